@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import random
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from tanks import (Difficulty, PlayerInput, Simulation, ENEMY_TYPES, ENEMY_WEIGHTS,
+                   ENEMIES_PER_WAVE, OWNER_ENEMY)
+
+# Поля результата одного эпизода, в том же порядке, что и в play_episode
+EPISODE_FIELDS = ["difficulty", "seed", "wave", "score", "damage_taken",
+                  "damage_dealt", "kills", "ticks", "alive"]
+# Какие распределения попадают в отчёт
+REPORT_FIELDS = ["wave", "score", "damage_taken", "damage_dealt", "kills", "ticks"]
+
+
+def scripted_policy(sim):
+    # Простой бот: встаёт на одну линию с ближайшим врагом, стреляет в него
+    # и отходит в сторону от летящих в него пуль
+    player = sim.player
+    px = player.center_x
+    py = player.center_y
+    inputs = PlayerInput(aim_x=px, aim_y=py + 1, fire=True)
+
+    if len(sim.enemy_list) > 0:
+        target = min(sim.enemy_list, key=lambda enemy: (enemy.center_x - px) ** 2 +
+                     (enemy.center_y - py) ** 2)
+        dx = target.center_x - px
+        dy = target.center_y - py
+        if abs(dx) < abs(dy):
+            # Стреляем по вертикали: подравниваемся по X
+            inputs.aim_x, inputs.aim_y = px, target.center_y
+            inputs.left = dx < -4
+            inputs.right = dx > 4
+            if abs(dy) < 150:
+                inputs.up = dy < 0
+                inputs.down = dy > 0
+        else:
+            inputs.aim_x, inputs.aim_y = target.center_x, py
+            inputs.down = dy < -4
+            inputs.up = dy > 4
+            if abs(dx) < 150:
+                inputs.right = dx < 0
+                inputs.left = dx > 0
+
+    bullets = sim.bullets
+    n = bullets.count
+    incoming = (bullets.alive[:n] & (bullets.owner[:n] == OWNER_ENEMY)).nonzero()[0]
+    if len(incoming):
+        rx = bullets.x[incoming] - px
+        ry = bullets.y[incoming] - py
+        vx = bullets.change_x[incoming]
+        vy = bullets.change_y[incoming]
+        # Время и расстояние наибольшего сближения с пулей
+        t = -(rx * vx + ry * vy) / np.maximum(vx * vx + vy * vy, 1e-9)
+        miss_x = rx + vx * t
+        miss_y = ry + vy * t
+        danger = (t > 0) & (t < 30) & (miss_x * miss_x + miss_y * miss_y < 40 ** 2)
+        for i in danger.nonzero()[0]:
+            if vx[i] == 0:
+                inputs.left = miss_x[i] >= 0
+                inputs.right = miss_x[i] < 0
+            else:
+                inputs.down = miss_y[i] >= 0
+                inputs.up = miss_y[i] < 0
+    return inputs
+
+
+def play_episode(task):
+    difficulty, seed, max_ticks, enemy_weights, enemies_per_wave = task
+    sim = Simulation(Difficulty(difficulty), seed=seed, effects=False,
+                     enemy_weights=enemy_weights, enemies_per_wave=enemies_per_wave)
+    while sim.tick < max_ticks and sim.step(scripted_policy(sim)):
+        pass
+    return (difficulty, seed, sim.wave, sim.score, sim.damage_taken,
+            sim.damage_dealt, sim.kills, sim.tick, sim.player.is_alive)
+
+
+def make_tasks(difficulties, episodes, seed, max_ticks, enemy_weights,
+               enemies_per_wave):
+    # Зерно у каждого эпизода своё и не зависит от числа процессов,
+    # поэтому отчёт воспроизводится на любой машине
+    rng = random.Random(seed)
+    tasks = []
+    for _ in range(episodes):
+        for difficulty in difficulties:
+            tasks.append((difficulty.value, rng.getrandbits(64), max_ticks,
+                          enemy_weights, enemies_per_wave))
+    return tasks
+
+
+def run_episodes(tasks, jobs):
+    if jobs == 1:
+        return [play_episode(task) for task in tasks]
+    # Эпизоды разной длины: раздаём их небольшими порциями по мере готовности
+    chunksize = max(1, min(16, len(tasks) // (jobs * 16)))
+    with Pool(jobs) as pool:
+        return list(pool.imap_unordered(play_episode, tasks, chunksize))
+
+
+def summarize(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "p10": float(np.percentile(values, 10)),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "max": float(values.max()),
+    }
+
+
+def build_report(results, settings):
+    report = {"settings": settings, "difficulties": {}}
+    for difficulty in Difficulty:
+        rows = [row for row in results if row[0] == difficulty.value]
+        if not rows:
+            continue
+        columns = {name: [row[i] for row in rows]
+                   for i, name in enumerate(EPISODE_FIELDS)}
+        waves = np.array(columns["wave"])
+        # Доля эпизодов, доживших до начала каждой волны
+        survival = {int(wave): float(np.mean(waves >= wave))
+                    for wave in range(int(waves.min()), int(waves.max()) + 1)}
+        report["difficulties"][difficulty.value] = {
+            "episodes": len(rows),
+            "survived_to_limit": float(np.mean(columns["alive"])),
+            "survival_by_wave": survival,
+            **{name: summarize(columns[name]) for name in REPORT_FIELDS},
+        }
+    return report
+
+
+def print_report(report):
+    settings = report["settings"]
+    print(f"Эпизодов: {settings['episodes_total']}, лимит {settings['max_ticks']} тиков, "
+          f"веса врагов {settings['enemy_weights']}, "
+          f"врагов на волну {settings['enemies_per_wave']}")
+    for difficulty, stats in report["difficulties"].items():
+        print()
+        print(f"Сложность {difficulty}: {stats['episodes']} эпизодов, "
+              f"дожили до лимита {stats['survived_to_limit']:.0%}")
+        print(f"  {'':14} {'среднее':>9} {'p10':>8} {'p50':>8} {'p90':>8} {'макс':>8}")
+        for name in REPORT_FIELDS:
+            s = stats[name]
+            print(f"  {name:14} {s['mean']:>9.1f} {s['p10']:>8.0f} {s['p50']:>8.0f} "
+                  f"{s['p90']:>8.0f} {s['max']:>8.0f}")
+        curve = "  ".join(f"{wave}:{share:.0%}"
+                          for wave, share in stats["survival_by_wave"].items())
+        print(f"  выживание по волнам: {curve}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Прогон баланса Танчиков методом Монте-Карло")
+    parser.add_argument("--episodes", type=int, default=1000,
+                        help="эпизодов на каждую сложность")
+    parser.add_argument("--difficulty", nargs="+", choices=[d.value for d in Difficulty],
+                        default=[d.value for d in Difficulty])
+    parser.add_argument("--max-ticks", type=int, default=60 * 60 * 5,
+                        help="лимит длины эпизода в тиках")
+    parser.add_argument("--weights", type=float, nargs=len(ENEMY_TYPES),
+                        default=ENEMY_WEIGHTS, metavar="W",
+                        help="веса врагов: " + ", ".join(ENEMY_TYPES))
+    parser.add_argument("--enemies-per-wave", type=int, default=ENEMIES_PER_WAVE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--json", metavar="FILE", help="сохранить отчёт в JSON")
+    args = parser.parse_args()
+
+    difficulties = [Difficulty(value) for value in args.difficulty]
+    tasks = make_tasks(difficulties, args.episodes, args.seed, args.max_ticks,
+                       args.weights, args.enemies_per_wave)
+    start = time.perf_counter()
+    results = run_episodes(tasks, args.jobs)
+    elapsed = time.perf_counter() - start
+    ticks = sum(row[EPISODE_FIELDS.index("ticks")] for row in results)
+
+    settings = {
+        "episodes_total": len(tasks),
+        "max_ticks": args.max_ticks,
+        "enemy_weights": list(args.weights),
+        "enemies_per_wave": args.enemies_per_wave,
+        "seed": args.seed,
+        "jobs": args.jobs,
+        "elapsed": elapsed,
+    }
+    report = build_report(results, settings)
+    print_report(report)
+    print()
+    print(f"{len(tasks)} эпизодов за {elapsed:.1f} с на {args.jobs} процессах "
+          f"({ticks / elapsed:.0f} тиков/с)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,515 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import arcade
+import numpy as np
+
+from balance import scripted_policy
+from tanks import (BulletSystem, Difficulty, Obstacle, ParticleSystem, Simulation,
+                   TankGame, sprite_boxes, OWNER_PLAYER, SCREEN_WIDTH, SCREEN_HEIGHT,
+                   BULLET_SPEED, ENEMY_MOVEMENT, ENEMY_TYPES)
+
+# Метрики сценария, по которым ищется регрессия относительно базовой линии
+SCENARIO_CHECKED = ["mean_ms", "p95_ms", "alloc_kib"]
+
+
+def random_shots(count, rng):
+    shots = []
+    for _ in range(count):
+        shots.append((rng.uniform(0, SCREEN_WIDTH), rng.uniform(0, SCREEN_HEIGHT),
+                      rng.choice([-BULLET_SPEED, 0, BULLET_SPEED]),
+                      rng.choice([-BULLET_SPEED, 0, BULLET_SPEED])))
+    return shots
+
+
+def bench_bullets(bullet_counts, enemies, repeats):
+    # Старый путь (спрайт на пулю, update() у каждой пули и проверка
+    # каждой пули против всего списка) против BulletSystem на тех же данных
+    rng = random.Random(42)
+    sim = Simulation(Difficulty.NORMAL)
+    while len(sim.enemy_list) < enemies:
+        sim.spawn_enemy()
+
+    targets = arcade.SpriteList()
+    for sprite in list(sim.obstacle_list) + list(sim.enemy_list):
+        targets.append(sprite)
+    halves = [sprite.width / 2 for sprite in targets]
+    boxes = sprite_boxes(list(targets), halves, halves)
+
+    print(f"Пули против {len(targets)} целей, {repeats} повторов")
+    print(f"{'пуль':>6} {'спрайты, мс':>12} {'массивы, мс':>12} {'ускорение':>10}")
+    for count in bullet_counts:
+        shots = random_shots(count, rng)
+
+        sprite_time = 0
+        for _ in range(repeats):
+            bullet_list = arcade.SpriteList()
+            for x, y, change_x, change_y in shots:
+                bullet = arcade.SpriteCircle(8, (255, 215, 0))
+                bullet.center_x = x
+                bullet.center_y = y
+                bullet.change_x = change_x
+                bullet.change_y = change_y
+                bullet_list.append(bullet)
+            start = time.perf_counter()
+            bullet_list.update()
+            for bullet in bullet_list:
+                arcade.check_for_collision_with_list(bullet, targets)
+            sprite_time += time.perf_counter() - start
+
+        array_time = 0
+        for _ in range(repeats):
+            bullets = BulletSystem()
+            for x, y, change_x, change_y in shots:
+                bullets.spawn(x, y, change_x, change_y, 8, 1, OWNER_PLAYER,
+                              (255, 215, 0))
+            start = time.perf_counter()
+            bullets.update(SCREEN_WIDTH, SCREEN_HEIGHT)
+            bullets.hits(None, *boxes)
+            array_time += time.perf_counter() - start
+
+        sprite_time /= repeats
+        array_time /= repeats
+        print(f"{count:>6} {sprite_time * 1000:>12.2f} {array_time * 1000:>12.2f} "
+              f"{sprite_time / array_time:>9.1f}x")
+
+
+def bench_tunnel(speeds, count, enemies, repeats):
+    # Пули разной скорости против препятствий и врагов стартовой арены:
+    # сколько попаданий теряет проверка пересечений в конце тика (пуля
+    # перелетает цель за один шаг) и во что обходится проверка вдоль пути
+    rng = random.Random(42)
+    sim = Simulation(Difficulty.NORMAL, seed=42)
+    while len(sim.enemy_list) < enemies:
+        sim.spawn_enemy()
+    targets = list(sim.obstacle_list) + list(sim.enemy_list)
+    halves = [sprite.width / 2 for sprite in targets]
+    boxes = sprite_boxes(targets, halves, halves)
+
+    print(f"{count} пуль против {len(targets)} целей, {repeats} повторов")
+    print(f"{'скорость':>9} {'попаданий hits':>15} {'sweeps':>7} {'потеряно':>9} "
+          f"{'hits, мс/тик':>13} {'sweeps, мс/тик':>15}")
+    for speed in speeds:
+        shots = [(rng.uniform(0, SCREEN_WIDTH), rng.uniform(0, SCREEN_HEIGHT),
+                  *rng.choice([(speed, 0), (-speed, 0), (0, speed), (0, -speed)]))
+                 for _ in range(count)]
+        results = []
+        for method in (BulletSystem.hits, BulletSystem.sweeps):
+            elapsed = 0
+            ticks = 0
+            for _ in range(repeats):
+                bullets = BulletSystem()
+                for x, y, change_x, change_y in shots:
+                    bullets.spawn(x, y, change_x, change_y, 8, 1, OWNER_PLAYER,
+                                  (255, 215, 0))
+                hit = 0
+                while len(bullets):
+                    start = time.perf_counter()
+                    bullets.update(SCREEN_WIDTH, SCREEN_HEIGHT)
+                    index = method(bullets, None, *boxes)[0]
+                    elapsed += time.perf_counter() - start
+                    ticks += 1
+                    hit += len(np.unique(index))
+                    bullets.alive[index] = False
+            results.append((hit, elapsed / ticks))
+        (hits, hits_time), (sweeps, sweeps_time) = results
+        print(f"{speed:>9} {hits:>15} {sweeps:>7} {1 - hits / max(sweeps, 1):>9.0%} "
+              f"{hits_time * 1000:>13.3f} {sweeps_time * 1000:>15.3f}")
+
+
+def bench_enemies(enemy_counts, ticks, movement=None):
+    # update() у каждого EnemyTank против пакетного EnemyController.
+    # Враги и игрок бессмертны, чтобы число врагов не менялось за прогон.
+    # movement - режим движения для всех типов врагов ("chase" - по полю
+    # направлений, "wander" - случайно), иначе ENEMY_MOVEMENT
+    enemy_movement = ENEMY_MOVEMENT
+    if movement:
+        enemy_movement = {enemy_type: movement for enemy_type in ENEMY_TYPES}
+    print(f"Тик симуляции, среднее за {ticks} тиков, движение: "
+          f"{movement or 'по типам'}")
+    print(f"{'врагов':>7} {'спрайты, мс':>12} {'массивы, мс':>12} {'ускорение':>10}")
+    for count in enemy_counts:
+        times = []
+        for batch_ai in (False, True):
+            random.seed(42)
+            sim = Simulation(Difficulty.NORMAL, batch_ai,
+                             enemy_movement=enemy_movement)
+            while len(sim.enemy_list) < count:
+                sim.spawn_enemy()
+            for tank in list(sim.enemy_list) + [sim.player]:
+                tank.health = tank.max_health = 10 ** 9
+            start = time.perf_counter()
+            sim.run(ticks)
+            times.append((time.perf_counter() - start) / ticks)
+        print(f"{count:>7} {times[0] * 1000:>12.2f} {times[1] * 1000:>12.2f} "
+              f"{times[0] / times[1]:>9.1f}x")
+
+
+def bench_sight(enemy_counts, ticks, seed):
+    # Сколько пуль выпускают враги с проверкой линии видимости и без неё.
+    # Игрок стоит на месте и не стреляет, все бессмертны: пули в отчёте -
+    # только вражеские, и все они проходят проверку попаданий в препятствия
+    print(f"Вражеские пули и тик симуляции за {ticks} тиков, зерно {seed}")
+    print(f"{'врагов':>7} {'пуль без':>9} {'пуль с':>7} {'меньше на':>10} "
+          f"{'в полёте без':>13} {'в полёте с':>11} {'тик без, мс':>12} "
+          f"{'тик с, мс':>10} {'лучей':>7}")
+    for count in enemy_counts:
+        rows = []
+        for enemy_sight in (False, True):
+            sim = Simulation(Difficulty.NORMAL, seed=seed, effects=False,
+                             enemy_sight=enemy_sight)
+            while len(sim.enemy_list) < count:
+                sim.spawn_enemy()
+            invulnerable(sim.player, *sim.enemy_list)
+            spawned = sim.bullets.spawned
+            in_flight = 0
+            start = time.perf_counter()
+            for _ in range(ticks):
+                sim.step()
+                in_flight += len(sim.bullets)
+            elapsed = (time.perf_counter() - start) / ticks
+            rays = sim.sight.rays if sim.sight else 0
+            rows.append((sim.bullets.spawned - spawned, in_flight / ticks, elapsed, rays))
+        (shots, flight, elapsed, _), (sight_shots, sight_flight, sight_elapsed, rays) = rows
+        print(f"{count:>7} {shots:>9} {sight_shots:>7} "
+              f"{1 - sight_shots / max(shots, 1):>10.0%} {flight:>13.1f} "
+              f"{sight_flight:>11.1f} {elapsed * 1000:>12.2f} "
+              f"{sight_elapsed * 1000:>10.2f} {rays:>7}")
+
+
+def invulnerable(*tanks):
+    for tank in tanks:
+        tank.health = tank.max_health = 10 ** 9
+
+
+def scenario_empty_arena(seed):
+    # Без препятствий и с одним неподвижным врагом: новая волна не начнётся
+    sim = Simulation(Difficulty.NORMAL, seed=seed)
+    for obstacle in list(sim.obstacle_list):
+        sim.remove_obstacle(obstacle)
+    for enemy in list(sim.enemy_list)[1:]:
+        enemy.remove_from_sprite_lists()
+    enemy = sim.enemy_list[0]
+    enemy.speed_multiplier = 0
+    enemy.shoot_timer = 10 ** 9
+    invulnerable(sim.player, enemy)
+    return sim, None
+
+
+def scenario_wave_10(seed):
+    sim = Simulation(Difficulty.NORMAL, seed=seed)
+    for enemy in list(sim.enemy_list):
+        enemy.remove_from_sprite_lists()
+    sim.wave = 9
+    sim.spawn_wave()
+    invulnerable(sim.player)
+    return sim, None
+
+
+def scenario_bullet_spam(seed):
+    # 200 бессмертных врагов стреляют в 9 раз чаще обычного
+    sim = Simulation(Difficulty.NORMAL, seed=seed)
+    while len(sim.enemy_list) < 200:
+        sim.spawn_enemy()
+    for enemy in sim.enemy_list:
+        enemy.shoot_interval = lambda: 10
+    invulnerable(sim.player, *sim.enemy_list)
+    sim.player.shoot_delay = 1
+    return sim, None
+
+
+def scenario_obstacle_heavy(seed):
+    sim = Simulation(Difficulty.NORMAL, seed=seed)
+    for x in range(140, SCREEN_WIDTH - 100, 50):
+        for y in range(170, SCREEN_HEIGHT - 100, 50):
+            obstacle = Obstacle(24, 24, (178, 34, 34), sim.rng)
+            obstacle.center_x = x
+            obstacle.center_y = y
+            sim.add_obstacle(obstacle)
+    invulnerable(sim.player)
+    return sim, None
+
+
+def scenario_particle_storm(seed):
+    # Пул на 20000 частиц и 300 новых частиц за тик
+    sim = Simulation(Difficulty.NORMAL, seed=seed)
+    sim.particle_system = ParticleSystem(capacity=20000, rng=random.Random(seed))
+    invulnerable(sim.player)
+    rng = random.Random(seed)
+
+    def storm(sim):
+        for _ in range(100):
+            sim.particle_system.create_trail(rng.uniform(0, SCREEN_WIDTH),
+                                             rng.uniform(0, SCREEN_HEIGHT),
+                                             (255, 140, 0))
+    return sim, storm
+
+
+def scenario_big_world(seed):
+    # Мир 16x16 экранов: время тика не должно зависеть от размера карты
+    sim = Simulation(Difficulty.NORMAL, seed=seed, world_width=SCREEN_WIDTH * 16,
+                     world_height=SCREEN_HEIGHT * 16)
+    invulnerable(sim.player)
+    return sim, None
+
+
+def scenario_arena_per_wave(seed):
+    # Волна зачищается каждые 100 тиков, и блоки арены расставляются заново
+    sim = Simulation(Difficulty.NORMAL, seed=seed, arena_per_wave=True)
+    invulnerable(sim.player)
+
+    def clear_wave(sim):
+        if sim.tick % 100 == 99:
+            for enemy in list(sim.enemy_list):
+                if sim.enemy_ai:
+                    sim.enemy_ai.remove(enemy)
+                sim.enemy_pool.release(enemy)
+    return sim, clear_wave
+
+
+SCENARIOS = {
+    "empty_arena": scenario_empty_arena,
+    "wave_10": scenario_wave_10,
+    "bullet_spam": scenario_bullet_spam,
+    "obstacle_heavy": scenario_obstacle_heavy,
+    "particle_storm": scenario_particle_storm,
+    "big_world": scenario_big_world,
+    "arena_per_wave": scenario_arena_per_wave,
+}
+
+
+def run_scenario(name, ticks, seed, warmup=60, alloc_ticks=100):
+    sim, load = SCENARIOS[name](seed)
+
+    def tick():
+        inputs = scripted_policy(sim)
+        start = time.perf_counter()
+        if load:
+            load(sim)
+        sim.step(inputs)
+        return time.perf_counter() - start
+
+    for _ in range(warmup):
+        tick()
+    times = np.array([tick() for _ in range(ticks)]) * 1000
+
+    # Память меряется отдельным прогоном: tracemalloc сильно замедляет тик.
+    # alloc_kib - сколько памяти тик занимает сверх уже занятой (пик),
+    # blocks - на сколько выросло число живых блоков Python за тик
+    peaks = []
+    blocks = []
+    tracemalloc.start()
+    for _ in range(alloc_ticks):
+        inputs = scripted_policy(sim)
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        allocated = sys.getallocatedblocks()
+        if load:
+            load(sim)
+        sim.step(inputs)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        blocks.append(sys.getallocatedblocks() - allocated)
+    tracemalloc.stop()
+
+    return {
+        "mean_ms": float(times.mean()),
+        "p95_ms": float(np.percentile(times, 95)),
+        "p99_ms": float(np.percentile(times, 99)),
+        "alloc_kib": float(np.mean(peaks)) / 1024,
+        "blocks": float(np.mean(blocks)),
+        "enemies": len(sim.enemy_list),
+        "bullets": len(sim.bullets),
+        "particles": len(sim.particle_system),
+    }
+
+
+def bench_scenarios(names, ticks, seed, repeats, baseline_path, save_baseline,
+                    threshold):
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)["scenarios"]
+
+    print(f"Сценарии, {ticks} тиков, зерно {seed}, лучший из {repeats} повторов")
+    print(f"{'сценарий':>15} {'среднее, мс':>12} {'p95, мс':>9} {'p99, мс':>9} "
+          f"{'КиБ/тик':>9} {'блоков/тик':>11}")
+    results = {}
+    regressions = []
+    for name in names:
+        # Сценарий детерминирован, поэтому от повтора к повтору меняется
+        # только шум машины: берём лучшее время
+        runs = [run_scenario(name, ticks, seed) for _ in range(repeats)]
+        result = runs[-1]
+        for metric in ("mean_ms", "p95_ms", "p99_ms"):
+            result[metric] = min(run[metric] for run in runs)
+        results[name] = result
+        print(f"{name:>15} {result['mean_ms']:>12.3f} {result['p95_ms']:>9.3f} "
+              f"{result['p99_ms']:>9.3f} {result['alloc_kib']:>9.1f} "
+              f"{result['blocks']:>11.1f}")
+        if name in baseline and not save_baseline:
+            for metric in SCENARIO_CHECKED:
+                old = baseline[name][metric]
+                if result[metric] > old * (1 + threshold):
+                    regressions.append(f"{name}.{metric}: {old:.3f} -> "
+                                       f"{result[metric]:.3f}")
+
+    if save_baseline:
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as f:
+                saved = json.load(f)["scenarios"]
+        else:
+            saved = {}
+        saved.update(results)
+        with open(baseline_path, "w") as f:
+            json.dump({"ticks": ticks, "seed": seed, "scenarios": saved}, f, indent=2)
+        print(f"Базовая линия сохранена в {baseline_path}")
+    elif not baseline:
+        print(f"Нет базовой линии {baseline_path}: сохраните её с --save-baseline")
+
+    if regressions:
+        print(f"Регрессия больше {threshold:.0%}:")
+        for line in regressions:
+            print("  " + line)
+        return False
+    return True
+
+
+def bench_state(names, ticks, seed, repeats):
+    # Снимок матча: размер, время save_state() и load_state() того же снимка
+    # (перемотка на шаг кольца) и возврата на ticks тиков назад (лучшее из
+    # repeats); затем тот же ввод после возврата должен дать тот же матч
+    print(f"Снимок матча после {ticks} тиков, зерно {seed}")
+    print(f"{'сценарий':<16} {'врагов':>7} {'пуль':>6} {'байт':>7} {'save, мкс':>10} "
+          f"{'load, мкс':>10} {'возврат, мкс':>13} {'совпадает':>10}")
+    for name in names:
+        sim, load = SCENARIOS[name](seed)
+
+        def tick(inputs=None):
+            if inputs is None:
+                inputs = scripted_policy(sim)
+            if load:
+                load(sim)
+            sim.step(inputs)
+            return inputs
+
+        for _ in range(ticks):
+            tick()
+        state = sim.save_state()
+        saves = []
+        loads = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            sim.save_state()
+            saves.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            sim.load_state(state)
+            loads.append(time.perf_counter() - start)
+        inputs = [tick() for _ in range(ticks)]
+        expected = sim.save_state()
+        backs = []
+        for _ in range(repeats):
+            sim.load_state(expected)
+            start = time.perf_counter()
+            sim.load_state(state)
+            backs.append(time.perf_counter() - start)
+        for recorded in inputs:
+            tick(recorded)
+        same = sim.save_state() == expected
+        print(f"{name:<16} {len(sim.enemy_list):>7} {len(sim.bullets):>6} {len(state):>7} "
+              f"{min(saves) * 1e6:>10.0f} {min(loads) * 1e6:>10.0f} {min(backs) * 1e6:>13.0f} "
+              f"{'да' if same else 'НЕТ':>10}")
+
+
+def draw_hud_immediate(game):
+    # Прежняя отрисовка HUD: f-строки и draw_text на каждый кадр
+    player = game.sim.player
+    arcade.draw_text(f"Здоровье: {player.health}/{player.max_health}",
+                     10, SCREEN_HEIGHT - 30, arcade.color.WHITE, 20)
+    arcade.draw_text(f"Очки: {game.sim.score}",
+                     10, SCREEN_HEIGHT - 60, arcade.color.WHITE, 20)
+    arcade.draw_text(f"Рекорд: {game.high_score}",
+                     10, SCREEN_HEIGHT - 90, arcade.color.GOLD, 20)
+    arcade.draw_text(f"Врагов: {len(game.sim.enemy_list)}",
+                     10, SCREEN_HEIGHT - 120, arcade.color.WHITE, 20)
+    arcade.draw_text(f"Волна: {game.sim.wave}", SCREEN_WIDTH - 150,
+                     SCREEN_HEIGHT - 30, arcade.color.WHITE, 20, anchor_x="right")
+    arcade.draw_text(f"Сложность: {game.difficulty.value}", SCREEN_WIDTH - 10,
+                     SCREEN_HEIGHT - 60, arcade.color.WHITE, 16, anchor_x="right")
+    arcade.draw_text("WASD - движение, ЛКМ/ПРОБЕЛ - стрельба", SCREEN_WIDTH // 2, 30,
+                     arcade.color.LIGHT_GRAY, 16, anchor_x="center")
+    arcade.draw_text("P - пауза", SCREEN_WIDTH - 10, SCREEN_HEIGHT - 90,
+                     arcade.color.LIGHT_GRAY, 16, anchor_x="right")
+
+
+def bench_hud(frames):
+    # Нужен контекст OpenGL: окно создаётся, но не показывается
+    game = TankGame()
+    game.set_visible(False)
+
+    for name, draw in (("draw_text", lambda: draw_hud_immediate(game)),
+                       ("TextLayer", game.draw_hud)):
+        draw()
+        game.ctx.finish()
+        start = time.perf_counter()
+        for frame in range(frames):
+            # Счёт меняется раз в 30 кадров, как в обычной игре
+            game.sim.score = frame // 30 * 10
+            draw()
+        game.ctx.finish()
+        elapsed = (time.perf_counter() - start) / frames
+        print(f"{name:>10}: {elapsed * 1000:.3f} мс на кадр")
+    game.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки Танчиков")
+    parser.add_argument("benchmark", nargs="?", default="bullets",
+                        choices=["bullets", "enemies", "hud", "scenarios", "sight",
+                                 "state", "tunnel"])
+    parser.add_argument("--bullets", type=int, nargs="+",
+                        default=[100, 500, 1000, 2000])
+    parser.add_argument("--enemies", type=int, default=50)
+    parser.add_argument("--speeds", type=float, nargs="+",
+                        default=[BULLET_SPEED, BULLET_SPEED * 2, 40, 80],
+                        help="tunnel: скорости пуль в пикселях за тик")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--enemy-counts", type=int, nargs="+",
+                        default=[10, 100, 1000, 5000])
+    parser.add_argument("--movement", choices=["chase", "wander"],
+                        help="enemies: режим движения всех врагов")
+    parser.add_argument("--ticks", type=int,
+                        help="тиков на прогон (enemies: 100, scenarios: 600, sight: 1200, "
+                             "state: 300)")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS),
+                        default=list(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default="benchmark_baseline.json",
+                        help="JSON с базовой линией сценариев")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="записать результаты как новую базовую линию")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="допустимое ухудшение относительно базовой линии")
+    args = parser.parse_args()
+    if args.benchmark == "hud":
+        bench_hud(args.frames)
+    elif args.benchmark == "enemies":
+        bench_enemies(args.enemy_counts, args.ticks or 100, args.movement)
+    elif args.benchmark == "tunnel":
+        bench_tunnel(args.speeds, args.bullets[-1], args.enemies, args.repeats)
+    elif args.benchmark == "sight":
+        bench_sight(args.enemy_counts, args.ticks or 1200, args.seed)
+    elif args.benchmark == "state":
+        bench_state(args.scenarios, args.ticks or 300, args.seed, args.repeats)
+    elif args.benchmark == "scenarios":
+        if not bench_scenarios(args.scenarios, args.ticks or 600, args.seed,
+                               args.repeats, args.baseline, args.save_baseline,
+                               args.threshold):
+            sys.exit(1)
+    else:
+        bench_bullets(args.bullets, args.enemies, args.repeats)
@@ -0,0 +1,410 @@
+import argparse
+import random
+import time
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from tanks import (Difficulty, PlayerInput, PowerUpType, Simulation, DIRECTIONS,
+                   ENEMY_TYPES, OWNER_ENEMY, SCREEN_WIDTH, SCREEN_HEIGHT, BULLET_SPEED)
+
+# Действие - строка int32 из трёх чисел, как ввод TankGame: кнопки в тех же
+# битах, что пишет Replay (left, right, up, down, fire), и точка прицела
+# в пикселях экрана, как у мыши
+ACTION_SIZE = 3
+ACTION_HIGH = np.array([31, SCREEN_WIDTH, SCREEN_HEIGHT], dtype=np.int32)
+
+# Признаки: игрок, ближайшие враги, пули и улучшения, карта препятствий.
+# Координаты объектов - относительно игрока, в долях экрана
+PLAYER_FEATURES = 11
+ENEMY_SLOTS = 16
+ENEMY_FEATURES = 11
+BULLET_SLOTS = 32
+BULLET_FEATURES = 6
+POWERUP_SLOTS = 4
+POWERUP_FEATURES = 8
+OBSTACLE_CELL = 40
+OBSTACLE_SHAPE = (SCREEN_HEIGHT // OBSTACLE_CELL, SCREEN_WIDTH // OBSTACLE_CELL)
+FEATURES_SIZE = (PLAYER_FEATURES + ENEMY_SLOTS * ENEMY_FEATURES +
+                 BULLET_SLOTS * BULLET_FEATURES + POWERUP_SLOTS * POWERUP_FEATURES +
+                 OBSTACLE_SHAPE[0] * OBSTACLE_SHAPE[1])
+
+# Растровое наблюдение: слои по клеткам GRID_CELL пикселей, строка 0 - низ экрана
+GRID_CELL = 20
+GRID_CHANNELS = ["obstacles", "player", "enemies", "enemy_bullets",
+                 "player_bullets", "powerups"]
+GRID_SHAPE = (len(GRID_CHANNELS), SCREEN_HEIGHT // GRID_CELL, SCREEN_WIDTH // GRID_CELL)
+
+POWERUP_TYPES = list(PowerUpType)
+
+
+def observation_shape(obs_type):
+    if obs_type == "features":
+        return (FEATURES_SIZE,)
+    if obs_type == "grid":
+        return GRID_SHAPE
+    raise ValueError(f"неизвестный тип наблюдения: {obs_type}")
+
+
+def encode_action(inputs):
+    keys = (inputs.left | inputs.right << 1 | inputs.up << 2 |
+            inputs.down << 3 | inputs.fire << 4)
+    return np.array([keys, round(inputs.aim_x), round(inputs.aim_y)], dtype=np.int32)
+
+
+def decode_action(action):
+    keys = int(action[0])
+    return PlayerInput(bool(keys & 1), bool(keys & 2), bool(keys & 4), bool(keys & 8),
+                       int(action[1]), int(action[2]), bool(keys & 16))
+
+
+def sample_actions(rng, count):
+    return (rng.random((count, ACTION_SIZE)) * (ACTION_HIGH + 1)).astype(np.int32)
+
+
+def rasterize_boxes(layer, cell, boxes, values):
+    # Отмечает клетки, которые задевают прямоугольники (центр, полуразмеры)
+    rows, cols = layer.shape
+    x, y, half_w, half_h = boxes
+    x0 = np.clip((x - half_w) // cell, 0, cols - 1).astype(np.intp)
+    x1 = np.clip((x + half_w - 1) // cell, 0, cols - 1).astype(np.intp)
+    y0 = np.clip((y - half_h) // cell, 0, rows - 1).astype(np.intp)
+    y1 = np.clip((y + half_h - 1) // cell, 0, rows - 1).astype(np.intp)
+    for i in range(len(x)):
+        layer[y0[i]:y1[i] + 1, x0[i]:x1[i] + 1] = values[i]
+
+
+def mark_points(layer, cell, x, y):
+    rows, cols = layer.shape
+    layer[np.clip(np.asarray(y) // cell, 0, rows - 1).astype(np.intp),
+          np.clip(np.asarray(x) // cell, 0, cols - 1).astype(np.intp)] = 1
+
+
+class TankEnv:
+    # Одна игра за интерфейсом reset()/step() в духе Gymnasium.
+    # Наблюдение пишется в obs на месте: VectorTankEnv отдаёт сюда строку
+    # общего буфера, и копирования между средой и агентом нет
+    def __init__(self, difficulty=Difficulty.NORMAL, obs_type="features",
+                 max_ticks=60 * 60 * 5, frame_skip=1, damage_penalty=50,
+                 batch_ai=False, seed=None, obs_buffer=None):
+        self.obs_type = obs_type
+        self.max_ticks = max_ticks
+        self.frame_skip = frame_skip
+        self.damage_penalty = damage_penalty
+        # Зёрна эпизодов идут из своего генератора: серия эпизодов
+        # воспроизводится по одному зерну среды
+        self.seeds = random.Random(seed)
+        self.sim = Simulation(difficulty, batch_ai, seed=0, effects=False)
+        if obs_buffer is None:
+            obs_buffer = np.zeros(observation_shape(obs_type), dtype=np.float32)
+        self.obs = obs_buffer
+        # Карта препятствий пересчитывается, только когда они меняются
+        self.obstacle_boxes = None
+        self.obstacle_layer = None
+
+    def reset(self, seed=None):
+        if seed is not None:
+            self.seeds = random.Random(seed)
+        self.sim.seed = self.seeds.getrandbits(64)
+        self.sim.setup()
+        self.observe()
+        return self.obs, self.info()
+
+    def step(self, action):
+        sim = self.sim
+        inputs = decode_action(action)
+        score = sim.score
+        damage_taken = sim.damage_taken
+        for _ in range(self.frame_skip):
+            if not sim.step(inputs) or sim.tick >= self.max_ticks:
+                break
+        reward = (sim.score - score) - self.damage_penalty * (sim.damage_taken - damage_taken)
+        terminated = not sim.player.is_alive
+        truncated = not terminated and sim.tick >= self.max_ticks
+        self.observe()
+        return self.obs, float(reward), terminated, truncated, self.info()
+
+    def info(self):
+        sim = self.sim
+        return {"tick": sim.tick, "wave": sim.wave, "score": sim.score}
+
+    def observe(self):
+        self.sim.sync_sprites()
+        if self.obs_type == "features":
+            self.observe_features(self.obs)
+        else:
+            self.observe_grid(self.obs)
+
+    def get_obstacle_layer(self, shape, cell):
+        boxes = self.sim.get_obstacle_boxes()
+        if boxes is not self.obstacle_boxes:
+            obstacles = boxes[0]
+            values = [0.5 if obstacle.is_destructible else 1.0 for obstacle in obstacles]
+            self.obstacle_layer = np.zeros(shape, dtype=np.float32)
+            rasterize_boxes(self.obstacle_layer, cell, boxes[1:], values)
+            self.obstacle_boxes = boxes
+        return self.obstacle_layer
+
+    def observe_features(self, out):
+        sim = self.sim
+        player = sim.player
+        px = player.center_x
+        py = player.center_y
+        out[:] = 0
+
+        out[0] = px / SCREEN_WIDTH
+        out[1] = py / SCREEN_HEIGHT
+        out[2] = player.health / player.max_health
+        out[3] = player.shoot_cooldown / player.shoot_delay
+        out[4] = player.speed_timer > 0
+        out[5] = player.damage_timer > 0
+        out[6] = player.fire_rate_timer > 0
+        out[7 + DIRECTIONS.index(player.direction)] = 1
+        offset = PLAYER_FEATURES
+
+        # Враги - от ближнего к дальнему
+        enemies = sorted(sim.enemy_list, key=lambda enemy: (enemy.center_x - px) ** 2 +
+                         (enemy.center_y - py) ** 2)
+        block = out[offset:offset + ENEMY_SLOTS * ENEMY_FEATURES].reshape(
+            ENEMY_SLOTS, ENEMY_FEATURES)
+        for row, enemy in zip(block, enemies):
+            row[0] = 1
+            row[1] = (enemy.center_x - px) / SCREEN_WIDTH
+            row[2] = (enemy.center_y - py) / SCREEN_HEIGHT
+            row[3] = enemy.health / enemy.max_health
+            row[4 + ENEMY_TYPES.index(enemy.enemy_type)] = 1
+            row[7 + DIRECTIONS.index(enemy.direction)] = 1
+        offset += ENEMY_SLOTS * ENEMY_FEATURES
+
+        # Пули - ближайшие BULLET_SLOTS без сортировки внутри
+        bullets = sim.bullets
+        index = bullets.alive[:bullets.count].nonzero()[0]
+        if len(index):
+            dx = bullets.x[index] - px
+            dy = bullets.y[index] - py
+            if len(index) > BULLET_SLOTS:
+                nearest = np.argpartition(dx * dx + dy * dy, BULLET_SLOTS - 1)[:BULLET_SLOTS]
+                index = index[nearest]
+                dx = dx[nearest]
+                dy = dy[nearest]
+            block = out[offset:offset + len(index) * BULLET_FEATURES].reshape(
+                len(index), BULLET_FEATURES)
+            block[:, 0] = 1
+            block[:, 1] = dx / SCREEN_WIDTH
+            block[:, 2] = dy / SCREEN_HEIGHT
+            block[:, 3] = bullets.change_x[index] / BULLET_SPEED
+            block[:, 4] = bullets.change_y[index] / BULLET_SPEED
+            block[:, 5] = bullets.owner[index] == OWNER_ENEMY
+        offset += BULLET_SLOTS * BULLET_FEATURES
+
+        block = out[offset:offset + POWERUP_SLOTS * POWERUP_FEATURES].reshape(
+            POWERUP_SLOTS, POWERUP_FEATURES)
+        for row, powerup in zip(block, sim.powerup_list):
+            row[0] = 1
+            row[1] = (powerup.center_x - px) / SCREEN_WIDTH
+            row[2] = (powerup.center_y - py) / SCREEN_HEIGHT
+            row[3] = powerup.lifetime / 300
+            row[4 + POWERUP_TYPES.index(powerup.type)] = 1
+        offset += POWERUP_SLOTS * POWERUP_FEATURES
+
+        out[offset:] = self.get_obstacle_layer(OBSTACLE_SHAPE, OBSTACLE_CELL).ravel()
+
+    def observe_grid(self, out):
+        sim = self.sim
+        out[:] = 0
+        out[0] = self.get_obstacle_layer(GRID_SHAPE[1:], GRID_CELL)
+        mark_points(out[1], GRID_CELL, sim.player.center_x, sim.player.center_y)
+        if len(sim.enemy_list):
+            mark_points(out[2], GRID_CELL, [enemy.center_x for enemy in sim.enemy_list],
+                        [enemy.center_y for enemy in sim.enemy_list])
+        bullets = sim.bullets
+        n = bullets.count
+        enemy_owned = bullets.owner[:n] == OWNER_ENEMY
+        for layer, mask in ((out[3], enemy_owned), (out[4], ~enemy_owned)):
+            index = (bullets.alive[:n] & mask).nonzero()[0]
+            mark_points(layer, GRID_CELL, bullets.x[index], bullets.y[index])
+        if len(sim.powerup_list):
+            mark_points(out[5], GRID_CELL, [powerup.center_x for powerup in sim.powerup_list],
+                        [powerup.center_y for powerup in sim.powerup_list])
+
+
+def vector_arrays(buffers, num_envs, obs_shape):
+    # Массивы VectorTankEnv поверх буферов: своих или общей памяти
+    observations, rewards, terminated, truncated, actions = buffers
+    return (np.ndarray((num_envs,) + obs_shape, dtype=np.float32, buffer=observations),
+            np.ndarray(num_envs, dtype=np.float32, buffer=rewards),
+            np.ndarray(num_envs, dtype=bool, buffer=terminated),
+            np.ndarray(num_envs, dtype=bool, buffer=truncated),
+            np.ndarray((num_envs, ACTION_SIZE), dtype=np.int32, buffer=actions))
+
+
+def vector_sizes(num_envs, obs_shape):
+    return (num_envs * int(np.prod(obs_shape)) * 4, num_envs * 4, num_envs, num_envs,
+            num_envs * ACTION_SIZE * 4)
+
+
+def env_seed(seed, i):
+    return None if seed is None else seed + i
+
+
+def step_envs(envs, first, arrays):
+    # Закончившийся эпизод сразу перезапускается, как в векторных средах
+    # Gymnasium: последнее наблюдение эпизода уходит в info
+    observations, rewards, terminated, truncated, actions = arrays
+    infos = []
+    for i, env in enumerate(envs, first):
+        _, reward, done, cut, info = env.step(actions[i])
+        rewards[i] = reward
+        terminated[i] = done
+        truncated[i] = cut
+        if done or cut:
+            info["final_observation"] = observations[i].copy()
+            env.reset()
+        infos.append(info)
+    return infos
+
+
+def vector_worker(pipe, names, num_envs, first, last, env_kwargs, seed):
+    blocks = [SharedMemory(name=name) for name in names]
+    obs_shape = observation_shape(env_kwargs.get("obs_type", "features"))
+    arrays = vector_arrays([block.buf for block in blocks], num_envs, obs_shape)
+    envs = [TankEnv(seed=env_seed(seed, i), obs_buffer=arrays[0][i], **env_kwargs)
+            for i in range(first, last)]
+    try:
+        while True:
+            command, data = pipe.recv()
+            if command == "step":
+                pipe.send(step_envs(envs, first, arrays))
+            elif command == "reset":
+                pipe.send([env.reset(env_seed(data, i))[1]
+                           for i, env in enumerate(envs, first)])
+            else:
+                break
+    finally:
+        del arrays, envs
+        for block in blocks:
+            block.close()
+        pipe.close()
+
+
+class VectorTankEnv:
+    # N независимых игр за одним вызовом step(actions). При jobs=0 игры
+    # идут в этом процессе, иначе делятся между jobs процессами; наблюдения,
+    # награды и действия лежат в общей памяти, по каналу идут только команды
+    # и короткие info
+    def __init__(self, num_envs, jobs=0, seed=None, **env_kwargs):
+        self.num_envs = num_envs
+        self.obs_shape = observation_shape(env_kwargs.get("obs_type", "features"))
+        sizes = vector_sizes(num_envs, self.obs_shape)
+        self.blocks = []
+        self.workers = []
+        self.pipes = []
+        if jobs <= 0:
+            buffers = [bytearray(size) for size in sizes]
+        else:
+            self.blocks = [SharedMemory(create=True, size=size) for size in sizes]
+            buffers = [block.buf for block in self.blocks]
+        self.arrays = vector_arrays(buffers, num_envs, self.obs_shape)
+        (self.observations, self.rewards, self.terminated,
+         self.truncated, self.actions) = self.arrays
+
+        if jobs <= 0:
+            self.envs = [TankEnv(seed=env_seed(seed, i), obs_buffer=self.observations[i],
+                                 **env_kwargs) for i in range(num_envs)]
+            return
+
+        self.envs = None
+        context = get_context()
+        jobs = min(jobs, num_envs)
+        bounds = [num_envs * k // jobs for k in range(jobs + 1)]
+        names = [block.name for block in self.blocks]
+        for first, last in zip(bounds, bounds[1:]):
+            pipe, child = context.Pipe()
+            worker = context.Process(target=vector_worker, daemon=True,
+                                     args=(child, names, num_envs, first, last,
+                                           env_kwargs, seed))
+            worker.start()
+            child.close()
+            self.pipes.append(pipe)
+            self.workers.append(worker)
+
+    def reset(self, seed=None):
+        if self.envs is not None:
+            infos = [env.reset(env_seed(seed, i))[1] for i, env in enumerate(self.envs)]
+        else:
+            for pipe in self.pipes:
+                pipe.send(("reset", seed))
+            infos = [info for pipe in self.pipes for info in pipe.recv()]
+        return self.observations, infos
+
+    def step(self, actions):
+        self.actions[:] = actions
+        if self.envs is not None:
+            infos = step_envs(self.envs, 0, self.arrays)
+        else:
+            for pipe in self.pipes:
+                pipe.send(("step", None))
+            infos = [info for pipe in self.pipes for info in pipe.recv()]
+        return self.observations, self.rewards, self.terminated, self.truncated, infos
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.send(("close", None))
+        for worker in self.workers:
+            worker.join()
+        for pipe in self.pipes:
+            pipe.close()
+        self.pipes = []
+        self.workers = []
+        # Массивы смотрят в общую память: их надо отпустить до close()
+        self.arrays = self.observations = self.rewards = None
+        self.terminated = self.truncated = self.actions = None
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def bench(num_envs, jobs, steps, seed, env_kwargs):
+    rng = np.random.default_rng(seed)
+    with VectorTankEnv(num_envs, jobs, seed, **env_kwargs) as envs:
+        envs.reset(seed)
+        episodes = 0
+        start = time.perf_counter()
+        for _ in range(steps):
+            _, _, terminated, truncated, _ = envs.step(sample_actions(rng, num_envs))
+            episodes += int(np.count_nonzero(terminated | truncated))
+        elapsed = time.perf_counter() - start
+    return num_envs * steps / elapsed, episodes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер пропускной способности среды Танчиков")
+    parser.add_argument("--envs", type=int, default=16, help="игр в векторной среде")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[0],
+                        help="число процессов, 0 - в этом процессе")
+    parser.add_argument("--steps", type=int, default=500, help="шагов векторной среды")
+    parser.add_argument("--obs", choices=["features", "grid"], default="features")
+    parser.add_argument("--difficulty", choices=[d.value for d in Difficulty],
+                        default=Difficulty.NORMAL.value)
+    parser.add_argument("--frame-skip", type=int, default=1)
+    parser.add_argument("--batch-ai", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    env_kwargs = {"difficulty": Difficulty(args.difficulty), "obs_type": args.obs,
+                  "frame_skip": args.frame_skip, "batch_ai": args.batch_ai}
+    print(f"{args.envs} сред, наблюдение {args.obs} {observation_shape(args.obs)}, "
+          f"{args.steps} шагов, пропуск кадров {args.frame_skip}")
+    for jobs in args.jobs:
+        rate, episodes = bench(args.envs, jobs, args.steps, args.seed, env_kwargs)
+        where = "в этом процессе" if jobs <= 0 else f"{jobs} процессов"
+        print(f"  {where:>16}: {rate:>8.0f} шагов среды/с, "
+              f"{rate * args.frame_skip:>8.0f} тиков/с, эпизодов завершено {episodes}")
@@ -0,0 +1,1143 @@
+import argparse
+import asyncio
+import random
+import signal
+import socket
+import struct
+import time
+from multiprocessing import get_context
+
+import arcade
+import numpy as np
+
+from tanks import (BulletSystem, Difficulty, HealthBarRenderer, ObstacleGrid, PlayerInput,
+                   PlayerTank, PowerUpType, RectRenderer, Simulation, Tank, TextLayer, Wall,
+                   drive_player, get_powerup_texture, tick_frames, DIRECTIONS, ENEMY_TYPES,
+                   MAX_FRAME_TIME, MIN_TICK_RATE, RECT_VERTEX_DTYPE, SCREEN_WIDTH,
+                   SCREEN_HEIGHT, SCREEN_TITLE, TICK_RATE)
+
+# Сетевая игра: сервер ведёт матч сам, клиенты шлют только ввод и получают
+# снимки состояния. Пакеты - датаграммы UDP: magic, версия протокола, тип
+NET_MAGIC = b"TNKN"
+NET_VERSION = 2
+NET_HEADER = struct.Struct("<4sBB")
+NET_PORT = 5555
+PACKET_HELLO = 0
+PACKET_WELCOME = 1
+PACKET_INPUT = 2
+PACKET_SNAPSHOT = 3
+PACKET_BYE = 4
+# WELCOME: номер игрока, тиков в секунду, тиков между снимками, размер мира
+WELCOME = struct.Struct("<HHBHH")
+# INPUT: последний принятый снимок, номер самого нового ввода, число вводов;
+# дальше вводы от нового к старому - кнопки в битах Replay и прицел
+INPUT_HEADER = struct.Struct("<IIB")
+INPUT_ENTRY = struct.Struct("<Bhh")
+# Каждый ввод повторяется ещё в стольких пакетах: потерянный пакет
+# не теряет ввод
+INPUT_REDUNDANCY = 4
+# Сколько вводов сервер держит в очереди; лишние старые пропускаются,
+# чтобы задержка управления не копилась
+INPUT_BUFFER = 3
+# Датаграмма не длиннее стольких байт проходит без IP-фрагментации:
+# минимальный MTU IPv6 1280 минус заголовки IP и UDP с запасом
+NET_MTU = 1200
+# SNAPSHOT: тик снимка, тик базового снимка (0 - снимок целиком),
+# последний применённый ввод получателя, номер части и число частей;
+# дальше часть изменений по категориям. Снимок режется на части по
+# SNAPSHOT_PART байт и разбирается, когда пришли все его части
+SNAPSHOT_HEADER = struct.Struct("<IIIBB")
+SNAPSHOT_PART = NET_MTU - NET_HEADER.size - SNAPSHOT_HEADER.size
+SNAPSHOT_MAX_PARTS = 255
+# Столько последних снимков сервер держит как базы для дельт, клиент -
+# как базы и для интерполяции
+SNAPSHOT_HISTORY = 64
+# Чужие танки и враги рисуются на столько снимков позади сервера
+INTERPOLATION = 2
+# Координаты в снимках - uint16 в четвертях пикселя
+NET_SCALE = 4
+NET_TIMEOUT = 5.0
+# Погибший игрок возвращается через столько кадров
+RESPAWN_TIME = 180
+
+# Объект снимка - кортеж целых полей; в дельту идёт маска изменившихся
+# полей и только они
+NET_FIELDS = {
+    # очки, волна
+    "match": "IH",
+    # x, y, направление, здоровье, максимум здоровья, флаги (жив и улучшения)
+    "players": "HHBBBB",
+    # x, y, направление, вид, здоровье
+    "enemies": "HHBBB",
+    # x, y и скорость за тик на тике tick, радиус, стиль (владелец и цвет), tick:
+    # пуля летит по прямой, и её поля после появления не меняются
+    "bullets": "HHhhBII",
+    # x, y, ширина, высота, прочность, разрушаемое
+    "obstacles": "HHHHHB",
+    # x, y, вид
+    "powerups": "HHB",
+}
+NET_COUNTS = struct.Struct("<HH")
+NET_ENTITY = struct.Struct("<IB")
+FIELD_STRUCTS = {}
+POWERUP_TYPES = list(PowerUpType)
+
+
+def field_struct(category, mask):
+    # Упаковщик полей объекта по маске; маски повторяются, поэтому кэш
+    packer = FIELD_STRUCTS.get((category, mask))
+    if packer is None:
+        fields = NET_FIELDS[category]
+        packer = struct.Struct("<" + "".join(field for i, field in enumerate(fields)
+                                             if mask >> i & 1))
+        FIELD_STRUCTS[(category, mask)] = packer
+    return packer
+
+
+def coordinate(value):
+    return min(max(round(value * NET_SCALE), 0), 65535)
+
+
+def encode_delta(base, state):
+    # Изменения state относительно base: по каждой категории - удалённые
+    # объекты, затем новые и изменившиеся с маской полей
+    out = bytearray()
+    for category, fields in NET_FIELDS.items():
+        old = base.get(category, {})
+        new = state[category]
+        if old is new:
+            out += NET_COUNTS.pack(0, 0)
+            continue
+        full = (1 << len(fields)) - 1
+        removed = [key for key in old if key not in new]
+        changed = []
+        for key, values in new.items():
+            previous = old.get(key)
+            if previous == values:
+                continue
+            mask = full
+            if previous is not None:
+                mask = 0
+                for i, (a, b) in enumerate(zip(previous, values)):
+                    if a != b:
+                        mask |= 1 << i
+            changed.append((key, mask, values))
+        out += NET_COUNTS.pack(len(removed), len(changed))
+        out += struct.pack(f"<{len(removed)}I", *removed)
+        for key, mask, values in changed:
+            out += NET_ENTITY.pack(key, mask)
+            if mask != full:
+                values = [value for i, value in enumerate(values) if mask >> i & 1]
+            out += field_struct(category, mask).pack(*values)
+    return bytes(out)
+
+
+def decode_delta(base, data, offset):
+    state = {}
+    for category, fields in NET_FIELDS.items():
+        entities = dict(base.get(category, {}))
+        full = (1 << len(fields)) - 1
+        removed, changed = NET_COUNTS.unpack_from(data, offset)
+        offset += NET_COUNTS.size
+        for key in struct.unpack_from(f"<{removed}I", data, offset):
+            entities.pop(key, None)
+        offset += 4 * removed
+        for _ in range(changed):
+            key, mask = NET_ENTITY.unpack_from(data, offset)
+            offset += NET_ENTITY.size
+            packer = field_struct(category, mask)
+            values = packer.unpack_from(data, offset)
+            offset += packer.size
+            if mask != full:
+                merged = list(entities[key])
+                changed_values = iter(values)
+                for i in range(len(fields)):
+                    if mask >> i & 1:
+                        merged[i] = next(changed_values)
+                values = tuple(merged)
+            entities[key] = values
+        state[category] = entities
+    return state
+
+
+def input_keys(inputs):
+    return (inputs.left | inputs.right << 1 | inputs.up << 2 |
+            inputs.down << 3 | inputs.fire << 4)
+
+
+def decode_input(keys, aim_x, aim_y):
+    return PlayerInput(bool(keys & 1), bool(keys & 2), bool(keys & 4), bool(keys & 8),
+                       aim_x, aim_y, bool(keys & 16))
+
+
+def packet(kind, *parts):
+    return b"".join((NET_HEADER.pack(NET_MAGIC, NET_VERSION, kind),) + parts)
+
+
+def snapshot_parts(body):
+    return [body[i:i + SNAPSHOT_PART] for i in range(0, len(body), SNAPSHOT_PART)]
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else 0.0
+
+
+class Connection:
+    # Клиент на сервере: его танк, очередь ввода и что он уже подтвердил
+    def __init__(self, number, address, player):
+        self.number = number
+        self.address = address
+        self.player = player
+        self.last_seen = time.monotonic()
+        # Последний снимок, который клиент получил: база для следующей дельты
+        self.acked = 0
+        # Номер последнего применённого ввода и сам ввод - он повторяется,
+        # пока не придёт следующий
+        self.applied = 0
+        self.control = None
+        self.pending = {}
+        self.respawn = None
+        self.bytes_sent = 0
+
+    def receive_inputs(self, newest, entries):
+        for age, entry in enumerate(entries):
+            sequence = newest - age
+            if sequence > self.applied and sequence not in self.pending:
+                self.pending[sequence] = decode_input(*entry)
+
+    def next_input(self):
+        if self.pending:
+            # Если ввод с номером applied + 1 пропал, он не придёт: более
+            # новые пакеты несли бы его повтором
+            for sequence in sorted(self.pending)[:-INPUT_BUFFER]:
+                del self.pending[sequence]
+            self.applied = min(self.pending)
+            self.control = self.pending.pop(self.applied)
+        return self.control
+
+
+class GameServer(asyncio.DatagramProtocol):
+    # Авторитетный сервер: тики матча по часам цикла asyncio, ввод клиентов
+    # из датаграмм, раз в snapshot_interval тиков - снимок каждому клиенту
+    # дельтой от последнего подтверждённого им снимка. Клиенты с одной
+    # базой получают одну и ту же закодированную дельту.
+    def __init__(self, difficulty=Difficulty.NORMAL, seed=None, world=(1600, 1200),
+                 level=None, tick_rate=TICK_RATE, snapshot_interval=2, batch_ai=False):
+        self.rng = random.Random(seed)
+        self.sim = Simulation(difficulty, batch_ai, self.rng.getrandbits(64), effects=False,
+                              world_width=world[0], world_height=world[1], level=level,
+                              tick_rate=tick_rate)
+        # Танк, созданный матчем, достаётся первому клиенту
+        self.spare_player = True
+        self.tick_rate = tick_rate
+        self.snapshot_interval = snapshot_interval
+        self.connections = {}
+        self.next_number = 1
+        self.tick = 0
+        self.history = {}
+        # Пули по сквозному номеру: место, скорость и тик первого снимка с ней
+        self.origins = {}
+        # Препятствия из прошлого снимка и версия сетки, по которой они
+        # собраны: меняется в основном прочность разрушаемых
+        self.obstacles = {}
+        self.destructible = []
+        self.obstacle_version = None
+        self.transport = None
+        self.running = False
+        self.tick_times = []
+        self.step_times = []
+        self.snapshot_times = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.packets_sent = 0
+        self.send_errors = 0
+        self.full_snapshots = 0
+        self.oversized_snapshots = 0
+        # Волна и очки матчей, закончившихся уходом всех игроков
+        self.results = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        # Неотправленная датаграмма не роняет сервер, но видна в отчёте
+        self.send_errors += 1
+
+    def datagram_received(self, data, address):
+        try:
+            magic, version, kind = NET_HEADER.unpack_from(data)
+            if magic != NET_MAGIC or version != NET_VERSION:
+                return
+            self.bytes_received += len(data)
+            connection = self.connections.get(address)
+            if kind == PACKET_HELLO:
+                if connection is None:
+                    connection = self.join(address)
+                # Повторный HELLO - WELCOME потерялся
+                self.send(connection, packet(PACKET_WELCOME, WELCOME.pack(
+                    connection.number, self.tick_rate, self.snapshot_interval,
+                    self.sim.world_width, self.sim.world_height)))
+            elif connection is None:
+                return
+            elif kind == PACKET_INPUT:
+                acked, newest, count = INPUT_HEADER.unpack_from(data, NET_HEADER.size)
+                offset = NET_HEADER.size + INPUT_HEADER.size
+                entries = [INPUT_ENTRY.unpack_from(data, offset + i * INPUT_ENTRY.size)
+                           for i in range(count)]
+                connection.acked = max(connection.acked, acked)
+                connection.receive_inputs(newest, entries)
+            elif kind == PACKET_BYE:
+                self.leave(connection)
+                return
+            connection.last_seen = time.monotonic()
+        except struct.error:
+            return
+
+    def join(self, address):
+        if self.spare_player:
+            player = self.sim.player
+            self.spare_player = False
+        else:
+            player = self.sim.add_player()
+        connection = Connection(self.next_number, address, player)
+        self.next_number += 1
+        self.connections[address] = connection
+        return connection
+
+    def leave(self, connection):
+        del self.connections[connection.address]
+        self.sim.remove_player(connection.player)
+        if not self.connections:
+            # Без игроков матч начинается заново с новым зерном
+            self.results.append((self.sim.wave, self.sim.score))
+            self.sim.seed = self.rng.getrandbits(64)
+            self.sim.setup()
+            self.spare_player = True
+            self.history = {}
+            self.origins = {}
+            self.obstacle_version = None
+
+    def send(self, connection, data):
+        self.transport.sendto(data, connection.address)
+        connection.bytes_sent += len(data)
+        self.bytes_sent += len(data)
+        self.packets_sent += 1
+
+    def update(self):
+        start = time.perf_counter()
+        now = time.monotonic()
+        for connection in list(self.connections.values()):
+            if now - connection.last_seen > NET_TIMEOUT:
+                self.leave(connection)
+        if not self.connections:
+            return
+        self.tick += 1
+        sim = self.sim
+        inputs = {}
+        for connection in self.connections.values():
+            player = connection.player
+            control = connection.next_input()
+            if player.is_alive:
+                if control is not None:
+                    inputs[player] = control
+            elif connection.respawn is None:
+                connection.respawn = RESPAWN_TIME
+            else:
+                connection.respawn -= sim.frame_step
+                if connection.respawn <= 0:
+                    sim.respawn_player(player)
+                    connection.respawn = None
+        sim.step(inputs)
+        stepped = time.perf_counter()
+        self.step_times.append(stepped - start)
+        if self.tick % self.snapshot_interval == 0:
+            self.broadcast()
+            self.snapshot_times.append(time.perf_counter() - stepped)
+        self.tick_times.append(time.perf_counter() - start)
+
+    def snapshot_state(self):
+        sim = self.sim
+        sim.sync_sprites()
+        players = {}
+        for connection in self.connections.values():
+            player = connection.player
+            flags = (player.is_alive | (player.speed_timer > 0) << 1 |
+                     (player.damage_timer > 0) << 2 | (player.fire_rate_timer > 0) << 3)
+            players[connection.number] = (
+                coordinate(player.center_x), coordinate(player.center_y),
+                DIRECTIONS.index(player.direction), max(0, player.health),
+                player.max_health, flags)
+        enemies = {
+            enemy.serial: (coordinate(enemy.center_x), coordinate(enemy.center_y),
+                           DIRECTIONS.index(enemy.direction),
+                           ENEMY_TYPES.index(enemy.enemy_type), max(0, enemy.health))
+            for enemy in sim.enemy_list
+        }
+        bullets = sim.bullets
+        n = bullets.count
+        alive = bullets.alive[:n]
+        origins = {}
+        for serial, x, y, change_x, change_y, radius, owner, color in zip(
+                bullets.serial[:n][alive].tolist(), bullets.x[:n][alive].tolist(),
+                bullets.y[:n][alive].tolist(), bullets.change_x[:n][alive].tolist(),
+                bullets.change_y[:n][alive].tolist(), bullets.radius[:n][alive].tolist(),
+                bullets.owner[:n][alive].tolist(), bullets.color[:n][alive].tolist()):
+            origin = self.origins.get(serial)
+            if origin is None:
+                origin = (coordinate(x), coordinate(y), round(change_x * NET_SCALE),
+                          round(change_y * NET_SCALE), int(radius),
+                          owner << 24 | color[0] << 16 | color[1] << 8 | color[2], self.tick)
+            origins[serial] = origin
+        self.origins = origins
+        powerups = {
+            powerup.serial: (coordinate(powerup.center_x), coordinate(powerup.center_y),
+                             POWERUP_TYPES.index(powerup.type))
+            for powerup in sim.powerup_list
+        }
+        return {"match": {0: (sim.score, sim.wave)}, "players": players, "enemies": enemies,
+                "bullets": origins, "obstacles": self.obstacle_state(), "powerups": powerups}
+
+    def obstacle_state(self):
+        # Снимки держат словарь препятствий общим, пока он не изменится:
+        # сохранённые в истории снимки не правятся
+        grid = self.sim.obstacle_grid
+        if grid.version != self.obstacle_version:
+            self.obstacle_version = grid.version
+            self.obstacles = {
+                slot: (coordinate(obstacle.center_x), coordinate(obstacle.center_y),
+                       coordinate(obstacle.width), coordinate(obstacle.height),
+                       min(max(obstacle.health, 0), 65535), obstacle.is_destructible)
+                for slot, obstacle in enumerate(grid.obstacles) if obstacle is not None
+            }
+            self.destructible = [(slot, obstacle) for slot, obstacle in enumerate(grid.obstacles)
+                                 if obstacle is not None and obstacle.is_destructible]
+            return self.obstacles
+        obstacles = self.obstacles
+        for slot, obstacle in self.destructible:
+            health = min(max(obstacle.health, 0), 65535)
+            if obstacles[slot][4] != health:
+                if obstacles is self.obstacles:
+                    obstacles = dict(obstacles)
+                obstacles[slot] = obstacles[slot][:4] + (health, True)
+        self.obstacles = obstacles
+        return obstacles
+
+    def snapshot_size(self):
+        # Длина полного снимка до начала игры: её растят в основном
+        # препятствия, поэтому размер мира проверяется по ней
+        return len(encode_delta({}, self.snapshot_state()))
+
+    def broadcast(self):
+        state = self.snapshot_state()
+        self.history[self.tick] = state
+        self.history.pop(self.tick - SNAPSHOT_HISTORY * self.snapshot_interval, None)
+        bodies = {}
+        for connection in list(self.connections.values()):
+            base = connection.acked if connection.acked in self.history else 0
+            parts = bodies.get(base)
+            if parts is None:
+                parts = bodies[base] = snapshot_parts(
+                    encode_delta(self.history.get(base, {}), state))
+            if len(parts) > SNAPSHOT_MAX_PARTS:
+                self.oversized_snapshots += 1
+                continue
+            if base == 0:
+                self.full_snapshots += 1
+            for index, part in enumerate(parts):
+                self.send(connection, packet(PACKET_SNAPSHOT, SNAPSHOT_HEADER.pack(
+                    self.tick, base, connection.applied, index, len(parts)), part))
+
+    async def run(self, host="0.0.0.0", port=NET_PORT, seconds=None):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: self,
+                                                           local_addr=(host, port))
+        tick_time = 1 / self.tick_rate
+        start = loop.time()
+        next_tick = start
+        self.running = True
+        # Ctrl+C и SIGTERM останавливают цикл, а не рвут asyncio.run():
+        # статистика сервера всё равно возвращается
+        signals = []
+        for number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(number, self.stop)
+                signals.append(number)
+            except (NotImplementedError, RuntimeError):
+                # Windows: остаётся KeyboardInterrupt, его ловит цикл ниже
+                pass
+        try:
+            while self.running and (seconds is None or loop.time() - start < seconds):
+                next_tick += tick_time
+                delay = next_tick - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -MAX_FRAME_TIME:
+                    # Сервер не успевает: пропущенное время не догоняется
+                    next_tick = loop.time()
+                self.update()
+        except KeyboardInterrupt:
+            self.stop()
+        finally:
+            for number in signals:
+                loop.remove_signal_handler(number)
+            transport.close()
+        return self.stats()
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        ms = 1000
+        ticks = len(self.tick_times)
+        seconds = max(ticks / self.tick_rate, 1e-9)
+        snapshots = len(self.snapshot_times)
+        wave, score = max(self.results + [(self.sim.wave, self.sim.score)],
+                          key=lambda result: result[1])
+        return {
+            "ticks": ticks,
+            "tick_ms": np.mean(self.tick_times) * ms if ticks else 0.0,
+            "tick_p99_ms": percentile(self.tick_times, 99) * ms,
+            "tick_max_ms": max(self.tick_times, default=0.0) * ms,
+            "step_ms": np.mean(self.step_times) * ms if ticks else 0.0,
+            "snapshot_ms": np.mean(self.snapshot_times) * ms if snapshots else 0.0,
+            "sent_kbps": self.bytes_sent * 8 / 1000 / seconds,
+            "received_kbps": self.bytes_received * 8 / 1000 / seconds,
+            "packets": self.packets_sent,
+            "packet_bytes": self.bytes_sent / max(self.packets_sent, 1),
+            "send_errors": self.send_errors,
+            "full_snapshots": self.full_snapshots,
+            "oversized_snapshots": self.oversized_snapshots,
+            "matches": len(self.results) + 1,
+            "wave": wave,
+            "score": score,
+        }
+
+
+class NetClient:
+    # Клиент без окна и сокета: собирает пакеты ввода и разбирает снимки.
+    # Свой танк предсказывается - ввод применяется сразу тем же
+    # drive_player, что и на сервере, а при каждом снимке танк ставится
+    # в подтверждённое место и неподтверждённый ввод проигрывается заново.
+    # Остальное рисуется с запозданием INTERPOLATION снимков между двумя
+    # полученными снимками.
+    def __init__(self):
+        self.number = None
+        self.tick_rate = TICK_RATE
+        self.frame_step = 1
+        self.snapshot_interval = 1
+        self.world_width = SCREEN_WIDTH
+        self.world_height = SCREEN_HEIGHT
+        self.grid = None
+        self.player = None
+        # Танк уже поставлен снимком с сервера
+        self.placed = False
+        self.states = {}
+        self.latest = 0
+        # Части ещё не собранных снимков: тик -> список частей, None - нет
+        self.parts = {}
+        # Препятствия в своей сетке для предсказания: слот -> Wall
+        self.obstacles = {}
+        self.sequence = 0
+        # Неподтверждённый ввод: (номер, ввод, предсказанные x и y после него)
+        self.history = []
+        # Тик сервера минус свои часы в тиках
+        self.clock = None
+        self.errors = []
+        self.bytes_received = 0
+        self.snapshots = 0
+        self.full_snapshots = 0
+        self.undecodable = 0
+
+    def hello(self):
+        return packet(PACKET_HELLO)
+
+    def bye(self):
+        return packet(PACKET_BYE)
+
+    def receive(self, data, now):
+        try:
+            magic, version, kind = NET_HEADER.unpack_from(data)
+            if magic != NET_MAGIC or version != NET_VERSION:
+                return
+            self.bytes_received += len(data)
+            if kind == PACKET_WELCOME and self.number is None:
+                self.welcome(*WELCOME.unpack_from(data, NET_HEADER.size))
+            elif kind == PACKET_SNAPSHOT and self.number is not None:
+                self.snapshot_part(data, now)
+        except struct.error:
+            return
+
+    def welcome(self, number, tick_rate, snapshot_interval, world_width, world_height):
+        self.number = number
+        self.tick_rate = tick_rate
+        self.frame_step = tick_frames(tick_rate)
+        self.snapshot_interval = snapshot_interval
+        self.world_width = world_width
+        self.world_height = world_height
+        self.grid = ObstacleGrid(world_width, world_height)
+        self.player = PlayerTank()
+        self.player.frame_step = self.frame_step
+
+    def snapshot_part(self, data, now):
+        tick, base, applied, index, count = SNAPSHOT_HEADER.unpack_from(data, NET_HEADER.size)
+        if tick <= self.latest or index >= count:
+            # Часть опоздавшего или уже собранного снимка, или испорченная
+            return
+        parts = self.parts.get(tick)
+        if parts is None:
+            oldest = tick - SNAPSHOT_HISTORY * self.snapshot_interval
+            for old in [old for old in self.parts if old <= oldest]:
+                del self.parts[old]
+            parts = self.parts[tick] = [None] * count
+        elif len(parts) != count:
+            return
+        parts[index] = data[NET_HEADER.size + SNAPSHOT_HEADER.size:]
+        if None in parts:
+            return
+        # Части более старых снимков уже не пригодятся
+        for old in [old for old in self.parts if old <= tick]:
+            del self.parts[old]
+        self.snapshot(tick, base, applied, b"".join(parts), now)
+
+    def snapshot(self, tick, base, applied, body, now):
+        if base and base not in self.states:
+            self.undecodable += 1
+            return
+        state = decode_delta(self.states.get(base, {}), body, 0)
+        self.snapshots += 1
+        self.full_snapshots += base == 0
+        self.states[tick] = state
+        oldest = tick - SNAPSHOT_HISTORY * self.snapshot_interval
+        for old in [old for old in self.states if old <= oldest]:
+            del self.states[old]
+        self.latest = tick
+
+        # Часы сервера: снимок, пришедший раньше ожидаемого, сдвигает оценку
+        # сразу, опоздавшие - понемногу
+        sample = tick - now * self.tick_rate
+        if self.clock is None or sample > self.clock:
+            self.clock = sample
+        else:
+            self.clock += (sample - self.clock) * 0.05
+        self.update_obstacles(state["obstacles"])
+        self.reconcile(state["players"].get(self.number), applied)
+
+    def update_obstacles(self, obstacles):
+        for slot in [slot for slot in self.obstacles if slot not in obstacles]:
+            self.grid.remove(self.obstacles.pop(slot))
+        for slot, (x, y, width, height, _, _) in obstacles.items():
+            if slot not in self.obstacles:
+                x /= NET_SCALE
+                y /= NET_SCALE
+                width /= NET_SCALE
+                height /= NET_SCALE
+                wall = Wall(x - width / 2, y - height / 2, x + width / 2, y + height / 2)
+                self.grid.add(wall)
+                self.obstacles[slot] = wall
+
+    def reconcile(self, mine, applied):
+        if mine is None:
+            return
+        x, y, direction, health, max_health, flags = mine
+        player = self.player
+        # Ошибка считается, только пока танк жив и уже стоит там, куда его
+        # поставил прошлый снимок: возрождение и первый перенос из
+        # PlayerTank() на место появления - не промах предсказания
+        was_alive = player.is_alive and self.placed
+        self.placed = True
+        player.center_x = x / NET_SCALE
+        player.center_y = y / NET_SCALE
+        player.direction = DIRECTIONS[direction]
+        player.health = health
+        player.max_health = max_health
+        player.is_alive = bool(flags & 1)
+        player.speed_multiplier = 1.5 if flags & 2 else 1.0
+        history = []
+        for sequence, control, predicted_x, predicted_y in self.history:
+            if sequence == applied and was_alive and player.is_alive:
+                self.errors.append(abs(predicted_x - player.center_x) +
+                                   abs(predicted_y - player.center_y))
+            if sequence > applied:
+                history.append((sequence, control, predicted_x, predicted_y))
+        self.history = []
+        for sequence, control, _, _ in history:
+            self.predict(sequence, control)
+
+    def predict(self, sequence, control):
+        player = self.player
+        if player.is_alive and drive_player(player, control, self.grid, self.frame_step):
+            player.center_x = max(30, min(self.world_width - 30, player.center_x))
+            player.center_y = max(30, min(self.world_height - 30, player.center_y))
+        self.history.append((sequence, control, player.center_x, player.center_y))
+
+    def control(self, inputs):
+        # Ввод этого тика: сразу двигает свой танк и возвращает пакет
+        # для сервера. Прицел округляется так же, как его увидит сервер
+        aim_x = max(-32768, min(32767, round(inputs.aim_x)))
+        aim_y = max(-32768, min(32767, round(inputs.aim_y)))
+        control = decode_input(input_keys(inputs), aim_x, aim_y)
+        self.sequence += 1
+        self.predict(self.sequence, control)
+        # Сервер молчит (танк погиб, связь пропала) - старое не копится
+        del self.history[:-SNAPSHOT_HISTORY]
+        recent = self.history[:-INPUT_REDUNDANCY - 1:-1]
+        return packet(PACKET_INPUT, INPUT_HEADER.pack(self.latest, self.sequence, len(recent)),
+                      *(INPUT_ENTRY.pack(input_keys(entry), entry.aim_x, entry.aim_y)
+                        for _, entry, _, _ in recent))
+
+    def server_tick(self, now):
+        return now * self.tick_rate + self.clock
+
+    def view(self, now):
+        # Что рисовать в момент now: {категория: {ключ: (x, y, поля...)}}
+        # с координатами в пикселях. Свой танк сюда не входит - это player
+        if not self.states:
+            return None
+        render = self.server_tick(now) - INTERPOLATION * self.snapshot_interval
+        ticks = sorted(self.states)
+        before = [tick for tick in ticks if tick <= render]
+        after = [tick for tick in ticks if tick > render]
+        a = before[-1] if before else ticks[0]
+        b = after[0] if after and before else a
+        alpha = (render - a) / (b - a) if b != a else 0.0
+        old = self.states[a]
+        new = self.states[b]
+        view = {}
+        for category in ("players", "enemies", "powerups"):
+            entities = {}
+            following = new[category]
+            for key, values in old[category].items():
+                if category == "players" and key == self.number:
+                    continue
+                x = values[0] / NET_SCALE
+                y = values[1] / NET_SCALE
+                later = following.get(key)
+                if later is not None:
+                    x += (later[0] / NET_SCALE - x) * alpha
+                    y += (later[1] / NET_SCALE - y) * alpha
+                entities[key] = (x, y) + values[2:]
+            view[category] = entities
+        view["bullets"] = {
+            key: ((x + change_x * (render - tick)) / NET_SCALE,
+                  (y + change_y * (render - tick)) / NET_SCALE, radius, style)
+            for key, (x, y, change_x, change_y, radius, style, tick) in old["bullets"].items()
+        }
+        latest = self.states[self.latest]
+        view["obstacles"] = latest["obstacles"]
+        view["match"] = latest["match"][0]
+        return view
+
+
+class Bot(asyncio.DatagramProtocol):
+    # Клиент-бот для нагрузки: держит огонь, выравнивается по ближайшему
+    # врагу из интерполированной картинки, без врагов ездит наугад.
+    # loss - доля входящих пакетов, которые бот выбрасывает, как сеть с потерями
+    def __init__(self, seed, loss=0.0):
+        self.client = NetClient()
+        self.rng = random.Random(seed)
+        self.loss = loss
+        self.transport = None
+        self.dropped = 0
+        self.heading = 0
+        self.ticks = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.sendto(self.client.hello())
+
+    def datagram_received(self, data, address):
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        self.client.receive(data, time.monotonic())
+
+    def act(self):
+        client = self.client
+        if client.number is None:
+            self.transport.sendto(client.hello())
+            return
+        self.ticks += 1
+        view = client.view(time.monotonic())
+        self.transport.sendto(client.control(self.policy(view)))
+
+    def policy(self, view):
+        player = self.client.player
+        px = player.center_x
+        py = player.center_y
+        inputs = PlayerInput(aim_x=px, aim_y=py + 1, fire=True)
+        enemies = list(view["enemies"].values()) if view else []
+        if enemies:
+            x, y = min(((enemy[0], enemy[1]) for enemy in enemies),
+                       key=lambda point: (point[0] - px) ** 2 + (point[1] - py) ** 2)
+            dx = x - px
+            dy = y - py
+            if abs(dx) < abs(dy):
+                inputs.aim_x, inputs.aim_y = px, y
+                inputs.left = dx < -4
+                inputs.right = dx > 4
+            else:
+                inputs.aim_x, inputs.aim_y = x, py
+                inputs.down = dy < -4
+                inputs.up = dy > 4
+            return inputs
+        if self.ticks % 60 == 0:
+            self.heading = self.rng.randrange(4)
+        inputs.up = self.heading == 0
+        inputs.right = self.heading == 1
+        inputs.down = self.heading == 2
+        inputs.left = self.heading == 3
+        return inputs
+
+
+async def run_bots(host, port, count, seconds, loss=0.0, seed=0):
+    loop = asyncio.get_running_loop()
+    bots = []
+    for i in range(count):
+        _, bot = await loop.create_datagram_endpoint(
+            lambda i=i: Bot(seed * 1000 + i, loss), remote_addr=(host, port))
+        bots.append(bot)
+    deadline = loop.time() + NET_TIMEOUT
+    while any(bot.client.number is None for bot in bots):
+        if loop.time() > deadline:
+            raise ConnectionError(f"сервер {host}:{port} не ответил")
+        for bot in bots:
+            bot.act()
+        await asyncio.sleep(0.1)
+
+    tick_time = 1 / bots[0].client.tick_rate
+    start = next_tick = loop.time()
+    while loop.time() - start < seconds:
+        for bot in bots:
+            bot.act()
+        next_tick += tick_time
+        await asyncio.sleep(max(0.0, next_tick - loop.time()))
+    for bot in bots:
+        bot.transport.sendto(bot.client.bye())
+        bot.transport.close()
+
+    clients = [bot.client for bot in bots]
+    errors = [error for client in clients for error in client.errors]
+    return {
+        "bots": count,
+        "received_kbps": sum(client.bytes_received for client in clients) * 8 / 1000 /
+        seconds / count,
+        "snapshots": sum(client.snapshots for client in clients) / count,
+        "full_snapshots": sum(client.full_snapshots for client in clients) / count,
+        "undecodable": sum(client.undecodable for client in clients),
+        "dropped": sum(bot.dropped for bot in bots),
+        "prediction_error": np.mean(errors) if errors else 0.0,
+        "prediction_p99": percentile(errors, 99),
+        "mispredicted": np.mean(np.array(errors) > 1.0) if errors else 0.0,
+    }
+
+
+def serve_worker(pipe, host, port, seconds, options):
+    pipe.send(asyncio.run(GameServer(**options).run(host, port, seconds)))
+    pipe.close()
+
+
+def bench(host, port, bots, seconds, loss, seed, options):
+    # Сервер в отдельном процессе, все боты - в этом: время тика сервера
+    # не смешивается с работой клиентов
+    context = get_context()
+    pipe, child = context.Pipe()
+    server = context.Process(target=serve_worker, daemon=True,
+                             args=(child, host, port, seconds + 2, options))
+    server.start()
+    child.close()
+    time.sleep(1.0)
+    client_stats = asyncio.run(run_bots(host, port, bots, seconds, loss, seed))
+    server_stats = pipe.recv()
+    server.join()
+    return server_stats, client_stats
+
+
+def print_report(server_stats, client_stats):
+    if server_stats is not None:
+        print(f"сервер: {server_stats['ticks']} тиков, тик {server_stats['tick_ms']:.2f} мс "
+              f"(p99 {server_stats['tick_p99_ms']:.2f}, макс. {server_stats['tick_max_ms']:.2f}), "
+              f"симуляция {server_stats['step_ms']:.2f} мс, "
+              f"снимок {server_stats['snapshot_ms']:.2f} мс")
+        print(f"  отправлено {server_stats['sent_kbps']:.0f} кбит/с "
+              f"({server_stats['packets']} пакетов по {server_stats['packet_bytes']:.0f} байт, "
+              f"полных снимков {server_stats['full_snapshots']}, "
+              f"не отправлено {server_stats['send_errors']}, "
+              f"слишком больших снимков {server_stats['oversized_snapshots']}), "
+              f"принято {server_stats['received_kbps']:.0f} кбит/с; "
+              f"лучший из {server_stats['matches']} матчей: волна {server_stats['wave']}, "
+              f"очки {server_stats['score']}")
+    if client_stats is not None:
+        print(f"клиент: {client_stats['received_kbps']:.1f} кбит/с, "
+              f"снимков {client_stats['snapshots']:.0f} "
+              f"(полных {client_stats['full_snapshots']:.1f}), "
+              f"выброшено {client_stats['dropped']}, "
+              f"не разобрано {client_stats['undecodable']}")
+        print(f"  ошибка предсказания: средняя {client_stats['prediction_error']:.2f} пикс., "
+              f"p99 {client_stats['prediction_p99']:.2f} пикс., "
+              f"с ошибкой больше пикселя {client_stats['mispredicted']:.1%} тиков")
+
+
+class NetGame(arcade.Window):
+    # Окно сетевого клиента: ввод уходит на сервер каждый тик, мир
+    # рисуется по NetClient.view(), свой танк - предсказанный
+    def __init__(self, host, port):
+        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE)
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.client = NetClient()
+        self.accumulator = 0.0
+        self.hello_time = 0.0
+        self.left = False
+        self.right = False
+        self.up = False
+        self.down = False
+        self.fire = False
+        self.mouse_x = 0
+        self.mouse_y = 0
+        self.view_x = 0
+        self.view_y = 0
+        self.camera = arcade.Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.gui_camera = arcade.Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.walls = RectRenderer()
+        self.wall_slots = None
+        # Спрайты по (категория, ключ) - создаются, когда объект появляется
+        self.sprites = {}
+        self.tank_list = arcade.SpriteList()
+        self.powerup_list = arcade.SpriteList()
+        self.player_list = arcade.SpriteList()
+        self.bullets = BulletSystem()
+        self.health_bars = HealthBarRenderer()
+        self.hud = TextLayer()
+        self.hud.add("health", "Здоровье: {}/{}", 10, SCREEN_HEIGHT - 30,
+                     arcade.color.WHITE, 20)
+        self.hud.add("score", "Очки: {}", 10, SCREEN_HEIGHT - 60, arcade.color.WHITE, 20)
+        self.hud.add("wave", "Волна: {}", SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30,
+                     arcade.color.WHITE, 20, anchor_x="right")
+        self.hud.add("players", "Игроков: {}", SCREEN_WIDTH - 10, SCREEN_HEIGHT - 60,
+                     arcade.color.WHITE, 16, anchor_x="right")
+        self.hud.add("status", "{}", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2,
+                     arcade.color.WHITE, 30, anchor_x="center")
+        arcade.set_background_color((30, 30, 30))
+
+    def on_update(self, delta_time):
+        now = time.monotonic()
+        while True:
+            try:
+                data, _ = self.socket.recvfrom(65536)
+            except (BlockingIOError, ConnectionError):
+                break
+            self.client.receive(data, now)
+        client = self.client
+        if client.number is None:
+            if now - self.hello_time > 0.5:
+                self.socket.sendto(client.hello(), self.address)
+                self.hello_time = now
+            return
+        if client.player not in self.player_list:
+            self.player_list.append(client.player)
+        self.accumulator += min(delta_time, MAX_FRAME_TIME)
+        tick_time = 1 / client.tick_rate
+        while self.accumulator >= tick_time:
+            self.accumulator -= tick_time
+            # Мышь в координатах экрана, прицел - в координатах мира
+            self.socket.sendto(client.control(PlayerInput(
+                self.left, self.right, self.up, self.down,
+                self.mouse_x + self.view_x, self.mouse_y + self.view_y, self.fire
+            )), self.address)
+
+    def sync_sprites(self, view):
+        seen = set()
+        for category, kinds in (("players", None), ("enemies", ENEMY_TYPES)):
+            for key, (x, y, direction, kind_or_health, *rest) in view[category].items():
+                if category == "players":
+                    kind = "player"
+                    health, max_health = kind_or_health, rest[0]
+                    if not rest[1] & 1:
+                        continue
+                else:
+                    kind = kinds[kind_or_health]
+                    health = rest[0]
+                    max_health = None
+                sprite = self.sprites.get((category, key))
+                if sprite is None:
+                    sprite = self.sprites[(category, key)] = Tank(kind)
+                    self.tank_list.append(sprite)
+                sprite.center_x = x
+                sprite.center_y = y
+                sprite.direction = DIRECTIONS[direction]
+                sprite.update_direction_texture()
+                sprite.health = health
+                sprite.max_health = max(max_health or sprite.max_health, health, 1)
+                seen.add((category, key))
+        for key, (x, y, kind) in view["powerups"].items():
+            sprite = self.sprites.get(("powerups", key))
+            if sprite is None:
+                sprite = self.sprites[("powerups", key)] = arcade.Sprite(
+                    texture=get_powerup_texture(POWERUP_TYPES[kind]))
+                self.powerup_list.append(sprite)
+            sprite.center_x = x
+            sprite.center_y = y
+            seen.add(("powerups", key))
+        for key in [key for key in self.sprites if key not in seen]:
+            self.sprites.pop(key).remove_from_sprite_lists()
+
+        if set(view["obstacles"]) != self.wall_slots:
+            self.wall_slots = set(view["obstacles"])
+            obstacles = np.array(list(view["obstacles"].values()),
+                                 dtype=np.float64).reshape(-1, 6)
+            x, y, width, height = (obstacles[:, :4] / NET_SCALE).T
+            data = np.empty(len(obstacles), dtype=RECT_VERTEX_DTYPE)
+            data["rect"] = np.column_stack((x - width / 2, y - height / 2,
+                                            x + width / 2, y + height / 2))
+            data["color"] = np.where(obstacles[:, 5:6] > 0,
+                                     arcade.get_four_byte_color((178, 34, 34)),
+                                     arcade.get_four_byte_color((169, 169, 169)))
+            self.walls.upload(data)
+
+        self.bullets.clear()
+        if view["bullets"]:
+            x, y, radius, style = np.array(list(view["bullets"].values()),
+                                           dtype=np.float64).T
+            style = style.astype(np.int64)
+            color = np.column_stack((style >> 16 & 255, style >> 8 & 255, style & 255))
+            self.bullets.spawn_many(x, y, 0, 0, radius, 0, style >> 24, color)
+
+    def on_draw(self):
+        self.clear()
+        client = self.client
+        view = client.view(time.monotonic()) if client.number is not None else None
+        if view is None:
+            self.gui_camera.use()
+            self.hud.set("status", "Подключение...")
+            self.hud.draw()
+            return
+        self.sync_sprites(view)
+        player = client.player
+        self.view_x = max(0, min(client.world_width - SCREEN_WIDTH,
+                                 int(player.center_x) - SCREEN_WIDTH // 2))
+        self.view_y = max(0, min(client.world_height - SCREEN_HEIGHT,
+                                 int(player.center_y) - SCREEN_HEIGHT // 2))
+        self.camera.move_to((self.view_x, self.view_y), 1.0)
+        self.camera.use()
+        screen = (self.view_x, self.view_y, self.view_x + SCREEN_WIDTH,
+                  self.view_y + SCREEN_HEIGHT)
+        self.walls.render()
+        self.powerup_list.draw()
+        self.tank_list.draw()
+        player.update_direction_texture()
+        if player.is_alive:
+            self.player_list.draw()
+        self.bullets.draw(screen)
+        tanks = list(self.tank_list)
+        if player.is_alive:
+            tanks.append(player)
+        self.health_bars.draw(tanks, screen)
+
+        self.gui_camera.use()
+        score, wave = view["match"]
+        self.hud.set("health", player.health, player.max_health)
+        self.hud.set("score", score)
+        self.hud.set("wave", wave)
+        self.hud.set("players", len(view["players"]) + 1)
+        self.hud.set("status", "" if player.is_alive else "Танк подбит, ждём возрождения")
+        self.hud.draw()
+
+    def on_key_press(self, key, modifiers):
+        if key in (arcade.key.W, arcade.key.UP):
+            self.up = True
+        elif key in (arcade.key.S, arcade.key.DOWN):
+            self.down = True
+        elif key in (arcade.key.A, arcade.key.LEFT):
+            self.left = True
+        elif key in (arcade.key.D, arcade.key.RIGHT):
+            self.right = True
+        elif key == arcade.key.SPACE:
+            self.fire = True
+        elif key == arcade.key.ESCAPE:
+            self.close()
+
+    def on_key_release(self, key, modifiers):
+        if key in (arcade.key.W, arcade.key.UP):
+            self.up = False
+        elif key in (arcade.key.S, arcade.key.DOWN):
+            self.down = False
+        elif key in (arcade.key.A, arcade.key.LEFT):
+            self.left = False
+        elif key in (arcade.key.D, arcade.key.RIGHT):
+            self.right = False
+        elif key == arcade.key.SPACE:
+            self.fire = False
+
+    def on_mouse_motion(self, x, y, dx, dy):
+        self.mouse_x = x
+        self.mouse_y = y
+
+    def on_mouse_press(self, x, y, button, modifiers):
+        if button == arcade.MOUSE_BUTTON_LEFT:
+            self.fire = True
+
+    def on_mouse_release(self, x, y, button, modifiers):
+        if button == arcade.MOUSE_BUTTON_LEFT:
+            self.fire = False
+
+    def on_close(self):
+        if self.client.number is not None:
+            self.socket.sendto(self.client.bye(), self.address)
+        self.socket.close()
+        super().on_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сетевая игра Танчиков")
+    parser.add_argument("mode", choices=["serve", "connect", "bots", "bench"],
+                        help="serve - сервер, connect - окно клиента, bots - боты "
+                             "к серверу, bench - сервер и боты на этой машине")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=NET_PORT)
+    parser.add_argument("--bots", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="доля снимков, которые боты выбрасывают")
+    parser.add_argument("--difficulty", choices=[d.value for d in Difficulty],
+                        default=Difficulty.NORMAL.value)
+    parser.add_argument("--world", type=int, nargs=2, default=[1600, 1200],
+                        metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--level", help="файл уровня (.tnkl)")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE)
+    parser.add_argument("--snapshot-interval", type=int, default=2,
+                        help="тиков между снимками")
+    parser.add_argument("--batch-ai", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.world[0] < SCREEN_WIDTH or args.world[1] < SCREEN_HEIGHT:
+        parser.error(f"мир не может быть меньше экрана {SCREEN_WIDTH}x{SCREEN_HEIGHT}")
+    if max(args.world) * NET_SCALE > 65535:
+        parser.error(f"мир больше {65535 // NET_SCALE} пикселей не помещается в координаты снимка")
+    if args.tick_rate < MIN_TICK_RATE:
+        parser.error(f"частота тиков не может быть меньше {MIN_TICK_RATE}")
+
+    options = {"difficulty": Difficulty(args.difficulty), "seed": args.seed,
+               "world": tuple(args.world), "level": args.level,
+               "tick_rate": args.tick_rate, "snapshot_interval": args.snapshot_interval,
+               "batch_ai": args.batch_ai}
+    if args.mode in ("serve", "bench"):
+        # Полный снимок должен уйти в SNAPSHOT_MAX_PARTS датаграмм, и это
+        # с запасом на танки и пули сверх начального мира
+        server = GameServer(**options)
+        size = server.snapshot_size()
+        if size > SNAPSHOT_MAX_PARTS * SNAPSHOT_PART // 2:
+            parser.error(f"полный снимок мира - {size} байт, больше "
+                         f"{SNAPSHOT_MAX_PARTS * SNAPSHOT_PART // 2}: уменьшите мир")
+    if args.mode == "serve":
+        host = "0.0.0.0" if args.host == "127.0.0.1" else args.host
+        print_report(asyncio.run(server.run(host, args.port)), None)
+    elif args.mode == "connect":
+        NetGame(args.host, args.port)
+        arcade.run()
+    elif args.mode == "bots":
+        print_report(None, asyncio.run(run_bots(args.host, args.port, args.bots,
+                                                args.seconds, args.loss, args.seed)))
+    else:
+        print_report(*bench(args.host, args.port, args.bots, args.seconds, args.loss,
+                            args.seed, options))
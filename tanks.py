@@ -3,15 +3,117 @@ import random
 import math
 import json
 import os
+import time
+import argparse
+import mmap
+import struct
+from collections import deque
 from enum import Enum
 
+import numpy as np
+import pyglet
+
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 SCREEN_TITLE = "Танчики"
+# Скорости и длительности в коде заданы в кадрах по 1/FRAME_RATE секунды.
+# Симуляция может идти с другой частотой тиков: за тик проходит
+# FRAME_RATE / tick_rate кадров
+FRAME_RATE = 60
+TICK_RATE = 60
+# Реже сдвиг быстрого танка за тик больше поля чанка CHUNK_APRON
+MIN_TICK_RATE = 30
+# Больше стольких секунд за кадр окно не догоняет (перетаскивание окна,
+# остановка в отладчике) - иначе тики копятся быстрее, чем считаются
+MAX_FRAME_TIME = 0.25
+# Если танк за тик сдвинулся дальше, это не движение, а перестановка
+# (новая волна, спрайт из пула) - такой танк рисуется без интерполяции
+MAX_LERP_DISTANCE = 64
 TANK_SPEED = 4
 BULLET_SPEED = 8
 ENEMY_SPEED = 1.5
 ENEMY_SHOOT_INTERVAL = 90
+ENEMY_TYPES = ["normal", "fast", "heavy"]
+# Вероятности типов врагов при появлении
+ENEMY_WEIGHTS = [0.6, 0.25, 0.15]
+ENEMIES_PER_WAVE = 3
+# Как ездят враги каждого типа: "chase" - по общему полю направлений
+# к игроку, "wander" - прежние случайные повороты раз в 30-90 тиков
+ENEMY_MOVEMENT = {"normal": "chase", "fast": "wander", "heavy": "chase"}
+# Поле направлений: клетка в пикселях и сколько пикселей вокруг игрока
+# оно покрывает по каждой оси. Дальше враги бродят как "wander"
+FLOW_CELL = 20
+FLOW_RANGE_X = SCREEN_WIDTH
+FLOW_RANGE_Y = SCREEN_HEIGHT
+# Поле пересчитывается, когда игрок отошёл от его цели дальше стольких клеток
+FLOW_STALE = 1
+# Код "стоять на месте": ближе FLOW_STOP клеток к игроку враг не подъезжает
+FLOW_HOLD = 4
+FLOW_STOP = 3
+# Перед поворотом враг выравнивается по центру клетки с такой точностью
+FLOW_ALIGN = 2
+# Линия видимости: препятствия растрируются в клетки SIGHT_CELL пикселей,
+# луч от врага к игроку проходит по ним алгоритмом DDA
+SIGHT_CELL = 10
+# Через сколько тиков враг без линии видимости снова пробует выстрелить
+SIGHT_RETRY = 6
+# "Бесконечность" для расстояний в сетке препятствий (int16)
+GRID_FAR = 30000
+# Сетка препятствий хранится чанками CHUNK_SIZE пикселей с полем
+# CHUNK_APRON вокруг; поле больше сдвига танка за тик и радиуса пули
+CHUNK_SIZE = 128
+CHUNK_APRON = 16
+# Столько чанков на размер танка держится в памяти
+CHUNK_CACHE = 256
+# Препятствия рисуются списками по чанкам такого размера: в кадр
+# попадает не больше четырёх
+DRAW_CHUNK_SIZE = 1024
+# Владельцы пуль в BulletSystem
+OWNER_PLAYER = 0
+OWNER_ENEMY = 1
+# До стольких пар пуля-цель BulletSystem.hits проверяет все пары подряд
+HITS_DENSE_PAIRS = 4096
+# До стольких пар BulletSystem.sweeps считает вход пули в цель скалярами
+SWEEP_SCALAR_PAIRS = 16
+# До стольких пуль BulletSystem обходит их поштучно на числах Python:
+# отсечение за краем мира и sweeps() с мелкими целями или с сеткой
+# препятствий, где цели находятся по словарю ячеек
+SCALAR_BULLETS = 8
+# Размер ячейки SpatialHash и шаг номеров ячеек между строками сетки
+SPATIAL_CELL = 64
+SPATIAL_ROW = 1 << 32
+# Номер ячейки убранного элемента SpatialHash: дальше любой настоящей
+SPATIAL_NONE = np.iinfo(np.int64).max
+# Направления танка: номер направления * 90 - угол спрайта
+DIRECTIONS = ["UP", "RIGHT", "DOWN", "LEFT"]
+DIRECTION_VECTORS = np.array([(0, 1), (1, 0), (0, -1), (-1, 0)], dtype=np.float64)
+# Клетки уровня в файле .tnkl и их символы в текстовом исходнике
+TILE_EMPTY = 0
+TILE_WALL = 1
+TILE_BRICK = 2
+TILE_SPAWN = 3
+TILE_CHARS = {".": TILE_EMPTY, " ": TILE_EMPTY, "#": TILE_WALL, "B": TILE_BRICK,
+              "P": TILE_SPAWN}
+TILE_SIZE = 40
+# Версия генератора случайной арены: записывается в повтор, чтобы старые
+# повторы строили ту арену, на которой были сыграны
+ARENA_VERSION = 2
+# Разрушаемые блоки ставятся в клетки решётки с шагом ARENA_PITCH
+# и сдвигаются внутри клетки не больше чем на ARENA_JITTER: блоки 60x60
+# не пересекаются, а между свободными клетками всегда проходит танк
+ARENA_PITCH = 80
+ARENA_JITTER = 10
+# Полоса вдоль краёв мира без блоков: стены и линии появления врагов
+ARENA_MARGIN = 140
+# Свободное место вокруг игрока и линий появления врагов
+PLAYER_CLEARANCE = 120
+# Шаг колец, по которым расставляются сетевые игроки вокруг точки старта
+PLAYER_SPACING = 60
+SPAWN_CLEARANCE = 40
+# Столько раз враг ищет на своей стороне место, не занятое препятствием
+SPAWN_ATTEMPTS = 8
+# Соседи клетки по кругу (строка, столбец): стороны на чётных местах
+ARENA_RING = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
 
 
 class GameState(Enum):
@@ -34,99 +136,1625 @@ class PowerUpType(Enum):
     RAPID_FIRE = "rapid_fire"
 
 
-class Explosion(arcade.Sprite):
-    def __init__(self, center_x, center_y, enemy_type=None):
-        super().__init__()
-        self.textures = []
+# Текстуры взрывов общие для всего процесса: каждый взрыв хранит только
+# ссылки на них, поэтому новые текстуры во время игры не создаются
+explosion_textures = {}
+
+
+def get_explosion_textures(kind=None):
+    if kind not in ("fast", "heavy", "hit"):
+        kind = None
+    textures = explosion_textures.get(kind)
+    if textures is not None:
+        return textures
+
+    if kind == "hit":
+        # Вспышка при попадании в игрока
+        textures = [arcade.make_circle_texture(20, arcade.color.RED)]
+    else:
         # Разные цвета взрывов для разных типов врагов
-        if enemy_type == "fast":
+        if kind == "fast":
             colors = [(0, 255, 0), (144, 238, 144), (255, 255, 255)]
-        elif enemy_type == "heavy":
+        elif kind == "heavy":
             colors = [(128, 0, 128), (216, 191, 216), (255, 255, 255)]
         else:
             colors = [(255, 165, 0), (255, 215, 0), (255, 255, 255)]
 
+        textures = []
         for i in range(5):
             radius = 15 + i * 5
             color = colors[min(i // 2, len(colors) - 1)]
-            texture = arcade.make_circle_texture(radius * 2, color)
-            self.textures.append(texture)
+            textures.append(arcade.make_circle_texture(radius * 2, color))
+
+    explosion_textures[kind] = textures
+    return textures
+
+
+def load_explosion_textures():
+    for kind in (None, "fast", "heavy", "hit"):
+        get_explosion_textures(kind)
+
+
+# Файл спрайта, масштаб и запасной квадрат (размер, цвет) для каждого танка
+TANK_SPRITES = {
+    "player": ("player_tank.png", 0.5, 40, (0, 255, 255)),
+    "normal": ("enemy_normal.png", 0.5, 40, (255, 140, 0)),
+    "fast": ("enemy_fast.png", 0.45, 35, (50, 205, 50)),
+    "heavy": ("enemy_heavy.png", 0.6, 50, (138, 43, 226)),
+}
+# Текстуры танков тоже загружаются один раз: новый танк берёт из реестра
+# готовый словарь текстур по направлениям и масштаб, без обращений к диску
+tank_textures = {}
+
+
+def get_tank_textures(kind):
+    entry = tank_textures.get(kind)
+    if entry is not None:
+        return entry
+
+    filename, scale, size, color = TANK_SPRITES[kind]
+    sprite_path = os.path.join("images", filename)
+    if os.path.exists(sprite_path):
+        texture = arcade.load_texture(sprite_path)
+    else:
+        texture = arcade.make_soft_square_texture(size, color, 255, 255)
+        scale = 1.0
+
+    entry = ({direction: texture for direction in DIRECTIONS}, scale)
+    tank_textures[kind] = entry
+    return entry
+
+
+def load_tank_textures():
+    for kind in TANK_SPRITES:
+        get_tank_textures(kind)
+
+
+class ObjectPool:
+    # Пул однотипных спрайтов: отработавший объект не выбрасывается,
+    # а при следующем acquire() возвращается в начальное состояние
+    # через reset() с теми же аргументами, что и у конструктора
+    def __init__(self, factory):
+        self.factory = factory
+        self.free = []
+        self.in_use = 0
+        self.acquired = 0
+        self.reused = 0
+        self.high_water = 0
+
+    def acquire(self, *args):
+        self.acquired += 1
+        if self.free:
+            item = self.free.pop()
+            item.reset(*args)
+            self.reused += 1
+        else:
+            item = self.factory(*args)
+            item.pool = self
+        self.in_use += 1
+        if self.in_use > self.high_water:
+            self.high_water = self.in_use
+        return item
+
+    def release(self, item):
+        item.remove_from_sprite_lists()
+        self.free.append(item)
+        self.in_use -= 1
+
+    def stats(self):
+        return {
+            "acquired": self.acquired,
+            "hit_rate": self.reused / self.acquired if self.acquired else 0.0,
+            "in_use": self.in_use,
+            "high_water": self.high_water,
+        }
+
+
+def release_sprite(sprite):
+    # Спрайт из пула возвращается в пул, остальные просто удаляются
+    if sprite.pool is not None:
+        sprite.pool.release(sprite)
+    else:
+        sprite.remove_from_sprite_lists()
+
+
+class Explosion(arcade.Sprite):
+    def __init__(self, center_x, center_y, enemy_type=None):
+        super().__init__()
+        self.pool = None
+        self.reset(center_x, center_y, enemy_type)
+
+    def reset(self, center_x, center_y, enemy_type=None):
+        self.textures = get_explosion_textures(enemy_type)
         self.texture = self.textures[0]
         self.current_texture = 0
         self.lifetime = 15
+        self.frame_step = 1
         self.center_x = center_x
         self.center_y = center_y
 
     def update(self, delta_time=1 / 60):
-        self.lifetime -= 1
+        self.lifetime -= self.frame_step
         if self.lifetime > 0:
-            frame = (self.lifetime // 3) % len(self.textures)
+            frame = int(self.lifetime // 3) % len(self.textures)
             self.texture = self.textures[frame]
         else:
-            self.remove_from_sprite_lists()
+            release_sprite(self)
 
 
-class Particle(arcade.SpriteCircle):
-    def __init__(self, radius, color):
-        super().__init__(radius, color)
-        self.lifetime = 20
-        self.velocity_x = random.uniform(-1, 1)
-        self.velocity_y = random.uniform(-1, 1)
+CIRCLE_VERTEX_SHADER = """
+#version 330
 
-    def update(self, delta_time=1 / 60):
-        self.lifetime -= 1
-        if self.lifetime <= 0:
-            self.remove_from_sprite_lists()
-        self.center_x += self.velocity_x
-        self.center_y += self.velocity_y
+in vec2 in_pos;
+in float in_radius;
+in vec4 in_color;
 
+out float v_radius;
+out vec4 v_color;
 
-class ParticleSystem:
+void main() {
+    gl_Position = vec4(in_pos, 0.0, 1.0);
+    v_radius = in_radius;
+    v_color = in_color;
+}
+"""
+
+CIRCLE_GEOMETRY_SHADER = """
+#version 330
+
+layout (points) in;
+layout (triangle_strip, max_vertices = 4) out;
+
+uniform Projection {
+    uniform mat4 matrix;
+} proj;
+
+in float v_radius[];
+in vec4 v_color[];
+
+out vec2 g_offset;
+out vec4 g_color;
+
+void main() {
+    vec2 center = gl_in[0].gl_Position.xy;
+    for (int i = 0; i < 4; i++) {
+        vec2 corner = vec2(i % 2 == 0 ? -1.0 : 1.0, i < 2 ? -1.0 : 1.0);
+        g_offset = corner;
+        g_color = v_color[0];
+        gl_Position = proj.matrix * vec4(center + corner * v_radius[0], 0.0, 1.0);
+        EmitVertex();
+    }
+    EndPrimitive();
+}
+"""
+
+CIRCLE_FRAGMENT_SHADER = """
+#version 330
+
+in vec2 g_offset;
+in vec4 g_color;
+
+out vec4 f_color;
+
+void main() {
+    if (dot(g_offset, g_offset) > 1.0) {
+        discard;
+    }
+    f_color = g_color;
+}
+"""
+
+CIRCLE_VERTEX_DTYPE = np.dtype([
+    ("pos", np.float32, 2),
+    ("radius", np.float32),
+    ("color", np.uint8, 4),
+])
+
+
+class CircleRenderer:
+    # Рисует набор кругов из массивов одним вызовом отрисовки
     def __init__(self):
-        self.particles = arcade.SpriteList()
+        self.program = None
+        self.geometry = None
+        self.buffer = None
+
+    def draw(self, x, y, radius, color, mask):
+        data = np.empty(int(np.count_nonzero(mask)), dtype=CIRCLE_VERTEX_DTYPE)
+        if len(data) == 0:
+            return
+        data["pos"][:, 0] = x[mask]
+        data["pos"][:, 1] = y[mask]
+        data["radius"] = radius[mask]
+        data["color"] = color[mask]
+
+        ctx = arcade.get_window().ctx
+        if self.program is None:
+            self.program = ctx.program(
+                vertex_shader=CIRCLE_VERTEX_SHADER,
+                geometry_shader=CIRCLE_GEOMETRY_SHADER,
+                fragment_shader=CIRCLE_FRAGMENT_SHADER,
+            )
+        if self.buffer is None or self.buffer.size < data.nbytes:
+            self.buffer = ctx.buffer(reserve=max(len(data), 256) * 2 * data.itemsize)
+            self.geometry = ctx.geometry(
+                [arcade.gl.BufferDescription(
+                    self.buffer, "2f 1f 4f1",
+                    ["in_pos", "in_radius", "in_color"],
+                    normalized=["in_color"],
+                )],
+                mode=ctx.POINTS,
+            )
+        self.buffer.write(data.tobytes())
+        self.geometry.render(self.program, vertices=len(data))
+
+
+class ParticleSystem:
+    # Пул частиц фиксированного размера на массивах: свободные слоты
+    # берутся из стека, время жизни и движение считаются сразу для всех.
+    # Когда пул заполнен, новые частицы не создаются.
+    def __init__(self, capacity=512, radius=3, lifetime=20, rng=random, frame_step=1):
+        self.capacity = capacity
+        self.rng = rng
+        # Время жизни в кадрах, счётчик частицы - в тиках
+        self.lifetime = lifetime
+        self.frame_step = frame_step
+        self.ticks = max(1, round(lifetime / frame_step))
+        self.x = np.zeros(capacity, dtype=np.float64)
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.velocity_x = np.zeros(capacity, dtype=np.float64)
+        self.velocity_y = np.zeros(capacity, dtype=np.float64)
+        self.time_left = np.zeros(capacity, dtype=np.int32)
+        self.radius = np.full(capacity, radius, dtype=np.float64)
+        self.color = np.zeros((capacity, 4), dtype=np.uint8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.free = np.arange(capacity - 1, -1, -1, dtype=np.intp)
+        self.free_count = capacity
+        self.renderer = CircleRenderer()
+
+    def __len__(self):
+        return self.capacity - self.free_count
+
+    def clear(self):
+        self.alive[:] = False
+        # Иначе счётчики живых частиц дойдут до нуля и слоты освободятся дважды
+        self.time_left[:] = 0
+        self.free[:] = np.arange(self.capacity - 1, -1, -1)
+        self.free_count = self.capacity
+
+    def emit(self, x, y, color):
+        if self.free_count == 0:
+            return
+        self.free_count -= 1
+        i = self.free[self.free_count]
+        self.x[i] = x
+        self.y[i] = y
+        self.velocity_x[i] = self.rng.uniform(-1, 1) * self.frame_step
+        self.velocity_y[i] = self.rng.uniform(-1, 1) * self.frame_step
+        self.time_left[i] = self.ticks
+        self.color[i, :3] = color[:3]
+        self.color[i, 3] = 255
+        self.alive[i] = True
 
     def create_trail(self, x, y, color):
+        if self.free_count == 0:
+            return
         for _ in range(3):
-            particle = Particle(3, color)
-            particle.center_x = x + random.uniform(-5, 5)
-            particle.center_y = y + random.uniform(-5, 5)
-            self.particles.append(particle)
+            self.emit(x + self.rng.uniform(-5, 5), y + self.rng.uniform(-5, 5), color)
 
     def update(self):
-        self.particles.update()
+        if self.free_count == self.capacity:
+            return
+        # Считаем все слоты сразу, без масок: у свободных слотов счётчик
+        # уходит в минус и больше никогда не проходит через ноль
+        self.time_left -= 1
+        self.x += self.velocity_x
+        self.y += self.velocity_y
+        expired = (self.time_left == 0).nonzero()[0]
+        if len(expired):
+            self.alive[expired] = False
+            self.free[self.free_count:self.free_count + len(expired)] = expired
+            self.free_count += len(expired)
 
     def draw(self):
-        self.particles.draw()
+        self.renderer.draw(self.x, self.y, self.radius, self.color, self.alive)
+
+
+class OccupancyLayer:
+    # Карта препятствий для танков одного полуразмера: препятствия
+    # "раздуты" на полуразмер танка, и танк становится точкой.
+    # Для каждой клетки хранится ближайшая занятая клетка по каждой оси.
+    # Карта хранится чанками по CHUNK_SIZE клеток с полем CHUNK_APRON вокруг:
+    # сдвиг за тик меньше поля, поэтому запрос для точки чанка решается
+    # по нему одному. Чанки строятся при первом запросе и лежат в общих
+    # массивах по слотам; когда слоты кончаются, вытесняется чанк,
+    # который дольше всех не запрашивали.
+    def __init__(self, half, grid):
+        self.half = half
+        self.grid = grid
+        self.slot_of = np.full(grid.chunk_shape, -1, dtype=np.intp)
+        self.chunks = []
+        self.allocate(8)
+
+    def allocate(self, capacity):
+        size = CHUNK_SIZE + 2 * CHUNK_APRON + 1
+        self.blocked = np.zeros((capacity, size, size), dtype=bool)
+        self.next_x = np.empty((capacity, size, size), dtype=np.int16)
+        self.prev_x = np.empty((capacity, size, size), dtype=np.int16)
+        self.next_y = np.empty((capacity, size, size), dtype=np.int16)
+        self.prev_y = np.empty((capacity, size, size), dtype=np.int16)
+        # Мировые координаты клетки (0, 0) чанка и время последнего запроса
+        self.left = np.zeros(capacity, dtype=np.int64)
+        self.bottom = np.zeros(capacity, dtype=np.int64)
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+
+    def arrays(self):
+        return (self.blocked, self.next_x, self.prev_x, self.next_y, self.prev_y,
+                self.left, self.bottom, self.last_used)
+
+    def grow(self):
+        old = self.arrays()
+        self.allocate(len(self.blocked) * 2)
+        for new, array in zip(self.arrays(), old):
+            new[:len(array)] = array
+
+    def new_slot(self):
+        slot = len(self.chunks)
+        if slot == len(self.blocked):
+            victim = int(self.last_used.argmin())
+            # Чанки, нужные текущему запросу, не вытесняются: если заняты
+            # все слоты, массивы растут и сверх CHUNK_CACHE
+            if slot < CHUNK_CACHE or self.last_used[victim] == self.grid.clock:
+                self.grow()
+            else:
+                cx, cy = self.chunks[victim]
+                self.slot_of[cy, cx] = -1
+                return victim
+        self.chunks.append(None)
+        return slot
+
+    def build(self, cx, cy):
+        slot = self.new_slot()
+        self.chunks[slot] = (cx, cy)
+        self.slot_of[cy, cx] = slot
+        self.left[slot] = cx * CHUNK_SIZE - CHUNK_APRON
+        self.bottom[slot] = cy * CHUNK_SIZE - CHUNK_APRON
+        self.last_used[slot] = self.grid.clock
+        last = self.blocked.shape[1] - 1
+        self.rasterize(slot, self.grid.obstacles_near(cx, cy), [(0, last, 0, last)])
+        return slot
+
+    def slot(self, x, y):
+        grid = self.grid
+        cx = min(max(math.floor(x), 0), grid.width) // CHUNK_SIZE
+        cy = min(max(math.floor(y), 0), grid.height) // CHUNK_SIZE
+        slot = self.slot_of.item(cy, cx)
+        grid.clock += 1
+        if slot < 0:
+            slot = self.build(cx, cy)
+        self.last_used[slot] = grid.clock
+        return slot
+
+    def slots(self, x, y):
+        grid = self.grid
+        cx = np.minimum(np.maximum(np.floor(x), 0), grid.width).astype(np.intp) // CHUNK_SIZE
+        cy = np.minimum(np.maximum(np.floor(y), 0), grid.height).astype(np.intp) // CHUNK_SIZE
+        slots = self.slot_of[cy, cx]
+        grid.clock += 1
+        missing = slots < 0
+        if missing.any():
+            # Сначала помечаем уже нужные чанки, чтобы их не вытеснить
+            self.last_used[slots[~missing]] = grid.clock
+            for i in missing.nonzero()[0]:
+                if self.slot_of[cy[i], cx[i]] < 0:
+                    self.build(int(cx[i]), int(cy[i]))
+            slots = self.slot_of[cy, cx]
+        self.last_used[slots] = grid.clock
+        return slots
+
+    def cell_bounds(self, obstacle):
+        # Клетки мира, которые занимает препятствие
+        reach_x = self.half + obstacle.width / 2
+        reach_y = self.half + obstacle.height / 2
+        # Касание не считается столкновением, поэтому границы не включаются
+        return (max(0, math.floor(obstacle.center_x - reach_x) + 1),
+                min(self.grid.width, math.ceil(obstacle.center_x + reach_x) - 1),
+                max(0, math.floor(obstacle.center_y - reach_y) + 1),
+                min(self.grid.height, math.ceil(obstacle.center_y + reach_y) - 1))
+
+    def rasterize(self, slot, obstacles, rects):
+        # rects - прямоугольники клеток внутри чанка (x0, x1, y0, y1),
+        # где препятствия могли смениться. Они очищаются, затем препятствия
+        # рисуются в общей рамке всех прямоугольников: вне rects клетки и
+        # так заняты ими. Строки и столбцы rects пересчитываются по разу
+        left = self.left.item(slot)
+        bottom = self.bottom.item(slot)
+        blocked = self.blocked[slot]
+        for x0, x1, y0, y1 in rects:
+            blocked[y0:y1 + 1, x0:x1 + 1] = False
+        x0 = min(rect[0] for rect in rects)
+        x1 = max(rect[1] for rect in rects)
+        y0 = min(rect[2] for rect in rects)
+        y1 = max(rect[3] for rect in rects)
+        for obstacle in obstacles:
+            ox0, ox1, oy0, oy1 = self.cell_bounds(obstacle)
+            ox0, ox1 = max(ox0 - left, x0), min(ox1 - left, x1)
+            oy0, oy1 = max(oy0 - bottom, y0), min(oy1 - bottom, y1)
+            if ox0 <= ox1 and oy0 <= oy1:
+                blocked[oy0:oy1 + 1, ox0:ox1 + 1] = True
+        if len(rects) == 1:
+            self.refresh(slot, slice(y0, y1 + 1), slice(x0, x1 + 1))
+            return
+        rows = np.zeros(blocked.shape[0], dtype=bool)
+        columns = np.zeros(blocked.shape[1], dtype=bool)
+        for x0, x1, y0, y1 in rects:
+            rows[y0:y1 + 1] = True
+            columns[x0:x1 + 1] = True
+        self.refresh(slot, rows.nonzero()[0], columns.nonzero()[0])
+
+    def update(self, bounds, added=False):
+        # Перестраивает клетки мира в прямоугольниках bounds (x0, x1, y0, y1)
+        # во всех построенных чанках. Каждый задетый чанк перестраивается
+        # один раз, сколько бы прямоугольников в него ни попало.
+        # added - в прямоугольниках только добавлены препятствия
+        last = self.blocked.shape[1] - 1
+        rows, cols = self.slot_of.shape
+        dirty = {}
+        for x0, x1, y0, y1 in bounds:
+            for cy in range(max(0, (y0 - CHUNK_APRON) // CHUNK_SIZE - 1),
+                            min(rows, (y1 + CHUNK_APRON) // CHUNK_SIZE + 1)):
+                for cx in range(max(0, (x0 - CHUNK_APRON) // CHUNK_SIZE - 1),
+                                min(cols, (x1 + CHUNK_APRON) // CHUNK_SIZE + 1)):
+                    slot = self.slot_of.item(cy, cx)
+                    if slot < 0:
+                        continue
+                    left = self.left.item(slot)
+                    bottom = self.bottom.item(slot)
+                    lx0, lx1 = max(x0 - left, 0), min(x1 - left, last)
+                    ly0, ly1 = max(y0 - bottom, 0), min(y1 - bottom, last)
+                    if lx0 <= lx1 and ly0 <= ly1:
+                        dirty.setdefault((cx, cy, slot), []).append((lx0, lx1, ly0, ly1))
+        for (cx, cy, slot), rects in dirty.items():
+            if added:
+                self.fill(slot, rects)
+            else:
+                self.rasterize(slot, self.grid.obstacles_near(cx, cy), rects)
+
+    def fill(self, slot, rects):
+        # Прямоугольники целиком заняты новыми препятствиями: ближайшая
+        # занятая клетка меняется только до их края, строки и столбцы
+        # не пересчитываются целиком
+        blocked = self.blocked[slot]
+        next_x = self.next_x[slot]
+        prev_x = self.prev_x[slot]
+        next_y = self.next_y[slot]
+        prev_y = self.prev_y[slot]
+        for x0, x1, y0, y1 in rects:
+            rows = slice(y0, y1 + 1)
+            columns = slice(x0, x1 + 1)
+            blocked[rows, columns] = True
+            span = np.arange(x0, x1 + 1, dtype=np.int16)
+            np.minimum(next_x[rows, :x0], x0, out=next_x[rows, :x0])
+            np.maximum(prev_x[rows, x1 + 1:], x1, out=prev_x[rows, x1 + 1:])
+            next_x[rows, columns] = span
+            prev_x[rows, columns] = span
+            span = np.arange(y0, y1 + 1, dtype=np.int16)[:, None]
+            np.minimum(next_y[:y0, columns], y0, out=next_y[:y0, columns])
+            np.maximum(prev_y[y1 + 1:, columns], y1, out=prev_y[y1 + 1:, columns])
+            next_y[rows, columns] = span
+            prev_y[rows, columns] = span
+
+    def refresh(self, slot, rows, columns):
+        # Пересчитываем расстояния только в затронутых строках и столбцах
+        # (срезы или массивы номеров)
+        blocked = self.blocked[slot]
+        lines = blocked[rows]
+        index = np.arange(lines.shape[1], dtype=np.int16)
+        ahead = np.where(lines, index, GRID_FAR)[:, ::-1]
+        self.next_x[slot][rows] = np.minimum.accumulate(ahead, axis=1)[:, ::-1]
+        behind = np.where(lines, index, -GRID_FAR)
+        self.prev_x[slot][rows] = np.maximum.accumulate(behind, axis=1)
+
+        lines = blocked[:, columns]
+        index = np.arange(lines.shape[0], dtype=np.int16)[:, None]
+        ahead = np.where(lines, index, GRID_FAR)[::-1]
+        self.next_y[slot][:, columns] = np.minimum.accumulate(ahead, axis=0)[::-1]
+        behind = np.where(lines, index, -GRID_FAR)
+        self.prev_y[slot][:, columns] = np.maximum.accumulate(behind, axis=0)
+
+
+class ObstacleGrid:
+    # Растровая карта препятствий с шагом в пиксель. Слои для разных
+    # размеров танков строятся по требованию и обновляются только в области
+    # добавленного или разрушенного препятствия. Препятствия разложены
+    # по чанкам (с полем CHUNK_APRON), и карта трогает только чанки рядом
+    # с танками, а не весь мир; пули ищут препятствия по SpatialHash.
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.chunk_shape = (height // CHUNK_SIZE + 1, width // CHUNK_SIZE + 1)
+        self.sight_shape = (-(-height // SIGHT_CELL), -(-width // SIGHT_CELL))
+        # Растёт при каждом изменении препятствий: по нему FlowField
+        # узнаёт, что пора пересчитаться
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        # Препятствия по слотам в порядке добавления, убранные - None
+        self.obstacles = []
+        self.boxes = np.zeros((64, 4), dtype=np.float64)
+        # Препятствия по слотам в сетке грубой фазы попаданий пуль
+        self.spatial = SpatialHash()
+        self.buckets = {}
+        self.layers = {}
+        # Сколько препятствий накрывает центр каждой клетки SIGHT_CELL
+        self.opaque = np.zeros(self.sight_shape, dtype=np.int16)
+        self.clock = 0
+        self.version += 1
+
+    def layer(self, half):
+        layer = self.layers.get(half)
+        if layer is None:
+            layer = OccupancyLayer(half, self)
+            self.layers[half] = layer
+        return layer
+
+    def chunk_keys(self, obstacle):
+        rows, cols = self.chunk_shape
+        reach_x = obstacle.width / 2 + CHUNK_APRON
+        reach_y = obstacle.height / 2 + CHUNK_APRON
+        x0 = max(0, math.floor(obstacle.center_x - reach_x) // CHUNK_SIZE)
+        x1 = min(cols - 1, math.floor(obstacle.center_x + reach_x) // CHUNK_SIZE)
+        y0 = max(0, math.floor(obstacle.center_y - reach_y) // CHUNK_SIZE)
+        y1 = min(rows - 1, math.floor(obstacle.center_y + reach_y) // CHUNK_SIZE)
+        return [(cx, cy) for cy in range(y0, y1 + 1) for cx in range(x0, x1 + 1)]
+
+    def add(self, obstacle, slot=None, refresh=True):
+        # slot - свободный слот убранного препятствия (загрузка снимка матча):
+        # при равном пути пуля достаётся препятствию с меньшим слотом,
+        # поэтому восстановленное препятствие встаёт на прежнее место.
+        # refresh=False - слои обновит позже refresh_layers() сразу для всех
+        if slot is None:
+            slot = len(self.obstacles)
+        if slot >= len(self.boxes):
+            boxes = self.boxes
+            self.boxes = np.zeros((max(len(boxes) * 2, slot + 1), 4), dtype=np.float64)
+            self.boxes[:len(boxes)] = boxes
+        if slot >= len(self.obstacles):
+            self.obstacles.extend([None] * (slot + 1 - len(self.obstacles)))
+        self.obstacles[slot] = obstacle
+        obstacle.grid_slot = slot
+        self.version += 1
+        self.boxes[slot] = (obstacle.center_x, obstacle.center_y,
+                            obstacle.width / 2, obstacle.height / 2)
+        self.spatial.insert(slot, obstacle.center_x, obstacle.center_y,
+                            obstacle.width / 2, obstacle.height / 2)
+        for key in self.chunk_keys(obstacle):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                self.buckets[key] = np.array([slot], dtype=np.intp)
+            else:
+                self.buckets[key] = np.append(bucket, slot)
+        self.opaque[self.sight_cells(obstacle)] += 1
+        if refresh:
+            self.refresh_layers([obstacle])
+
+    def remove(self, obstacle, refresh=True):
+        slot = obstacle.grid_slot
+        if slot is None or self.obstacles[slot] is not obstacle:
+            return
+        self.obstacles[slot] = None
+        obstacle.grid_slot = None
+        self.version += 1
+        # Прямоугольник отрицательного размера не задевает ни одна пуля
+        self.boxes[slot, 2:] = -np.inf
+        self.spatial.remove(slot)
+        for key in self.chunk_keys(obstacle):
+            bucket = self.buckets[key]
+            self.buckets[key] = bucket[bucket != slot]
+        self.opaque[self.sight_cells(obstacle)] -= 1
+        if refresh:
+            self.refresh_layers([obstacle])
+
+    def refresh_layers(self, obstacles, added=False):
+        # Перестраивает слои там, где добавлены или убраны obstacles;
+        # added - все они добавлены
+        if not obstacles:
+            return
+        for layer in self.layers.values():
+            layer.update([layer.cell_bounds(obstacle) for obstacle in obstacles], added)
+
+    def trim(self, size):
+        # Снимок матча: слоты с size пусты, новые препятствия снова
+        # получают номера с size, как в исходном матче
+        del self.obstacles[size:]
+        self.obstacles.extend([None] * (size - len(self.obstacles)))
+
+    def sight_cells(self, obstacle):
+        # Клетки SIGHT_CELL, центры которых лежат внутри препятствия
+        rows, columns = self.sight_shape
+        half_width = obstacle.width / 2
+        half_height = obstacle.height / 2
+        x0 = max(0, math.ceil((obstacle.center_x - half_width) / SIGHT_CELL - 0.5))
+        x1 = min(columns, math.floor((obstacle.center_x + half_width) / SIGHT_CELL - 0.5) + 1)
+        y0 = max(0, math.ceil((obstacle.center_y - half_height) / SIGHT_CELL - 0.5))
+        y1 = min(rows, math.floor((obstacle.center_y + half_height) / SIGHT_CELL - 0.5) + 1)
+        return slice(y0, y1), slice(x0, x1)
+
+    def line_of_sight(self, x0, y0, x1, y1):
+        # Проход луча по клеткам SIGHT_CELL (DDA, Amanatides-Woo): на каждом
+        # шаге луч переходит в соседнюю клетку через ту границу, до которой
+        # ближе. Клеток на пути ровно |dx| + |dy| + 1 в клетках сетки
+        opaque = self.opaque
+        rows, columns = self.sight_shape
+        column = int(x0 // SIGHT_CELL)
+        row = int(y0 // SIGHT_CELL)
+        steps = (abs(int(x1 // SIGHT_CELL) - column) +
+                 abs(int(y1 // SIGHT_CELL) - row))
+        dx = x1 - x0
+        dy = y1 - y0
+        # Доля пути до следующей вертикальной (горизонтальной) границы
+        # и доля пути на одну клетку
+        step_column = 1 if dx > 0 else -1
+        if dx:
+            next_x = ((column + (dx > 0)) * SIGHT_CELL - x0) / dx
+            delta_x = SIGHT_CELL / abs(dx)
+        else:
+            next_x = delta_x = math.inf
+        step_row = 1 if dy > 0 else -1
+        if dy:
+            next_y = ((row + (dy > 0)) * SIGHT_CELL - y0) / dy
+            delta_y = SIGHT_CELL / abs(dy)
+        else:
+            next_y = delta_y = math.inf
+        for _ in range(steps + 1):
+            if 0 <= row < rows and 0 <= column < columns and opaque.item(row, column):
+                return False
+            if next_x < next_y:
+                next_x += delta_x
+                column += step_column
+            else:
+                next_y += delta_y
+                row += step_row
+        return True
+
+    def obstacles_near(self, cx, cy):
+        # Препятствия, которые могут задеть чанк (cx, cy) с его полем
+        parts = [self.buckets[key] for key in
+                 ((cx + i, cy + j) for j in (-1, 0, 1) for i in (-1, 0, 1))
+                 if key in self.buckets]
+        if not parts:
+            return []
+        return [self.obstacles[slot] for slot in np.unique(np.concatenate(parts))]
+
+    def box_arrays(self):
+        # Прямоугольники (центр, полуразмеры) по слотам для BulletSystem.hits;
+        # у пустых слотов полуразмеры -inf, и в self.spatial их нет
+        boxes = self.boxes[:len(self.obstacles)]
+        return boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+
+    def cells_x(self, x):
+        # Точка между клетками свободна, если свободны обе соседние клетки
+        return (min(max(math.floor(x), 0), self.width),
+                min(max(math.ceil(x), 0), self.width))
+
+    def cells_y(self, y):
+        return (min(max(math.floor(y), 0), self.height),
+                min(max(math.ceil(y), 0), self.height))
+
+    def is_blocked(self, half, x, y):
+        layer = self.layer(half)
+        slot = layer.slot(x, y)
+        left = layer.left.item(slot)
+        bottom = layer.bottom.item(slot)
+        blocked = layer.blocked
+        x0, x1 = self.cells_x(x)
+        y0, y1 = self.cells_y(y)
+        x0 -= left
+        x1 -= left
+        y0 -= bottom
+        y1 -= bottom
+        # item() возвращает обычные числа Python - так быстрее, чем через
+        # скаляры NumPy
+        return bool(blocked.item(slot, y0, x0) or blocked.item(slot, y0, x1) or
+                    blocked.item(slot, y1, x0) or blocked.item(slot, y1, x1))
+
+    def max_shift_x(self, half, x, y, dx):
+        layer = self.layer(half)
+        slot = layer.slot(x, y)
+        left = layer.left.item(slot)
+        bottom = layer.bottom.item(slot)
+        y0, y1 = self.cells_y(y)
+        y0 -= bottom
+        y1 -= bottom
+        if dx > 0:
+            column = math.ceil(x)
+            if column > self.width:
+                return dx
+            limit = min(layer.next_x.item(slot, y0, column - left),
+                        layer.next_x.item(slot, y1, column - left)) - 1 + left
+            return max(0.0, min(dx, limit - x))
+        column = math.floor(x)
+        if column < 0:
+            return dx
+        limit = max(layer.prev_x.item(slot, y0, column - left),
+                    layer.prev_x.item(slot, y1, column - left)) + 1 + left
+        return min(0.0, max(dx, limit - x))
+
+    def max_shift_y(self, half, x, y, dy):
+        layer = self.layer(half)
+        slot = layer.slot(x, y)
+        left = layer.left.item(slot)
+        bottom = layer.bottom.item(slot)
+        x0, x1 = self.cells_x(x)
+        x0 -= left
+        x1 -= left
+        if dy > 0:
+            row = math.ceil(y)
+            if row > self.height:
+                return dy
+            limit = min(layer.next_y.item(slot, row - bottom, x0),
+                        layer.next_y.item(slot, row - bottom, x1)) - 1 + bottom
+            return max(0.0, min(dy, limit - y))
+        row = math.floor(y)
+        if row < 0:
+            return dy
+        limit = max(layer.prev_y.item(slot, row - bottom, x0),
+                    layer.prev_y.item(slot, row - bottom, x1)) + 1 + bottom
+        return min(0.0, max(dy, limit - y))
+
+    def max_shifts_x(self, half, x, y, dx):
+        # То же, что max_shift_x, но сразу для массивов танков одного размера.
+        # Обе стороны считаются для всех танков, нужная выбирается по знаку dx
+        layer = self.layer(half)
+        slots = layer.slots(x, y)
+        left = layer.left[slots]
+        bottom = layer.bottom[slots]
+        y0 = (np.minimum(np.maximum(np.floor(y), 0), self.height) - bottom).astype(np.intp)
+        y1 = (np.minimum(np.maximum(np.ceil(y), 0), self.height) - bottom).astype(np.intp)
+        column = np.where(dx > 0, np.ceil(x), np.floor(x))
+        inside = (dx != 0) & (column >= 0) & (column <= self.width)
+        c = np.where(inside, column - left, 0).astype(np.intp)
+        limit = np.where(
+            dx > 0,
+            np.minimum(layer.next_x[slots, y0, c], layer.next_x[slots, y1, c]) - 1,
+            np.maximum(layer.prev_x[slots, y0, c], layer.prev_x[slots, y1, c]) + 1
+        ) + left
+        shift = np.minimum(np.maximum(limit - x, np.minimum(dx, 0)), np.maximum(dx, 0))
+        return np.where(inside, shift, dx)
+
+    def max_shifts_y(self, half, x, y, dy):
+        layer = self.layer(half)
+        slots = layer.slots(x, y)
+        left = layer.left[slots]
+        bottom = layer.bottom[slots]
+        x0 = (np.minimum(np.maximum(np.floor(x), 0), self.width) - left).astype(np.intp)
+        x1 = (np.minimum(np.maximum(np.ceil(x), 0), self.width) - left).astype(np.intp)
+        row = np.where(dy > 0, np.ceil(y), np.floor(y))
+        inside = (dy != 0) & (row >= 0) & (row <= self.height)
+        r = np.where(inside, row - bottom, 0).astype(np.intp)
+        limit = np.where(
+            dy > 0,
+            np.minimum(layer.next_y[slots, r, x0], layer.next_y[slots, r, x1]) - 1,
+            np.maximum(layer.prev_y[slots, r, x0], layer.prev_y[slots, r, x1]) + 1
+        ) + bottom
+        shift = np.minimum(np.maximum(limit - y, np.minimum(dy, 0)), np.maximum(dy, 0))
+        return np.where(inside, shift, dy)
 
 
 class Obstacle(arcade.SpriteSolidColor):
-    def __init__(self, width, height, color):
+    def __init__(self, width, height, color, rng=random):
         super().__init__(width, height, color)
-        self.is_destructible = random.choice([True, False])
+        self.is_destructible = rng.choice([True, False])
         self.health = 2 if self.is_destructible else 999
+        self.grid_slot = None
+
+
+class Wall:
+    # Неразрушаемая стена уровня: прямоугольник для сетки препятствий
+    # и попаданий пуль, без спрайта. Рисуются стены все разом в TankGame
+    is_destructible = False
+    health = 999
+
+    def __init__(self, left, bottom, right, top):
+        self.center_x = (left + right) / 2
+        self.center_y = (bottom + top) / 2
+        self.width = right - left
+        self.height = top - bottom
+        self.grid_slot = None
+
+
+LEVEL_MAGIC = b"TNKL"
+LEVEL_VERSION = 1
+# magic, версия, размер клетки в пикселях, столбцов, строк; дальше
+# по байту на клетку, строки сверху вниз - как в текстовом исходнике
+LEVEL_HEADER = struct.Struct("<4sBBHH")
+
+
+def keeps_connected(mask):
+    # mask - занятые соседи клетки по ARENA_RING (бит i - сосед i).
+    # Клетку можно занять, если её свободные соседи по сторонам связаны
+    # друг с другом через свободные клетки вокруг неё: любой путь через
+    # клетку тогда обходится, и свободная область остаётся связной
+    ring = [bool(mask >> i & 1) for i in range(8)]
+    if all(ring):
+        return True
+    start = ring.index(True) if any(ring) else 0
+    runs = set()
+    run = 0
+    for i in range(start, start + 8):
+        if ring[i % 8]:
+            run += 1
+        elif i % 2 == 0:
+            runs.add(run)
+    return len(runs) <= 1
+
+
+# Ответ keeps_connected для всех 256 вариантов соседей
+ARENA_SAFE = [keeps_connected(mask) for mask in range(256)]
+
+
+def generate_blocks(rng, width, height, count, clear):
+    # Центры до count блоков 60x60 на поле width x height, вне прямоугольников
+    # clear (x0, y0, x1, y1). Свободные клетки решётки перебираются в
+    # случайном порядке ровно один раз, поэтому время ограничено размером
+    # карты. Клетки за краем решётки (полоса ARENA_MARGIN) свободны
+    # и связаны, а каждый блок ставится, только если не разрывает
+    # свободную область: до игрока можно доехать с любой стороны
+    columns = max(0, (width - 2 * ARENA_MARGIN) // ARENA_PITCH)
+    rows = max(0, (height - 2 * ARENA_MARGIN) // ARENA_PITCH)
+    if columns == 0 or rows == 0 or count <= 0:
+        return []
+    x = (width - columns * ARENA_PITCH) // 2 + ARENA_PITCH // 2 + \
+        np.arange(columns) * ARENA_PITCH
+    y = (height - rows * ARENA_PITCH) // 2 + ARENA_PITCH // 2 + \
+        np.arange(rows) * ARENA_PITCH
+    reach = 30 + ARENA_JITTER
+    candidate = np.ones((rows, columns), dtype=bool)
+    for x0, y0, x1, y1 in clear:
+        candidate[np.ix_((y + reach > y0) & (y - reach < y1),
+                         (x + reach > x0) & (x - reach < x1))] = False
+
+    generator = np.random.default_rng(rng.getrandbits(64))
+    # Для каждой клетки - маска занятых соседей, с полем в клетку по краям.
+    # Плоский список: в цикле по клеткам он быстрее массива NumPy
+    stride = columns + 2
+    neighbours = [0] * (stride * (rows + 2))
+    offsets = [(1 << bit, -dy * stride - dx) for bit, (dy, dx) in enumerate(ARENA_RING)]
+    placed = []
+    for index in generator.permutation(np.flatnonzero(candidate)).tolist():
+        row, column = divmod(index, columns)
+        cell = (row + 1) * stride + column + 1
+        if ARENA_SAFE[neighbours[cell]]:
+            for bit, offset in offsets:
+                neighbours[cell + offset] |= bit
+            placed.append((row, column))
+            if len(placed) == count:
+                break
+    jitter = generator.integers(-ARENA_JITTER, ARENA_JITTER + 1, size=(len(placed), 2))
+    return [(int(x[column]) + dx, int(y[row]) + dy)
+            for (row, column), (dx, dy) in zip(placed, jitter.tolist())]
+
+
+def merge_wall_runs(walls):
+    # walls[строка, столбец], строка 0 - нижняя. Стены каждой строки
+    # режутся на отрезки, а одинаковые отрезки соседних строк сливаются
+    # в один прямоугольник (столбец0, строка0, столбец1, строка1),
+    # правая и верхняя границы не включаются
+    rows = walls.shape[0]
+    rects = []
+    started = {}
+    for row in range(rows + 1):
+        runs = set()
+        if row < rows:
+            edges = np.flatnonzero(np.diff(np.concatenate(
+                ([0], walls[row].astype(np.int8), [0]))))
+            runs = set(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+        for run in sorted(started):
+            if run not in runs:
+                rects.append((run[0], started.pop(run), run[1], row))
+        for run in sorted(runs):
+            started.setdefault(run, row)
+    return rects
+
+
+class Level:
+    # Разобранный уровень в пикселях мира: прямоугольники стен, центры
+    # разрушаемых блоков и место появления игрока
+    def __init__(self, tiles, tile_size):
+        rows, columns = tiles.shape
+        if columns * tile_size < SCREEN_WIDTH or rows * tile_size < SCREEN_HEIGHT:
+            raise ValueError("уровень меньше экрана")
+        # В файле строки идут сверху вниз, в мире y растёт вверх
+        tiles = tiles[::-1]
+        self.tile_size = tile_size
+        self.width = columns * tile_size
+        self.height = rows * tile_size
+        self.walls = np.array(merge_wall_runs(tiles == TILE_WALL),
+                              dtype=np.int64).reshape(-1, 4) * tile_size
+        rows_b, columns_b = (tiles == TILE_BRICK).nonzero()
+        self.bricks = np.column_stack((columns_b, rows_b)) * tile_size + tile_size // 2
+        spawn = np.argwhere(tiles == TILE_SPAWN)
+        if len(spawn):
+            row, column = spawn[0].tolist()
+            self.spawn = (column * tile_size + tile_size // 2,
+                          row * tile_size + tile_size // 2)
+        else:
+            self.spawn = (self.width // 2, 100)
+
+
+def parse_level_text(lines):
+    # Текстовый исходник уровня: # - стена, B - разрушаемый блок,
+    # P - игрок, точка или пробел - пусто
+    lines = [line.rstrip("\r\n") for line in lines]
+    lines = [line for line in lines if line.strip()]
+    columns = max(len(line) for line in lines)
+    tiles = np.zeros((len(lines), columns), dtype=np.uint8)
+    for row, line in enumerate(lines):
+        for column, char in enumerate(line):
+            if char not in TILE_CHARS:
+                raise ValueError(f"неизвестная клетка {char!r} в строке {row + 1}")
+            tiles[row, column] = TILE_CHARS[char]
+    return tiles
+
+
+def save_level(path, tiles, tile_size=TILE_SIZE):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    rows, columns = tiles.shape
+    with open(path, "wb") as f:
+        f.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, tile_size, columns, rows))
+        f.write(np.ascontiguousarray(tiles, dtype=np.uint8).tobytes())
+
+
+def read_level(path):
+    # Клетки читаются прямо из отображённого в память файла, без копии
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, tile_size, columns, rows = LEVEL_HEADER.unpack_from(data)
+        if magic != LEVEL_MAGIC:
+            raise ValueError("это не файл уровня")
+        if version != LEVEL_VERSION:
+            raise ValueError(f"неподдерживаемая версия уровня: {version}")
+        tiles = np.frombuffer(data, dtype=np.uint8, count=columns * rows,
+                              offset=LEVEL_HEADER.size).reshape(rows, columns)
+        level = Level(tiles, tile_size)
+        # Массив держит буфер mmap: без этого файл не закроется
+        del tiles
+    return level
+
+
+# Разобранные уровни по пути; при рестарте матча файл не читается заново,
+# пока не изменится
+level_cache = {}
+
+
+def load_level(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = level_cache.get(path)
+    if cached is None or cached[0] != key:
+        cached = level_cache[path] = (key, read_level(path))
+    return cached[1]
+
+
+def segment_circle_entry(px, py, dx, dy, radius):
+    # Доля пути t из [0, 1), на которой точка, движущаяся из (px, py)
+    # на (dx, dy), входит в круг радиуса radius с центром в начале
+    # координат; inf - не входит. Если точка уже внутри, t = 0
+    a = dx * dx + dy * dy
+    b = px * dx + py * dy
+    c = px * px + py * py - radius * radius
+    discriminant = b * b - a * c
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (-b - np.sqrt(np.maximum(discriminant, 0))) / a
+    t = np.where(c < 0, 0.0, t)
+    return np.where((c < 0) | ((discriminant > 0) & (a > 0) & (t >= 0) & (t < 1)),
+                    t, np.inf)
+
+
+def segment_box_entry(px, py, dx, dy, half_width, half_height, radius):
+    # Доля пути t, на которой круг радиуса radius, движущийся из (px, py)
+    # на (dx, dy), впервые задевает прямоугольник с центром в начале
+    # координат; inf - не задевает. Центр круга при этом входит в
+    # прямоугольник, расширенный на radius, со скруглёнными углами.
+    # Сначала отрезок пересекается с расширенным прямоугольником по осям
+    # (slab-тест); если вход пришёлся на угол, точный ответ даёт окружность
+    # этого угла. Касание, как и в BulletSystem.hits, попаданием не считается
+    reach_x = half_width + radius
+    reach_y = half_height + radius
+    with np.errstate(divide="ignore", invalid="ignore"):
+        enter_x = np.where(dx != 0, (-np.copysign(reach_x, dx) - px) / dx,
+                           np.where(np.abs(px) < reach_x, -np.inf, np.inf))
+        leave_x = np.where(dx != 0, (np.copysign(reach_x, dx) - px) / dx, np.inf)
+        enter_y = np.where(dy != 0, (-np.copysign(reach_y, dy) - py) / dy,
+                           np.where(np.abs(py) < reach_y, -np.inf, np.inf))
+        leave_y = np.where(dy != 0, (np.copysign(reach_y, dy) - py) / dy, np.inf)
+    enter = np.maximum(np.maximum(enter_x, enter_y), 0)
+    leave = np.minimum(np.minimum(leave_x, leave_y), 1)
+    t = np.where(enter < leave, enter, np.inf)
+
+    hit = np.isfinite(t)
+    entry_x = px + np.where(hit, t, 0) * dx
+    entry_y = py + np.where(hit, t, 0) * dy
+    corner = (hit & (np.abs(entry_x) > half_width) &
+              (np.abs(entry_y) > half_height)).nonzero()[0]
+    if len(corner):
+        t[corner] = segment_circle_entry(
+            px[corner] - np.copysign(half_width[corner], entry_x[corner]),
+            py[corner] - np.copysign(half_height[corner], entry_y[corner]),
+            dx[corner], dy[corner], radius[corner])
+    return t
+
+
+def segment_circle_entry_scalar(px, py, dx, dy, radius):
+    # segment_circle_entry() для одной точки, теми же операциями
+    a = dx * dx + dy * dy
+    b = px * dx + py * dy
+    c = px * px + py * py - radius * radius
+    if c < 0:
+        return 0.0
+    discriminant = b * b - a * c
+    if discriminant <= 0 or a <= 0:
+        return math.inf
+    t = (-b - math.sqrt(discriminant)) / a
+    return t if 0 <= t < 1 else math.inf
+
+
+def segment_box_entry_scalar(px, py, dx, dy, half_width, half_height, radius):
+    # segment_box_entry() для одной пары: на нескольких парах скаляры
+    # быстрее двух десятков временных массивов, а ответ тот же до бита
+    reach_x = half_width + radius
+    reach_y = half_height + radius
+    if dx != 0:
+        enter_x = (-math.copysign(reach_x, dx) - px) / dx
+        leave_x = (math.copysign(reach_x, dx) - px) / dx
+    else:
+        enter_x = -math.inf if abs(px) < reach_x else math.inf
+        leave_x = math.inf
+    if dy != 0:
+        enter_y = (-math.copysign(reach_y, dy) - py) / dy
+        leave_y = (math.copysign(reach_y, dy) - py) / dy
+    else:
+        enter_y = -math.inf if abs(py) < reach_y else math.inf
+        leave_y = math.inf
+    t = max(enter_x, enter_y, 0)
+    if not t < min(leave_x, leave_y, 1):
+        return math.inf
+    entry_x = px + t * dx
+    entry_y = py + t * dy
+    if abs(entry_x) > half_width and abs(entry_y) > half_height:
+        return segment_circle_entry_scalar(px - math.copysign(half_width, entry_x),
+                                           py - math.copysign(half_height, entry_y),
+                                           dx, dy, radius)
+    return t
+
+
+class SpatialHash:
+    # Равномерная сетка для грубой фазы попаданий. Элемент - номер строки
+    # в массивах координат, он лежит в ячейке своего центра; запрос
+    # расширяется на наибольший полуразмер элементов. Номера ячеек
+    # отсортированы, и каждая строка ячеек запроса - отрезок этого порядка.
+    # Подвижные элементы (танки, пули) заносятся все сразу через update(),
+    # неподвижные (препятствия) - по одному через insert() и remove().
+    # Порядок пересобирается, только если кто-то из элементов сменил ячейку
+    def __init__(self, cell_size=SPATIAL_CELL):
+        self.cell_size = cell_size
+        # Ячейка каждого элемента, SPATIAL_NONE - элемента нет
+        self.cells = np.zeros(0, dtype=np.int64)
+        self.count = 0
+        self.order = None
+        self.sorted_cells = None
+        self.points = None
+        self.half_x = 0.0
+        self.half_y = 0.0
+        # Элементы по номеру ячейки для near(); есть только у сетки,
+        # заполненной через insert()
+        self.buckets = {}
+
+    def update(self, x, y, half_width, half_height):
+        # Новые положения всех элементов; ячейки считаются при запросе
+        self.points = (x, y, half_width, half_height)
+        self.count = len(x)
+        self.buckets = None
+
+    def insert(self, item, x, y, half_width, half_height):
+        if item >= len(self.cells):
+            cells = self.cells
+            self.cells = np.full(max(len(cells) * 2, item + 1, 64), SPATIAL_NONE,
+                                 dtype=np.int64)
+            self.cells[:len(cells)] = cells
+        cell = math.floor(y / self.cell_size) * SPATIAL_ROW + math.floor(x / self.cell_size)
+        self.cells[item] = cell
+        self.buckets.setdefault(cell, []).append(item)
+        self.count += 1
+        # Полуразмер не уменьшается при remove(): запрос лишь шире нужного
+        self.half_x = max(self.half_x, half_width)
+        self.half_y = max(self.half_y, half_height)
+        self.order = None
+
+    def remove(self, item):
+        self.buckets[self.cells.item(item)].remove(item)
+        self.cells[item] = SPATIAL_NONE
+        self.count -= 1
+        self.order = None
+
+    def near(self, x, y, reach_x, reach_y):
+        # Те же кандидаты, что pairs() для одного запроса, но по словарю
+        # ячеек на числах Python: для пары пуль без массивов NumPy
+        size = self.cell_size
+        reach_x += self.half_x
+        reach_y += self.half_y
+        x0 = math.floor((x - reach_x) / size)
+        x1 = math.floor((x + reach_x) / size)
+        found = []
+        for row in range(math.floor((y - reach_y) / size), math.floor((y + reach_y) / size) + 1):
+            for cell in range(row * SPATIAL_ROW + x0, row * SPATIAL_ROW + x1 + 1):
+                items = self.buckets.get(cell)
+                if items:
+                    found += items
+        return found
+
+    def columns(self, x):
+        # Номер столбца (или строки) ячейки для координаты
+        return np.floor(x / self.cell_size).astype(np.int64)
+
+    def prepare(self):
+        if self.points is not None:
+            x, y, half_width, half_height = self.points
+            self.points = None
+            self.half_x = float(half_width.max()) if len(x) else 0.0
+            self.half_y = float(half_height.max()) if len(x) else 0.0
+            cells = self.columns(y) * SPATIAL_ROW + self.columns(x)
+            if self.order is not None and np.array_equal(cells, self.cells):
+                return
+            self.cells = cells
+            self.order = None
+        if self.order is None:
+            self.order = np.argsort(self.cells, kind="stable")
+            self.sorted_cells = self.cells[self.order]
+
+    def pairs(self, x, y, reach_x, reach_y):
+        # Пары (запрос, элемент), у которых центры ближе reach запроса плюс
+        # полуразмер элемента по обеим осям - и, возможно, ещё несколько
+        self.prepare()
+        empty = np.empty(0, dtype=np.intp)
+        if self.count == 0 or len(x) == 0:
+            return empty, empty
+        reach_x = reach_x + self.half_x
+        reach_y = reach_y + self.half_y
+        bounds = np.empty((4, len(x)))
+        np.subtract(x, reach_x, out=bounds[0])
+        np.add(x, reach_x, out=bounds[1])
+        np.subtract(y, reach_y, out=bounds[2])
+        np.add(y, reach_y, out=bounds[3])
+        x0, x1, y0, y1 = self.columns(bounds)
+        # Строки ячеек всех запросов подряд: запрос, номер строки, её начало
+        # и конец в отсортированных номерах ячеек
+        rows = y1 - y0 + 1
+        query = np.repeat(np.arange(len(x)), rows)
+        row = np.arange(len(query)) + np.repeat(y0 - np.cumsum(rows) + rows, rows)
+        row *= SPATIAL_ROW
+        low = np.searchsorted(self.sorted_cells, row + x0[query], side="left")
+        high = np.searchsorted(self.sorted_cells, row + x1[query], side="right")
+        counts = high - low
+        first = np.repeat(low - np.cumsum(counts) + counts, counts)
+        first += np.arange(len(first))
+        return np.repeat(query, counts), self.order[first]
+
+
+class BulletSystem:
+    # Все пули в непрерывных массивах NumPy: движение, отсечение за экраном
+    # и проверка попаданий выполняются сразу для всех пуль.
+    # Индексы пуль стабильны в пределах тика, мёртвые слоты убираются
+    # в начале следующего update().
+    def __init__(self, capacity=256):
+        self.count = 0
+        # Слоты массивов и есть пул пуль: считаем выстрелы и наибольшее
+        # число занятых слотов, всё сверх него - повторное использование
+        self.spawned = 0
+        self.high_water = 0
+        self.allocate(capacity)
+        self.renderer = CircleRenderer()
+        # Рамки путей пуль за тик (см. paths() и path_items()) и сетка
+        # пуль по ним; None и -1 - пересчитать после движения
+        self.path = None
+        self.path_list = None
+        self.spatial = SpatialHash()
+        self.indexed = -1
+
+    def allocate(self, capacity):
+        self.x = np.zeros(capacity, dtype=np.float64)
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.change_x = np.zeros(capacity, dtype=np.float64)
+        self.change_y = np.zeros(capacity, dtype=np.float64)
+        self.radius = np.zeros(capacity, dtype=np.float64)
+        self.damage = np.zeros(capacity, dtype=np.int32)
+        self.owner = np.zeros(capacity, dtype=np.int8)
+        self.color = np.zeros((capacity, 4), dtype=np.uint8)
+        self.alive = np.zeros(capacity, dtype=bool)
+        # Сквозной номер выстрела: слоты переиспользуются, номер - нет
+        self.serial = np.zeros(capacity, dtype=np.int64)
+
+    def arrays(self):
+        return (self.x, self.y, self.change_x, self.change_y, self.radius,
+                self.damage, self.owner, self.color, self.alive, self.serial)
+
+    def grow(self):
+        old = self.arrays()
+        self.allocate(len(self.x) * 2)
+        for new, array in zip(self.arrays(), old):
+            new[:len(array)] = array
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive[:self.count]))
+
+    def clear(self):
+        self.alive[:self.count] = False
+        self.count = 0
+        self.path = None
+        self.path_list = None
+        self.indexed = -1
+
+    def spawn(self, x, y, change_x, change_y, radius, damage, owner, color):
+        if self.count == len(self.x):
+            self.grow()
+        i = self.count
+        self.x[i] = x
+        self.y[i] = y
+        self.change_x[i] = change_x
+        self.change_y[i] = change_y
+        self.radius[i] = radius
+        self.damage[i] = damage
+        self.owner[i] = owner
+        self.color[i, :3] = color[:3]
+        self.color[i, 3] = 255
+        self.alive[i] = True
+        self.count += 1
+        self.spawned += 1
+        self.serial[i] = self.spawned
+        if self.count > self.high_water:
+            self.high_water = self.count
+        return i
+
+    def spawn_many(self, x, y, change_x, change_y, radius, damage, owner, color):
+        k = len(x)
+        while self.count + k > len(self.x):
+            self.grow()
+        s = slice(self.count, self.count + k)
+        self.x[s] = x
+        self.y[s] = y
+        self.change_x[s] = change_x
+        self.change_y[s] = change_y
+        self.radius[s] = radius
+        self.damage[s] = damage
+        self.owner[s] = owner
+        self.color[s, :3] = color
+        self.color[s, 3] = 255
+        self.alive[s] = True
+        self.serial[s] = np.arange(self.spawned + 1, self.spawned + k + 1)
+        self.count += k
+        self.spawned += k
+        if self.count > self.high_water:
+            self.high_water = self.count
+
+    def kill(self, index):
+        self.alive[index] = False
+
+    def to_bytes(self):
+        # Для снимка матча: живые пули подряд, массив за массивом
+        alive = self.alive[:self.count].nonzero()[0]
+        parts = [STATE_BULLETS.pack(len(alive), self.spawned)]
+        for array in self.arrays():
+            if array is not self.alive:
+                parts.append(array[alive].astype(array.dtype.newbyteorder("<"),
+                                                 copy=False).tobytes())
+        return b"".join(parts)
+
+    def restore(self, data, offset):
+        count, self.spawned = STATE_BULLETS.unpack_from(data, offset)
+        offset += STATE_BULLETS.size
+        self.clear()
+        while count > len(self.x):
+            self.grow()
+        for array in self.arrays():
+            if array is self.alive:
+                continue
+            dtype = array.dtype.newbyteorder("<")
+            size = count * (array.size // len(array))
+            array[:count] = np.frombuffer(data, dtype=dtype, count=size,
+                                          offset=offset).reshape(array[:count].shape)
+            offset += size * dtype.itemsize
+        self.alive[:count] = True
+        self.count = count
+        if count > self.high_water:
+            self.high_water = count
+        return offset
+
+    def stats(self):
+        return {
+            "acquired": self.spawned,
+            "hit_rate": (1 - self.high_water / self.spawned) if self.spawned else 0.0,
+            "in_use": len(self),
+            "high_water": self.high_water,
+        }
 
-
-class Bullet(arcade.SpriteCircle):
-    def __init__(self, radius, color, damage=1):
-        super().__init__(radius, color)
-        self.damage = damage
-
-    def update(self, delta_time=1 / 60):
-        self.center_x += self.change_x
-        self.center_y += self.change_y
-
-        # Безопасная проверка границ с учетом радиуса пули
-        bullet_radius = self.width / 2
-        if (self.center_x < -bullet_radius or
-                self.center_x > SCREEN_WIDTH + bullet_radius or
-                self.center_y < -bullet_radius or
-                self.center_y > SCREEN_HEIGHT + bullet_radius):
-            self.remove_from_sprite_lists()
+    def compact(self):
+        n = self.count
+        keep = self.alive[:n].nonzero()[0]
+        if len(keep) == n:
+            return
+        for array in self.arrays():
+            array[:len(keep)] = array[keep]
+        self.alive[len(keep):n] = False
+        self.count = len(keep)
+
+    def update(self, width, height):
+        self.compact()
+        n = self.count
+        x = self.x[:n]
+        y = self.y[:n]
+        r = self.radius[:n]
+        # Пуля исчезает, когда целиком вылетела за край мира ещё до шага:
+        # последний отрезок пути нужен непрерывной проверке попаданий
+        if n <= SCALAR_BULLETS:
+            for slot, (bx, by, radius) in enumerate(zip(x.tolist(), y.tolist(), r.tolist())):
+                if not (-radius <= bx <= width + radius and -radius <= by <= height + radius):
+                    self.alive[slot] = False
+        else:
+            self.alive[:n] &= ((x >= -r) & (x <= width + r) &
+                               (y >= -r) & (y <= height + r))
+        x += self.change_x[:n]
+        y += self.change_y[:n]
+        self.path = None
+        self.path_list = None
+        self.indexed = -1
+
+    def paths(self):
+        # Начало пути каждой пули за тик и рамка этого пути: середина
+        # отрезка и полуразмер с радиусом и запасом в пиксель, чтобы
+        # округление не отбросило касание. Считаются раз за тик для всех
+        n = self.count
+        if self.path is None or len(self.path[0]) != n:
+            dx = self.change_x[:n]
+            dy = self.change_y[:n]
+            start_x = self.x[:n] - dx
+            start_y = self.y[:n] - dy
+            reach = self.radius[:n] + 1
+            self.path = (start_x, start_y, start_x + dx / 2, start_y + dy / 2,
+                         np.abs(dx) / 2 + reach, np.abs(dy) / 2 + reach)
+        return self.path
+
+    def path_items(self):
+        # Пути из paths() на числах Python для sweeps_scalar(): слот,
+        # владелец, начало, шаг, радиус, середина и полуразмер рамки.
+        # Формулы те же, поэтому и ответ совпадает до бита
+        n = self.count
+        if self.path_list is None or len(self.path_list) != n:
+            self.path_list = []
+            for slot, (x, y, dx, dy, radius, owner) in enumerate(zip(
+                    self.x[:n].tolist(), self.y[:n].tolist(), self.change_x[:n].tolist(),
+                    self.change_y[:n].tolist(), self.radius[:n].tolist(),
+                    self.owner[:n].tolist())):
+                start_x = x - dx
+                start_y = y - dy
+                reach = radius + 1
+                self.path_list.append((slot, owner, start_x, start_y, dx, dy, radius,
+                                       start_x + dx / 2, start_y + dy / 2,
+                                       abs(dx) / 2 + reach, abs(dy) / 2 + reach))
+        return self.path_list
+
+    def register(self):
+        # Пули в сетке - рамками путей, как их проверяет sweeps()
+        self.spatial.update(*self.paths()[2:])
+        self.indexed = self.count
+
+    def select(self, owner):
+        n = self.count
+        mask = self.alive[:n]
+        if owner is not None:
+            mask = mask & (self.owner[:n] == owner)
+        return mask.nonzero()[0]
+
+    def pairs(self, bullets, x, y, reach_x, reach_y, boxes, spatial=None):
+        # Пары (номер в bullets, цель), у которых рамка пули (x, y, reach)
+        # пересекает цель. Кандидатов даёт SpatialHash целей spatial, а без
+        # него - сетка самих пуль, в которую запрашиваются цели
+        center_x, center_y, half_width, half_height = boxes
+        if spatial is not None:
+            pair_bullet, pair_box = spatial.pairs(x, y, reach_x, reach_y)
+        else:
+            if self.indexed != self.count:
+                self.register()
+            pair_box, slot = self.spatial.pairs(center_x, center_y, half_width, half_height)
+            position = np.full(self.count, -1, dtype=np.intp)
+            position[bullets] = np.arange(len(bullets))
+            pair_bullet = position[slot]
+            selected = pair_bullet >= 0
+            pair_bullet = pair_bullet[selected]
+            pair_box = pair_box[selected]
+        near = ((np.abs(x[pair_bullet] - center_x[pair_box]) <
+                 reach_x[pair_bullet] + half_width[pair_box]) &
+                (np.abs(y[pair_bullet] - center_y[pair_box]) <
+                 reach_y[pair_bullet] + half_height[pair_box]))
+        return pair_bullet[near], pair_box[near]
+
+    def hits(self, owner, center_x, center_y, half_width, half_height, spatial=None):
+        # Пересечение кругов пуль с прямоугольниками целей. Кандидаты
+        # отбираются по сетке (spatial - SpatialHash целей, см. pairs()),
+        # точная проверка - только для соседних пар. Результат упорядочен
+        # по пуле, затем по индексу цели.
+        bullets = self.select(owner)
+        empty = np.empty(0, dtype=np.intp)
+        if len(bullets) == 0 or len(center_x) == 0:
+            return empty, empty
+
+        bx = self.x[bullets]
+        by = self.y[bullets]
+        br = self.radius[bullets]
+        if len(bullets) * len(center_x) <= HITS_DENSE_PAIRS:
+            # Мало пар: проще проверить все сразу, чем искать по сетке
+            gap_x = np.maximum(np.abs(bx[:, None] - center_x) - half_width, 0)
+            gap_y = np.maximum(np.abs(by[:, None] - center_y) - half_height, 0)
+            pair_bullet, pair_box = np.nonzero(
+                gap_x * gap_x + gap_y * gap_y < (br * br)[:, None]
+            )
+            return bullets[pair_bullet], pair_box
+
+        pair_bullet, pair_box = self.pairs(bullets, bx, by, br, br,
+                                           (center_x, center_y, half_width, half_height),
+                                           spatial)
+        if len(pair_bullet) == 0:
+            return empty, empty
+
+        gap_x = np.maximum(np.abs(bx[pair_bullet] - center_x[pair_box]) -
+                           half_width[pair_box], 0)
+        gap_y = np.maximum(np.abs(by[pair_bullet] - center_y[pair_box]) -
+                           half_height[pair_box], 0)
+        # Касание не считается попаданием
+        hit = gap_x * gap_x + gap_y * gap_y < br[pair_bullet] ** 2
+
+        hit_bullets = bullets[pair_bullet[hit]]
+        hit_boxes = pair_box[hit]
+        order = np.lexsort((hit_boxes, hit_bullets))
+        return hit_bullets[order], hit_boxes[order]
+
+    def sweeps(self, owner, center_x, center_y, half_width, half_height, spatial=None):
+        # Непрерывная проверка: за тик круг пули прошёл отрезок от
+        # (x - change_x, y - change_y) до (x, y), и пуля не пролетает
+        # сквозь цель, даже если шаг больше цели. Для каждой задевшей
+        # что-то пули - первая цель на пути (при равенстве - с меньшим
+        # индексом) и доля пути t до неё. Результат упорядочен по пуле
+        if self.count <= SCALAR_BULLETS:
+            if self.count * len(center_x) <= SWEEP_SCALAR_PAIRS:
+                return self.sweeps_scalar(owner, center_x, center_y, half_width, half_height)
+            if spatial is not None and spatial.buckets is not None:
+                return self.sweeps_scalar(owner, center_x, center_y, half_width, half_height,
+                                          spatial)
+        bullets = self.select(owner)
+        empty = np.empty(0, dtype=np.intp)
+        if len(bullets) == 0 or len(center_x) == 0:
+            return empty, empty, np.empty(0)
+
+        # Пары, у которых рамка пути пули не задевает цель, отсеиваются
+        # до точной проверки
+        start_x, start_y, middle_x, middle_y, reach_x, reach_y = [
+            values[bullets] for values in self.paths()]
+        if len(bullets) * len(center_x) <= HITS_DENSE_PAIRS:
+            pair_bullet, pair_box = np.nonzero(
+                (np.abs(middle_x[:, None] - center_x) < reach_x[:, None] + half_width) &
+                (np.abs(middle_y[:, None] - center_y) < reach_y[:, None] + half_height))
+        else:
+            pair_bullet, pair_box = self.pairs(bullets, middle_x, middle_y, reach_x, reach_y,
+                                               (center_x, center_y, half_width, half_height),
+                                               spatial)
+        if len(pair_bullet) == 0:
+            return empty, empty, np.empty(0)
+
+        slots = bullets[pair_bullet]
+        pairs = (start_x[pair_bullet] - center_x[pair_box],
+                 start_y[pair_bullet] - center_y[pair_box],
+                 self.change_x[slots], self.change_y[slots], half_width[pair_box],
+                 half_height[pair_box], self.radius[slots])
+        if len(pair_bullet) <= SWEEP_SCALAR_PAIRS:
+            t = np.array([segment_box_entry_scalar(*pair)
+                          for pair in zip(*[values.tolist() for values in pairs])],
+                         dtype=np.float64)
+        else:
+            t = segment_box_entry(*pairs)
+        hit = np.isfinite(t)
+        pair_bullet = pair_bullet[hit]
+        pair_box = pair_box[hit]
+        t = t[hit]
+        order = np.lexsort((pair_box, t, pair_bullet))
+        pair_bullet = pair_bullet[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = pair_bullet[1:] != pair_bullet[:-1]
+        return bullets[pair_bullet[first]], pair_box[order][first], t[order][first]
+
+    def sweeps_scalar(self, owner, center_x, center_y, half_width, half_height,
+                      spatial=None):
+        # sweeps() на числах Python для нескольких пуль и одного танка или
+        # препятствий из сетки spatial (см. SpatialHash.near()): там каждая
+        # из двух десятков операций NumPy дороже всей проверки
+        boxes = None
+        hit_bullets = []
+        hit_boxes = []
+        hit_t = []
+        for (slot, bullet_owner, start_x, start_y, dx, dy, radius,
+             middle_x, middle_y, reach_x, reach_y) in self.path_items():
+            if (owner is not None and bullet_owner != owner) or not self.alive.item(slot):
+                continue
+            if spatial is not None:
+                boxes = [(box, (center_x.item(box), center_y.item(box),
+                                half_width.item(box), half_height.item(box)))
+                         for box in spatial.near(middle_x, middle_y, reach_x, reach_y)]
+            elif boxes is None:
+                boxes = list(enumerate(zip(center_x.tolist(), center_y.tolist(),
+                                           half_width.tolist(), half_height.tolist())))
+            first = None
+            first_t = math.inf
+            for box, (x, y, half_w, half_h) in boxes:
+                if not (abs(middle_x - x) < reach_x + half_w and
+                        abs(middle_y - y) < reach_y + half_h):
+                    continue
+                t = segment_box_entry_scalar(start_x - x, start_y - y, dx, dy,
+                                             half_w, half_h, radius)
+                # Кандидаты из сетки идут не по порядку: при равном t
+                # побеждает меньший индекс, как в sweeps()
+                if t < first_t or (t == first_t and first is not None and box < first):
+                    first = box
+                    first_t = t
+            if first is not None:
+                hit_bullets.append(slot)
+                hit_boxes.append(first)
+                hit_t.append(first_t)
+        if not hit_bullets:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty, np.empty(0)
+        return (np.array(hit_bullets, dtype=np.intp), np.array(hit_boxes, dtype=np.intp),
+                np.array(hit_t, dtype=np.float64))
+
+    def draw(self, view=None, alpha=1.0):
+        n = self.count
+        mask = self.alive[:n]
+        x = self.x[:n]
+        y = self.y[:n]
+        if alpha < 1.0:
+            # Между тиками пуля рисуется на доле alpha пути последнего тика
+            x = x - self.change_x[:n] * (1.0 - alpha)
+            y = y - self.change_y[:n] * (1.0 - alpha)
+        if view is not None:
+            # Пули за пределами экрана (left, bottom, right, top) не рисуются
+            left, bottom, right, top = view
+            r = self.radius[:n]
+            mask = mask & (x + r >= left) & (x - r <= right) & \
+                (y + r >= bottom) & (y - r <= top)
+        self.renderer.draw(x, y, self.radius[:n], self.color[:n], mask)
 
 
 class Tank(arcade.Sprite):
-    def __init__(self, sprite_file, scale=1.0, health=3):
-        super().__init__(sprite_file, scale)
+    def __init__(self, kind, health=3):
+        textures_by_direction, scale = get_tank_textures(kind)
+        super().__init__(scale=scale, texture=textures_by_direction["UP"])
+        self.collision_half = None
+        self.textures_by_direction = None
+        self.reset_tank(kind, health)
+
+    def reset_tank(self, kind, health=3):
+        # Словарь текстур общий для всех танков одного вида, его не меняем
+        textures_by_direction, scale = get_tank_textures(kind)
+        if textures_by_direction is not self.textures_by_direction:
+            # Танк из пула мог быть другого вида: меняем вид целиком
+            texture = textures_by_direction["UP"]
+            self.scale = scale
+            self.texture = texture
+            self.set_hit_box(texture.hit_box_points)
+            self.collision_half = None
+            self.textures_by_direction = textures_by_direction
+        if self.angle != 0:
+            self.angle = 0
         self.direction = "UP"
         self.health = health
         self.max_health = health
@@ -135,7 +1763,8 @@ class Tank(arcade.Sprite):
         self.shoot_delay = 15
         self.speed_multiplier = 1.0
         self.damage_multiplier = 1.0
-        self.textures_by_direction = {}
+        # Сколько кадров проходит за тик симуляции
+        self.frame_step = 1
         self.load_directional_textures()
 
     def load_directional_textures(self):
@@ -143,17 +1772,23 @@ class Tank(arcade.Sprite):
             self.texture = self.textures_by_direction[self.direction]
 
     def update_direction_texture(self):
-        if self.direction in self.textures_by_direction:
-            self.texture = self.textures_by_direction[self.direction]
+        # Сеттеры спрайта дорогие: трогаем их, только когда что-то изменилось
+        texture = self.textures_by_direction.get(self.direction)
+        if texture is not None and texture is not self.texture:
+            self.texture = texture
 
         if self.direction == "UP":
-            self.angle = 0
+            angle = 0
         elif self.direction == "RIGHT":
-            self.angle = 90
+            angle = 90
         elif self.direction == "DOWN":
-            self.angle = 180
+            angle = 180
         elif self.direction == "LEFT":
-            self.angle = 270
+            angle = 270
+        else:
+            return
+        if self.angle != angle:
+            self.angle = angle
 
     def can_shoot(self):
         return self.shoot_cooldown <= 0
@@ -165,96 +1800,60 @@ class Tank(arcade.Sprite):
 
     def update(self):
         if self.shoot_cooldown > 0:
-            self.shoot_cooldown -= 1
+            self.shoot_cooldown -= self.frame_step
         self.update_direction_texture()
 
-    def check_obstacle_collision(self, new_x, new_y, obstacle_list):
-        old_x = self.center_x
-        old_y = self.center_y
-        self.center_x = new_x
-        self.center_y = new_y
-        collision = arcade.check_for_collision_with_list(self, obstacle_list)
-        self.center_x = old_x
-        self.center_y = old_y
-        return collision
-
-    def move_with_collision(self, dx, dy, obstacle_list):
+    def get_collision_half(self):
+        # Полуразмер хитбокса танка - по нему выбирается слой сетки препятствий
+        if self.collision_half is None:
+            points = self.get_hit_box()
+            self.collision_half = round(
+                max(max(abs(x), abs(y)) for x, y in points) * self.scale
+            )
+        return self.collision_half
+
+    def is_blocked(self, x, y, obstacle_grid):
+        return obstacle_grid.is_blocked(self.get_collision_half(), x, y)
+
+    def move_with_collision(self, dx, dy, obstacle_grid):
+        half = self.get_collision_half()
         # Проверяем по X
-        new_x = self.center_x + dx
-        if not self.check_obstacle_collision(new_x, self.center_y, obstacle_list):
-            self.center_x = new_x
-        else:
-            step = 1 if dx > 0 else -1
-            for i in range(1, int(abs(dx)) + 1):
-                test_x = self.center_x + step
-                if not self.check_obstacle_collision(test_x, self.center_y, obstacle_list):
-                    self.center_x = test_x
-                else:
-                    break
+        if dx:
+            self.center_x += obstacle_grid.max_shift_x(
+                half, self.center_x, self.center_y, dx
+            )
 
         # Проверяем по Y
-        new_y = self.center_y + dy
-        if not self.check_obstacle_collision(self.center_x, new_y, obstacle_list):
-            self.center_y = new_y
-        else:
-            step = 1 if dy > 0 else -1
-            for i in range(1, int(abs(dy)) + 1):
-                test_y = self.center_y + step
-                if not self.check_obstacle_collision(self.center_x, test_y, obstacle_list):
-                    self.center_y = test_y
-                else:
-                    break
+        if dy:
+            self.center_y += obstacle_grid.max_shift_y(
+                half, self.center_x, self.center_y, dy
+            )
 
-    def shoot(self, bullet_list, bullet_color, bullet_radius=8):
+    def shoot(self, bullets, bullet_color, bullet_radius=8, owner=OWNER_PLAYER):
         if self.can_shoot():
             damage = int(1 * self.damage_multiplier)
-            bullet = Bullet(bullet_radius, bullet_color, damage)
-            bullet.center_x = self.center_x
-            bullet.center_y = self.center_y
+            change_x = 0
+            change_y = 0
+            speed = BULLET_SPEED * self.frame_step
 
             if self.direction == "UP":
-                bullet.change_x = 0
-                bullet.change_y = BULLET_SPEED
+                change_y = speed
             elif self.direction == "DOWN":
-                bullet.change_x = 0
-                bullet.change_y = -BULLET_SPEED
+                change_y = -speed
             elif self.direction == "LEFT":
-                bullet.change_x = -BULLET_SPEED
-                bullet.change_y = 0
+                change_x = -speed
             elif self.direction == "RIGHT":
-                bullet.change_x = BULLET_SPEED
-                bullet.change_y = 0
+                change_x = speed
 
-            bullet_list.append(bullet)
+            bullets.spawn(self.center_x, self.center_y, change_x, change_y,
+                          bullet_radius, damage, owner, bullet_color)
             self.shoot_cooldown = self.shoot_delay
             return True
         return False
 
-    def draw_health_bar(self):
-        health_width = self.width
-        health_height = 6
-        health_ratio = self.health / self.max_health
-
-        left = self.center_x - health_width / 2
-        right = self.center_x + health_width / 2
-        bottom = self.center_y + self.height / 2 + 5
-        top = bottom + health_height
-
-        arcade.draw_lrbt_rectangle_filled(
-            left, right, bottom, top, arcade.color.BLACK
-        )
-
-        if health_ratio > 0:
-            right_health = left + health_width * health_ratio
-            arcade.draw_lrbt_rectangle_filled(
-                left, right_health, bottom, top, arcade.color.LIME_GREEN
-            )
-
 
 class PlayerTank(Tank):
     def __init__(self, difficulty=Difficulty.NORMAL):
-        sprite_path = os.path.join("images", "player_tank.png")
-
         # Настройки здоровья в зависимости от сложности
         if difficulty == Difficulty.EASY:
             health = 10
@@ -263,68 +1862,313 @@ class PlayerTank(Tank):
         else:  # HARD
             health = 3
 
-        if os.path.exists(sprite_path):
-            super().__init__(sprite_path, scale=0.5, health=health)
-        else:
-            super().__init__(None, scale=1.0, health=health)
-            self.texture = arcade.make_soft_square_texture(40, (0, 255, 255), 255, 255)
-
-        self.textures_by_direction = {
-            "UP": self.texture,
-            "DOWN": self.texture,
-            "LEFT": self.texture,
-            "RIGHT": self.texture
-        }
+        super().__init__("player", health=health)
+        # Оставшееся время действия улучшений в кадрах
+        self.speed_timer = 0
+        self.damage_timer = 0
+        self.fire_rate_timer = 0
+
+
+def tank_collision_half(kind):
+    # То же, что Tank.get_collision_half, но без спрайта - по реестру текстур
+    textures_by_direction, scale = get_tank_textures(kind)
+    points = textures_by_direction["UP"].hit_box_points
+    return round(max(max(abs(x), abs(y)) for x, y in points) * scale)
+
+
+class FlowField:
+    # Общее для всех врагов поле направлений к игрокам: поиск в ширину
+    # сразу от клеток всех игроков по клеткам FLOW_CELL, где проходит танк
+    # полуразмера half, - каждая клетка ведёт к ближайшему. Пересчитывается,
+    # только когда кто-то из игроков отходит от цели дальше FLOW_STALE
+    # клеток или меняются препятствия; враг берёт направление из своей
+    # клетки за O(1), поэтому цена не растёт с числом врагов.
+    def __init__(self, grid, half, align=FLOW_ALIGN):
+        self.grid = grid
+        self.half = half
+        # Точность выравнивания не меньше половины шага танка за тик,
+        # иначе он качается вокруг центра клетки
+        self.align = align
+        self.goal = None
+        self.version = None
+        # Поле покрывает окно мира вокруг игроков: клетки column0..column1,
+        # row0..row1 (правая и верхняя не включаются)
+        self.column0 = self.row0 = 0
+        self.direction = np.full((0, 0), -1, dtype=np.int8)
+        self.open = np.zeros((0, 0), dtype=bool)
+        self.updates = 0
+
+    def update(self, points):
+        # points - позиции игроков (x, y)
+        grid = self.grid
+        goal = [(int(x // FLOW_CELL), int(y // FLOW_CELL)) for x, y in points]
+        if (grid.version == self.version and self.goal is not None and
+                len(goal) == len(self.goal) and
+                all(abs(column - old_column) <= FLOW_STALE and abs(row - old_row) <= FLOW_STALE
+                    for (column, row), (old_column, old_row) in zip(goal, self.goal))):
+            return
+        self.goal = goal
+        self.version = grid.version
+        self.updates += 1
+
+        columns = -(-grid.width // FLOW_CELL)
+        rows = -(-grid.height // FLOW_CELL)
+        self.column0 = max(0, min(column for column, _ in goal) - FLOW_RANGE_X // FLOW_CELL)
+        self.row0 = max(0, min(row for _, row in goal) - FLOW_RANGE_Y // FLOW_CELL)
+        column1 = min(columns, max(column for column, _ in goal) + FLOW_RANGE_X // FLOW_CELL + 1)
+        row1 = min(rows, max(row for _, row in goal) + FLOW_RANGE_Y // FLOW_CELL + 1)
+        passable = self.passable(self.column0, self.row0, column1, row1)
+        distance = self.distances(passable, [(column - self.column0, row - self.row0)
+                                             for column, row in goal])
+        self.open = distance >= 0
+
+        # В каждой клетке - шаг к соседу, который ближе к игроку. Клетки,
+        # где крупный танк не помещается, ведут к соседней открытой
+        far = np.where(distance < 0, np.inf, distance)
+        padded = np.pad(far, 1, constant_values=np.inf)
+        neighbours = np.stack((padded[2:, 1:-1], padded[1:-1, 2:],
+                               padded[:-2, 1:-1], padded[1:-1, :-2]))
+        best = neighbours.argmin(axis=0)
+        closer = neighbours.min(axis=0) < far
+        self.direction = np.where(closer, best, -1).astype(np.int8)
+        self.direction[(distance >= 0) & (distance <= FLOW_STOP)] = FLOW_HOLD
+
+    def passable(self, column0, row0, column1, row1):
+        # Клетка проходима, если танк с центром в её центре не задевает
+        # препятствий. Покрытие считается разностным массивом: по четыре
+        # отметки на препятствие и две кумулятивные суммы
+        grid = self.grid
+        columns = column1 - column0
+        rows = row1 - row0
+        alive = np.fromiter((obstacle is not None for obstacle in grid.obstacles),
+                            dtype=bool, count=len(grid.obstacles))
+        x, y, half_width, half_height = grid.boxes[:len(alive)][alive].T
+        reach_x = half_width + self.half
+        reach_y = half_height + self.half
+        # Касание не считается столкновением, поэтому границы не включаются
+        c0 = (np.floor((x - reach_x) / FLOW_CELL - 0.5) + 1).astype(np.intp) - column0
+        c1 = (np.ceil((x + reach_x) / FLOW_CELL - 0.5) - 1).astype(np.intp) - column0
+        r0 = (np.floor((y - reach_y) / FLOW_CELL - 0.5) + 1).astype(np.intp) - row0
+        r1 = (np.ceil((y + reach_y) / FLOW_CELL - 0.5) - 1).astype(np.intp) - row0
+        np.clip(c0, 0, columns, out=c0)
+        np.clip(c1, -1, columns - 1, out=c1)
+        np.clip(r0, 0, rows, out=r0)
+        np.clip(r1, -1, rows - 1, out=r1)
+        inside = (c0 <= c1) & (r0 <= r1)
+        c0, c1, r0, r1 = c0[inside], c1[inside] + 1, r0[inside], r1[inside] + 1
+        cover = np.zeros((rows + 1, columns + 1), dtype=np.int32)
+        np.add.at(cover, (r0, c0), 1)
+        np.add.at(cover, (r0, c1), -1)
+        np.add.at(cover, (r1, c0), -1)
+        np.add.at(cover, (r1, c1), 1)
+        passable = cover.cumsum(axis=0).cumsum(axis=1)[:rows, :columns] == 0
+
+        # Танки не выезжают за 30 пикселей от края мира
+        center_x = (np.arange(column0, column1) + 0.5) * FLOW_CELL
+        center_y = (np.arange(row0, row1) + 0.5) * FLOW_CELL
+        passable[:, (center_x < 30) | (center_x > grid.width - 30)] = False
+        passable[(center_y < 30) | (center_y > grid.height - 30)] = False
+        return passable
+
+    def distances(self, passable, goals):
+        # Поиск в ширину по плоскому списку с рамкой из непроходимых клеток:
+        # на таких размерах он быстрее волны по массивам NumPy.
+        # Если игрок стоит у стены там, где крупный танк не помещается,
+        # поиск начинается с открытых клеток вокруг него
+        rows, columns = passable.shape
+        stride = columns + 2
+        padded = np.zeros((rows + 2, stride), dtype=bool)
+        padded[1:-1, 1:-1] = passable
+        free = padded.ravel().tolist()
+        distance = [-1] * len(free)
+        queue = []
+        for column, row in goals:
+            start = len(queue)
+            for radius in range(3):
+                for near_row in range(row - radius, row + radius + 1):
+                    for near_column in range(column - radius, column + radius + 1):
+                        cell = (near_row + 1) * stride + near_column + 1
+                        if (0 <= near_row < rows and 0 <= near_column < columns and
+                                free[cell] and distance[cell] < 0):
+                            distance[cell] = 0
+                            queue.append(cell)
+                if len(queue) > start:
+                    break
+        offsets = (1, -1, stride, -stride)
+        for cell in queue:
+            step = distance[cell] + 1
+            for offset in offsets:
+                near = cell + offset
+                if free[near] and distance[near] < 0:
+                    distance[near] = step
+                    queue.append(near)
+        return np.array(distance, dtype=np.int32).reshape(rows + 2, stride)[1:-1, 1:-1]
+
+    def to_bytes(self):
+        # Поле пишется в снимок матча целиком: пересчитать его при загрузке
+        # дорого, и цели за FLOW_STALE клеток дали бы другое поле
+        if self.goal is None:
+            return STATE_FLOW.pack(0, 0, 0, 0, 0, 0)
+        flags = STATE_FLOW_BUILT
+        if self.version == self.grid.version:
+            flags |= STATE_FLOW_CURRENT
+        rows, columns = self.direction.shape
+        goal = [value for point in self.goal for value in point]
+        return b"".join((STATE_FLOW.pack(flags, self.column0, self.row0, rows, columns,
+                                         len(self.goal)),
+                         struct.pack(f"<{len(goal)}i", *goal),
+                         self.direction.tobytes(), self.open.tobytes()))
+
+    def restore(self, data, offset):
+        # Вызывается после препятствий: поле, построенное по тем же
+        # препятствиям, что в снимке, не пересчитывается
+        flags, self.column0, self.row0, rows, columns, count = \
+            STATE_FLOW.unpack_from(data, offset)
+        offset += STATE_FLOW.size
+        goal = struct.unpack_from(f"<{2 * count}i", data, offset)
+        offset += 8 * count
+        cells = rows * columns
+        self.direction = np.frombuffer(data, dtype=np.int8, count=cells,
+                                       offset=offset).reshape(rows, columns).copy()
+        offset += cells
+        self.open = np.frombuffer(data, dtype=bool, count=cells,
+                                  offset=offset).reshape(rows, columns).copy()
+        offset += cells
+        self.goal = list(zip(goal[::2], goal[1::2])) if flags & STATE_FLOW_BUILT else None
+        self.version = self.grid.version if flags & STATE_FLOW_CURRENT else None
+        return offset
+
+    def steer(self, x, y):
+        # Направление для танка в точке (x, y): номер из DIRECTIONS,
+        # FLOW_HOLD или -1, если точка вне поля или пути нет
+        column = int(x // FLOW_CELL) - self.column0
+        row = int(y // FLOW_CELL) - self.row0
+        rows, columns = self.direction.shape
+        if not (0 <= column < columns and 0 <= row < rows):
+            return -1
+        move = self.direction.item(row, column)
+        if not self.open.item(row, column):
+            return move
+        # Перед поворотом танк выезжает на середину клетки: путь между
+        # центрами соседних клеток свободен, а из угла клетки - не всегда
+        if move == 0 or move == 2:
+            offset = x - (column + self.column0 + 0.5) * FLOW_CELL
+            if abs(offset) > self.align:
+                return 3 if offset > 0 else 1
+        elif move == 1 or move == 3:
+            offset = y - (row + self.row0 + 0.5) * FLOW_CELL
+            if abs(offset) > self.align:
+                return 2 if offset > 0 else 0
+        return move
+
+    def steers(self, x, y):
+        # steer() сразу для массивов точек
+        column = np.floor(x / FLOW_CELL).astype(np.intp) - self.column0
+        row = np.floor(y / FLOW_CELL).astype(np.intp) - self.row0
+        rows, columns = self.direction.shape
+        inside = (column >= 0) & (column < columns) & (row >= 0) & (row < rows)
+        move = np.full(len(x), -1, dtype=np.int8)
+        move[inside] = self.direction[row[inside], column[inside]]
+        open_cell = np.zeros(len(x), dtype=bool)
+        open_cell[inside] = self.open[row[inside], column[inside]]
+        offset_x = x - (column + self.column0 + 0.5) * FLOW_CELL
+        offset_y = y - (row + self.row0 + 0.5) * FLOW_CELL
+        vertical = (open_cell & ((move == 0) | (move == 2)) &
+                    (np.abs(offset_x) > self.align))
+        horizontal = (open_cell & ((move == 1) | (move == 3)) &
+                      (np.abs(offset_y) > self.align))
+        move[vertical] = np.where(offset_x[vertical] > 0, 3, 1)
+        move[horizontal] = np.where(offset_y[horizontal] > 0, 2, 0)
+        return move
+
+
+class PlayerSight:
+    # Видит ли враг игрока (target_x, target_y). Луч пускается из центра
+    # клетки SIGHT_CELL, где стоит враг, и зависит только от этой клетки,
+    # цели и препятствий. Поэтому он запоминается, пока игроки стоят на месте
+    # и препятствия не менялись: враги в одной клетке, повторные попытки
+    # выстрела и враги, вернувшиеся в клетку в следующих тиках, лучей не пускают.
+    def __init__(self, grid):
+        self.grid = grid
+        self.cache = {}
+        self.targets = None
+        self.version = None
+        self.queries = 0
+        self.rays = 0
+
+    def update(self, targets):
+        # targets - позиции игроков (x, y)
+        if targets == self.targets and self.grid.version == self.version:
+            return
+        # Игроки сдвинулись или препятствия изменились - прошлые лучи не годятся
+        self.targets = targets
+        self.version = self.grid.version
+        self.cache.clear()
+
+    def visible(self, x, y, target_x, target_y):
+        self.queries += 1
+        key = (int(x // SIGHT_CELL), int(y // SIGHT_CELL), target_x, target_y)
+        seen = self.cache.get(key)
+        if seen is None:
+            self.rays += 1
+            seen = self.grid.line_of_sight((key[0] + 0.5) * SIGHT_CELL,
+                                           (key[1] + 0.5) * SIGHT_CELL,
+                                           target_x, target_y)
+            self.cache[key] = seen
+        return seen
 
 
 class EnemyTank(Tank):
-    def __init__(self, player_tank, enemy_type="normal"):
+    def __init__(self, player_tank, enemy_type="normal", rng=random):
+        super().__init__(enemy_type)
+        self.pool = None
+        self.reset(player_tank, enemy_type, rng)
+
+    def reset(self, player_tank, enemy_type="normal", rng=random):
         self.enemy_type = enemy_type
+        self.rng = rng
 
         if enemy_type == "normal":
-            sprite_path = os.path.join("images", "enemy_normal.png")
-            scale = 0.5
             health = 2
             self.speed_multiplier = 1.0
         elif enemy_type == "fast":
-            sprite_path = os.path.join("images", "enemy_fast.png")
-            scale = 0.45
             health = 1
             self.speed_multiplier = 2.0
         elif enemy_type == "heavy":
-            sprite_path = os.path.join("images", "enemy_heavy.png")
-            scale = 0.6
             health = 5
             self.speed_multiplier = 0.5
             self.damage_multiplier = 2.0
 
-        if os.path.exists(sprite_path):
-            super().__init__(sprite_path, scale=scale, health=health)
-        else:
-            super().__init__(None, scale=1.0, health=health)
-            if enemy_type == "normal":
-                color = (255, 140, 0)
-                size = 40
-            elif enemy_type == "fast":
-                color = (50, 205, 50)
-                size = 35
-            else:  # heavy
-                color = (138, 43, 226)
-                size = 50
-            self.texture = arcade.make_soft_square_texture(size, color, 255, 255)
+        self.reset_tank(enemy_type, health)
 
         self.player = player_tank
-        self.shoot_timer = random.randint(30, ENEMY_SHOOT_INTERVAL)
-        self.direction = random.choice(["UP", "DOWN", "LEFT", "RIGHT"])
-        self.change_direction_timer = random.randint(30, 90)
-        self.obstacle_list = None
-
-        self.textures_by_direction = {
-            "UP": self.texture,
-            "DOWN": self.texture,
-            "LEFT": self.texture,
-            "RIGHT": self.texture
-        }
+        self.shoot_timer = rng.randint(30, ENEMY_SHOOT_INTERVAL)
+        self.direction = rng.choice(["UP", "DOWN", "LEFT", "RIGHT"])
+        self.change_direction_timer = rng.randint(30, 90)
+        self.obstacle_grid = None
+        self.bullets = None
+        self.world_width = SCREEN_WIDTH
+        self.world_height = SCREEN_HEIGHT
+        self.movement = "wander"
+        self.flow = None
+        self.sight = None
+        self.ai_slot = None
+
+    def bullet_style(self):
+        if self.enemy_type == "normal":
+            return (255, 140, 0), 8
+        elif self.enemy_type == "fast":
+            return (0, 255, 0), 6
+        else:  # heavy
+            return (255, 0, 255), 12
+
+    def shoot_interval(self):
+        if self.enemy_type == "fast":
+            return ENEMY_SHOOT_INTERVAL // 2
+        elif self.enemy_type == "heavy":
+            return ENEMY_SHOOT_INTERVAL * 2
+        else:
+            return ENEMY_SHOOT_INTERVAL
 
     def update(self):
         super().update()
@@ -332,12 +2176,21 @@ class EnemyTank(Tank):
             return
 
         original_direction = self.direction
-        self.change_direction_timer -= 1
-        if self.change_direction_timer <= 0:
-            self.direction = random.choice(["UP", "DOWN", "LEFT", "RIGHT"])
-            self.change_direction_timer = random.randint(30, 90)
+        speed = ENEMY_SPEED * self.speed_multiplier * self.frame_step
+        move = -1
+        if self.movement == "chase" and self.flow is not None:
+            # Вне поля (далеко от игрока или без пути к нему) - блуждание
+            move = self.flow.steer(self.center_x, self.center_y)
+        if move == FLOW_HOLD:
+            speed = 0
+        elif move >= 0:
+            self.direction = DIRECTIONS[move]
+        else:
+            self.change_direction_timer -= self.frame_step
+            if self.change_direction_timer <= 0:
+                self.direction = self.rng.choice(["UP", "DOWN", "LEFT", "RIGHT"])
+                self.change_direction_timer = self.rng.randint(30, 90)
 
-        speed = ENEMY_SPEED * self.speed_multiplier
         dx, dy = 0, 0
 
         if self.direction == "UP":
@@ -349,16 +2202,21 @@ class EnemyTank(Tank):
         elif self.direction == "RIGHT":
             dx = speed
 
-        if self.obstacle_list:
-            self.move_with_collision(dx, dy, self.obstacle_list)
+        if self.obstacle_grid:
+            self.move_with_collision(dx, dy, self.obstacle_grid)
         else:
             self.center_x += dx
             self.center_y += dy
 
-        self.center_x = max(30, min(SCREEN_WIDTH - 30, self.center_x))
-        self.center_y = max(30, min(SCREEN_HEIGHT - 30, self.center_y))
+        self.center_x = max(30, min(self.world_width - 30, self.center_x))
+        self.center_y = max(30, min(self.world_height - 30, self.center_y))
 
-        self.shoot_timer -= 1
+        self.shoot_timer -= self.frame_step
+        # Без линии видимости враг не стреляет и пробует снова через SIGHT_RETRY
+        if (self.shoot_timer <= 0 and self.player.is_alive and self.sight is not None and
+                not self.sight.visible(self.center_x, self.center_y,
+                                       self.player.center_x, self.player.center_y)):
+            self.shoot_timer = SIGHT_RETRY
         if self.shoot_timer <= 0 and self.player.is_alive:
             dx_to_player = self.player.center_x - self.center_x
             dy_to_player = self.player.center_y - self.center_y
@@ -368,64 +2226,1931 @@ class EnemyTank(Tank):
             else:
                 self.direction = "UP" if dy_to_player > 0 else "DOWN"
 
-            if self.enemy_type == "normal":
-                bullet_color = (255, 140, 0)
-                bullet_size = 8
-            elif self.enemy_type == "fast":
-                bullet_color = (0, 255, 0)
-                bullet_size = 6
-            else:  # heavy
-                bullet_color = (255, 0, 255)
-                bullet_size = 12
-
-            super().shoot(self.enemy_bullet_list, bullet_color, bullet_size)
-
-            if self.enemy_type == "fast":
-                self.shoot_timer = ENEMY_SHOOT_INTERVAL // 2
-            elif self.enemy_type == "heavy":
-                self.shoot_timer = ENEMY_SHOOT_INTERVAL * 2
-            else:
-                self.shoot_timer = ENEMY_SHOOT_INTERVAL
+            bullet_color, bullet_size = self.bullet_style()
+            super().shoot(self.bullets, bullet_color, bullet_size, OWNER_ENEMY)
+            self.shoot_timer = self.shoot_interval()
 
             self.direction = original_direction
 
 
-class PowerUp(arcade.SpriteCircle):
+class EnemyController:
+    # ИИ всех врагов одним проходом по массивам NumPy вместо update()
+    # у каждого спрайта. Массивы - источник истины для позиции, направления
+    # и таймеров; спрайты догоняют их в sync() перед отрисовкой.
+    def __init__(self, capacity=64, seed=None, frame_step=1):
+        self.rng = np.random.default_rng(seed)
+        # Кадров за тик: таймеры в кадрах, поэтому они дробные
+        self.frame_step = frame_step
+        self.enemies = []
+        # Полуразмеры танков, которые встречались: по ним идут слои сетки
+        self.sizes = set()
+        self.count = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.x = np.zeros(capacity, dtype=np.float64)
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.speed = np.zeros(capacity, dtype=np.float64)
+        self.half = np.zeros(capacity, dtype=np.int32)
+        self.direction = np.zeros(capacity, dtype=np.int8)
+        self.turn_timer = np.zeros(capacity, dtype=np.float64)
+        self.shoot_timer = np.zeros(capacity, dtype=np.float64)
+        self.shoot_interval = np.zeros(capacity, dtype=np.int32)
+        self.cooldown = np.zeros(capacity, dtype=np.float64)
+        self.shoot_delay = np.zeros(capacity, dtype=np.int32)
+        self.damage = np.zeros(capacity, dtype=np.int32)
+        self.bullet_radius = np.zeros(capacity, dtype=np.float64)
+        self.bullet_color = np.zeros((capacity, 3), dtype=np.uint8)
+        self.chase = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        # Что последний раз записано в спрайт
+        self.synced_x = np.zeros(capacity, dtype=np.float64)
+        self.synced_y = np.zeros(capacity, dtype=np.float64)
+        self.synced_direction = np.zeros(capacity, dtype=np.int8)
+
+    def arrays(self):
+        return (self.x, self.y, self.speed, self.half, self.direction,
+                self.turn_timer, self.shoot_timer, self.shoot_interval,
+                self.cooldown, self.shoot_delay, self.damage,
+                self.bullet_radius, self.bullet_color, self.chase, self.alive,
+                self.synced_x, self.synced_y, self.synced_direction)
+
+    def grow(self):
+        old = self.arrays()
+        self.allocate(len(self.x) * 2)
+        for new, array in zip(self.arrays(), old):
+            new[:len(array)] = array
+
+    def clear(self, seed=None):
+        self.enemies = []
+        self.alive[:self.count] = False
+        self.count = 0
+        if seed is not None:
+            self.rng = np.random.default_rng(seed)
+
+    def add(self, enemy):
+        if self.count == len(self.x):
+            self.grow()
+        i = self.count
+        self.x[i] = self.synced_x[i] = enemy.center_x
+        self.y[i] = self.synced_y[i] = enemy.center_y
+        self.speed[i] = ENEMY_SPEED * enemy.speed_multiplier * self.frame_step
+        self.half[i] = enemy.get_collision_half()
+        self.sizes.add(self.half[i].item())
+        self.direction[i] = self.synced_direction[i] = DIRECTIONS.index(enemy.direction)
+        self.turn_timer[i] = enemy.change_direction_timer
+        self.shoot_timer[i] = enemy.shoot_timer
+        self.shoot_interval[i] = enemy.shoot_interval()
+        self.cooldown[i] = enemy.shoot_cooldown
+        self.shoot_delay[i] = enemy.shoot_delay
+        self.damage[i] = int(1 * enemy.damage_multiplier)
+        color, radius = enemy.bullet_style()
+        self.bullet_color[i] = color
+        self.bullet_radius[i] = radius
+        self.chase[i] = enemy.movement == "chase"
+        self.alive[i] = True
+        enemy.ai_slot = i
+        self.enemies.append(enemy)
+        self.count += 1
+
+    def remove(self, enemy):
+        # Слот освобождается в compact() в начале следующего update()
+        self.sync_one(enemy.ai_slot)
+        self.alive[enemy.ai_slot] = False
+
+    def compact(self):
+        n = self.count
+        keep = self.alive[:n].nonzero()[0]
+        if len(keep) == n:
+            return
+        for array in self.arrays():
+            array[:len(keep)] = array[keep]
+        self.alive[len(keep):n] = False
+        self.enemies = [self.enemies[i] for i in keep]
+        for i, enemy in enumerate(self.enemies):
+            enemy.ai_slot = i
+        self.count = len(keep)
+
+    def boxes(self):
+        # Враги и их хитбоксы в виде массивов для BulletSystem.hits
+        n = self.count
+        half = self.half[:n].astype(np.float64)
+        return self.enemies, (self.x[:n], self.y[:n], half, half)
+
+    def update(self, players, obstacle_grid, bullets, flow=None, sight=None):
+        # players - живые игроки; каждый враг стреляет в ближайшего
+        self.compact()
+        n = self.count
+        if n == 0:
+            return
+        x = self.x[:n]
+        y = self.y[:n]
+        direction = self.direction[:n]
+
+        frame_step = self.frame_step
+        cooldown = self.cooldown[:n]
+        cooldown -= (cooldown > 0) * frame_step
+
+        # Преследователи берут направление из поля; кто вне поля,
+        # в этот тик блуждает вместе с "wander"
+        move = np.full(n, -1, dtype=np.int8)
+        chasers = self.chase[:n].nonzero()[0]
+        if flow is not None and len(chasers):
+            move[chasers] = flow.steers(x[chasers], y[chasers])
+        wander = move < 0
+        holding = move == FLOW_HOLD
+        following = (move >= 0) & ~holding
+        direction[following] = move[following]
+
+        turn_timer = self.turn_timer[:n]
+        turn_timer -= wander * frame_step
+        turning = ((turn_timer <= 0) & wander).nonzero()[0]
+        if len(turning):
+            direction[turning] = self.rng.integers(0, 4, len(turning))
+            turn_timer[turning] = self.rng.integers(30, 91, len(turning))
+
+        # Движение: столкновения с препятствиями решаются по слою сетки
+        # для каждого размера танка, сначала по X, потом по Y
+        step = DIRECTION_VECTORS[direction] * self.speed[:n, None]
+        step[holding] = 0
+        half = self.half[:n]
+        for size in self.sizes:
+            group = (half == size).nonzero()[0]
+            if len(group) == 0:
+                continue
+            x[group] += obstacle_grid.max_shifts_x(size, x[group], y[group],
+                                                   step[group, 0])
+            y[group] += obstacle_grid.max_shifts_y(size, x[group], y[group],
+                                                   step[group, 1])
+        np.clip(x, 30, obstacle_grid.width - 30, out=x)
+        np.clip(y, 30, obstacle_grid.height - 30, out=y)
+
+        shoot_timer = self.shoot_timer[:n]
+        shoot_timer -= frame_step
+        if not players:
+            return
+        firing = (shoot_timer <= 0).nonzero()[0]
+        if len(firing) == 0:
+            return
+        if len(players) == 1:
+            target_x = np.full(len(firing), players[0].center_x)
+            target_y = np.full(len(firing), players[0].center_y)
+        else:
+            player_x = np.array([player.center_x for player in players])
+            player_y = np.array([player.center_y for player in players])
+            nearest = ((player_x - x[firing, None]) ** 2 +
+                       (player_y - y[firing, None]) ** 2).argmin(axis=1)
+            target_x = player_x[nearest]
+            target_y = player_y[nearest]
+        if sight is not None:
+            # Кто не видит игрока, пробует снова через SIGHT_RETRY. Стреляющих
+            # в тике немного, лучи пускаются по одному через кэш sight
+            clear = np.array([sight.visible(*point) for point in
+                              zip(x[firing].tolist(), y[firing].tolist(),
+                                  target_x.tolist(), target_y.tolist())], dtype=bool)
+            shoot_timer[firing[~clear]] = SIGHT_RETRY
+            firing = firing[clear]
+            target_x = target_x[clear]
+            target_y = target_y[clear]
+            if len(firing) == 0:
+                return
+        # Стреляем в сторону игрока, направление движения не меняется
+        to_x = target_x - x[firing]
+        to_y = target_y - y[firing]
+        aim = np.where(np.abs(to_x) > np.abs(to_y),
+                       np.where(to_x > 0, 1, 3), np.where(to_y > 0, 0, 2))
+        ready = cooldown[firing] <= 0
+        shooters = firing[ready]
+        velocity = DIRECTION_VECTORS[aim[ready]] * (BULLET_SPEED * frame_step)
+        bullets.spawn_many(x[shooters], y[shooters], velocity[:, 0], velocity[:, 1],
+                           self.bullet_radius[shooters], self.damage[shooters],
+                           OWNER_ENEMY, self.bullet_color[shooters])
+        cooldown[shooters] = self.shoot_delay[shooters]
+        shoot_timer[firing] = self.shoot_interval[firing]
+
+    def sync_one(self, i):
+        enemy = self.enemies[i]
+        enemy.position = (self.x[i], self.y[i])
+        enemy.direction = DIRECTIONS[self.direction[i]]
+        enemy.update_direction_texture()
+        self.synced_x[i] = self.x[i]
+        self.synced_y[i] = self.y[i]
+        self.synced_direction[i] = self.direction[i]
+
+    def sync(self):
+        # Переносим в спрайты только то, что изменилось
+        n = self.count
+        moved = ((self.x[:n] != self.synced_x[:n]) |
+                 (self.y[:n] != self.synced_y[:n]) |
+                 (self.direction[:n] != self.synced_direction[:n]))
+        for i in (moved & self.alive[:n]).nonzero()[0]:
+            self.sync_one(i)
+
+
+POWERUP_COLORS = {
+    PowerUpType.HEALTH: arcade.color.LIME_GREEN,
+    PowerUpType.SPEED: arcade.color.SKY_BLUE,
+    PowerUpType.DAMAGE: arcade.color.RED_ORANGE,
+    PowerUpType.RAPID_FIRE: arcade.color.GOLD
+}
+powerup_textures = {}
+
+
+def get_powerup_texture(powerup_type):
+    texture = powerup_textures.get(powerup_type)
+    if texture is None:
+        texture = arcade.make_circle_texture(40, POWERUP_COLORS[powerup_type])
+        powerup_textures[powerup_type] = texture
+    return texture
+
+
+class PowerUp(arcade.Sprite):
     def __init__(self, powerup_type):
+        super().__init__(texture=get_powerup_texture(powerup_type))
+        self.pool = None
+        self.reset(powerup_type)
+
+    def reset(self, powerup_type):
+        # Улучшение из пула могло быть другого типа: меняем текстуру
+        texture = get_powerup_texture(powerup_type)
+        if texture is not self.texture:
+            self.texture = texture
+            self.set_hit_box(texture.hit_box_points)
         self.type = powerup_type
-        colors = {
-            PowerUpType.HEALTH: arcade.color.LIME_GREEN,
-            PowerUpType.SPEED: arcade.color.SKY_BLUE,
-            PowerUpType.DAMAGE: arcade.color.RED_ORANGE,
-            PowerUpType.RAPID_FIRE: arcade.color.GOLD
-        }
-        super().__init__(20, colors[powerup_type])
         self.lifetime = 300
+        self.frame_step = 1
 
     def update(self, delta_time=1 / 60):
-        self.lifetime -= 1
+        self.lifetime -= self.frame_step
         if self.lifetime <= 0:
-            self.remove_from_sprite_lists()
-
-
-class TankGame(arcade.Window):
-    def __init__(self):
-        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE)
+            release_sprite(self)
+
+
+class PlayerInput:
+    def __init__(self, left=False, right=False, up=False, down=False,
+                 aim_x=0, aim_y=0, fire=False):
+        self.left = left
+        self.right = right
+        self.up = up
+        self.down = down
+        self.aim_x = aim_x
+        self.aim_y = aim_y
+        self.fire = fire
+
+
+REPLAY_MAGIC = b"TNKR"
+REPLAY_VERSION = 8
+# magic, версия, сложность, флаги, зерно, число тиков, ширина и высота мира,
+# длина пути к файлу уровня (сам путь в UTF-8 идёт сразу за заголовком),
+# версия генератора арены, частота тиков. В версии 1 не было размера мира
+# (мир размером с экран), в версии 2 - уровня, до версии 4 арену строил
+# генератор 1.
+# С версии 5 в флагах биты REPLAY_WANDER << i: враги ENEMY_TYPES[i]
+# ездят случайно; раньше так ездили все. С версии 6 флаг REPLAY_SIGHT:
+# враги стреляют только при линии видимости, с версии 7 REPLAY_SWEPT:
+# попадания пуль ищутся вдоль пути. До версии 8 все матчи шли с частотой
+# TICK_RATE
+REPLAY_HEADERS = {
+    1: struct.Struct("<4sBBBQI"),
+    2: struct.Struct("<4sBBBQIHH"),
+    3: struct.Struct("<4sBBBQIHHH"),
+    4: struct.Struct("<4sBBBQIHHHB"),
+    5: struct.Struct("<4sBBBQIHHHB"),
+    6: struct.Struct("<4sBBBQIHHHB"),
+    7: struct.Struct("<4sBBBQIHHHB"),
+    8: struct.Struct("<4sBBBQIHHHBH"),
+}
+REPLAY_HEADER = REPLAY_HEADERS[REPLAY_VERSION]
+REPLAY_AIM = struct.Struct("<hh")
+REPLAY_BATCH_AI = 1
+REPLAY_ARENA_PER_WAVE = 2
+REPLAY_WANDER = 4
+REPLAY_SIGHT = REPLAY_WANDER << len(ENEMY_TYPES)
+REPLAY_SWEPT = REPLAY_SIGHT << 1
+REPLAY_DIR = "replays"
+
+
+def match_flags(batch_ai, arena_per_wave, enemy_movement, enemy_sight, swept_bullets):
+    # Флаги REPLAY_* настроек матча - общие для повторов и снимков
+    flags = ((REPLAY_BATCH_AI if batch_ai else 0) |
+             (REPLAY_ARENA_PER_WAVE if arena_per_wave else 0) |
+             (REPLAY_SIGHT if enemy_sight else 0) |
+             (REPLAY_SWEPT if swept_bullets else 0))
+    for i, kind in enumerate(ENEMY_TYPES):
+        if enemy_movement[kind] == "wander":
+            flags |= REPLAY_WANDER << i
+    return flags
+
+
+def flag_movement(flags):
+    return {kind: "wander" if flags & REPLAY_WANDER << i else "chase"
+            for i, kind in enumerate(ENEMY_TYPES)}
+
+
+class Replay:
+    # Запись матча: зерно симуляции и ввод игрока по тикам.
+    # Каждый тик кодируется изменением относительно предыдущего:
+    #   0b0AKKKKK - новые кнопки (K), при A=1 следом идёт прицел "<hh";
+    #   0b1NNNNNN - предыдущий ввод повторяется ещё N + 1 тиков.
+    # Минута игры без движения мыши занимает около 30 байт.
+    def __init__(self, seed, difficulty=Difficulty.NORMAL, batch_ai=False,
+                 world_width=SCREEN_WIDTH, world_height=SCREEN_HEIGHT, level=None,
+                 arena=ARENA_VERSION, arena_per_wave=False, enemy_movement=ENEMY_MOVEMENT,
+                 enemy_sight=True, swept_bullets=True, tick_rate=TICK_RATE):
+        self.seed = seed
+        self.tick_rate = tick_rate
+        self.enemy_movement = dict(enemy_movement)
+        self.enemy_sight = enemy_sight
+        self.swept_bullets = swept_bullets
+        self.difficulty = difficulty
+        self.batch_ai = batch_ai
+        self.world_width = world_width
+        self.world_height = world_height
+        self.level = level
+        self.arena = arena
+        self.arena_per_wave = arena_per_wave
+        self.data = bytearray()
+        self.ticks = 0
+        self.last_keys = None
+        self.last_aim = None
+        self.repeat = 0
+
+    def flush(self):
+        while self.repeat > 0:
+            run = min(self.repeat, 128)
+            self.data.append(0x80 | (run - 1))
+            self.repeat -= run
+
+    def record(self, inputs):
+        # Возвращает ввод в том виде, в каком его увидит воспроизведение:
+        # прицел хранится в целых пикселях
+        aim = (max(-32768, min(32767, round(inputs.aim_x))),
+               max(-32768, min(32767, round(inputs.aim_y))))
+        keys = (inputs.left | inputs.right << 1 | inputs.up << 2 |
+                inputs.down << 3 | inputs.fire << 4)
+        self.ticks += 1
+        if keys == self.last_keys and aim == self.last_aim:
+            self.repeat += 1
+        else:
+            self.flush()
+            if aim != self.last_aim:
+                self.data.append(keys | 0x20)
+                self.data += REPLAY_AIM.pack(*aim)
+            else:
+                self.data.append(keys)
+            self.last_keys = keys
+            self.last_aim = aim
+        return PlayerInput(inputs.left, inputs.right, inputs.up, inputs.down,
+                           aim[0], aim[1], inputs.fire)
+
+    def inputs(self):
+        data = self.data
+        i = 0
+        current = None
+        while i < len(data):
+            byte = data[i]
+            i += 1
+            if byte & 0x80:
+                for _ in range((byte & 0x7f) + 1):
+                    yield current
+                continue
+            if byte & 0x20:
+                aim = REPLAY_AIM.unpack_from(data, i)
+                i += REPLAY_AIM.size
+            current = PlayerInput(bool(byte & 1), bool(byte & 2), bool(byte & 4),
+                                  bool(byte & 8), aim[0], aim[1], bool(byte & 16))
+            yield current
+
+    def mark(self):
+        # Место в записи: после перемотки матча назад rewind() отрезает
+        # ввод, записанный с этого места
+        return len(self.data), self.ticks, self.last_keys, self.last_aim, self.repeat
+
+    def rewind(self, mark, data=None):
+        # data - копия записи до mark, если с тех пор повтор уже
+        # перематывался и ввод после этого места записан заново
+        size, self.ticks, self.last_keys, self.last_aim, self.repeat = mark
+        if data is not None:
+            self.data[:] = data
+        del self.data[size:]
+
+    def to_bytes(self):
+        self.flush()
+        flags = match_flags(self.batch_ai, self.arena_per_wave, self.enemy_movement,
+                            self.enemy_sight, self.swept_bullets)
+        level = self.level.encode() if self.level is not None else b""
+        header = REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION,
+                                    list(Difficulty).index(self.difficulty),
+                                    flags, self.seed, self.ticks,
+                                    self.world_width, self.world_height, len(level),
+                                    self.arena, self.tick_rate)
+        return header + level + bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        magic, version = struct.unpack_from("<4sB", blob)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("это не файл повтора")
+        header = REPLAY_HEADERS.get(version)
+        if header is None:
+            raise ValueError(f"неподдерживаемая версия повтора: {version}")
+        # Полей, которых в старой версии нет, - значения по умолчанию
+        fields = header.unpack_from(blob)
+        fields += (SCREEN_WIDTH, SCREEN_HEIGHT, 0, 1, TICK_RATE)[len(fields) - 6:]
+        (difficulty, flags, seed, ticks, world_width, world_height, level_size,
+         arena, tick_rate) = fields[2:]
+        start = header.size + level_size
+        level = blob[header.size:start].decode() if level_size else None
+        if version < 5:
+            flags |= ((1 << len(ENEMY_TYPES)) - 1) * REPLAY_WANDER
+        movement = flag_movement(flags)
+        replay = cls(seed, list(Difficulty)[difficulty],
+                     bool(flags & REPLAY_BATCH_AI), world_width, world_height, level,
+                     arena, bool(flags & REPLAY_ARENA_PER_WAVE), movement,
+                     bool(flags & REPLAY_SIGHT), bool(flags & REPLAY_SWEPT), tick_rate)
+        replay.data = bytearray(blob[start:])
+        replay.ticks = ticks
+        return replay
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.from_bytes(f.read())
+
+
+STATE_MAGIC = b"TNKS"
+STATE_VERSION = 2
+# Снимок матча (Simulation.save_state). Заголовок - настройки матча, как
+# в повторе: magic, версия, сложность, флаги REPLAY_*, зерно, ширина и
+# высота мира, длина пути к файлу уровня (путь идёт следом), генератор
+# арены, частота тиков. Дальше разделы STATE_* в порядке объявления,
+# записи одного раздела идут подряд
+STATE_HEADER = struct.Struct("<4sBBBQHHHBH")
+# Очки, волна, врагов в волне, таймер улучшений, последний сквозной номер,
+# тик, полученный и нанесённый урон, убито врагов
+STATE_MATCH = struct.Struct("<qIIdIIIII")
+# random.Random матча: 624 слова и позиция вихря Мерсенна, отложенное
+# значение gauss() (NaN - его нет)
+STATE_RANDOM = struct.Struct("<625Id")
+# Генератор пакетного ИИ (PCG64, только с batch_ai): состояние и
+# приращение по 128 бит, отложенные 32 бита
+STATE_NUMPY_RANDOM = struct.Struct("<QQQQBI")
+# Число игроков, врагов, разрушаемых препятствий и улучшений; номер
+# основного игрока; число слотов сетки препятствий
+STATE_COUNTS = struct.Struct("<HIIHHI")
+# x, y, направление, здоровье, его максимум, жив, перезарядка, задержка
+# выстрела, множители скорости и урона, таймеры улучшений
+STATE_PLAYER = struct.Struct("<ddBiiBdHddddd")
+# Сквозной номер, вид, x, y, направление, здоровье, его максимум,
+# множители скорости и урона, перезарядка, задержка выстрела, таймеры
+# выстрела и поворота, номер игрока-цели
+STATE_ENEMY = struct.Struct("<IBddBiidddHddH")
+# Пули: число и сколько выпущено за матч; дальше массивы BulletSystem
+STATE_BULLETS = struct.Struct("<Iq")
+# Разрушаемые препятствия по возрастанию слота в сетке: слот, x, y, ширина,
+# высота подряд для всех, затем прочность "<i" для всех. Неразрушаемые не
+# меняются весь матч, их ставит setup()
+STATE_OBSTACLE = np.dtype([("slot", "<u4"), ("x", "<f8"), ("y", "<f8"),
+                           ("width", "<u2"), ("height", "<u2")])
+# Сквозной номер, вид, x, y, оставшееся время
+STATE_POWERUP = struct.Struct("<IBddd")
+# Поле направлений (если есть преследователи): флаги STATE_FLOW_*, клетка
+# начала окна, его размер и число целей; следом цели "<ii" и по байту
+# на клетку направлений и открытых клеток
+STATE_FLOW = struct.Struct("<BiiHHH")
+STATE_FLOW_BUILT = 1
+STATE_FLOW_CURRENT = 2
+STATE_DIR = "saves"
+# Кольцо снимков TankGame для перемотки: снимок раз в REWIND_STEP секунд
+# матча, всего на REWIND_SECONDS назад; каждый AUTOSAVE_STEPS-й снимок
+# пишется на диск на случай сбоя
+REWIND_STEP = 0.1
+REWIND_SECONDS = 30
+AUTOSAVE_STEPS = 100
+UINT64 = (1 << 64) - 1
+
+
+def read_state_header(blob):
+    # Настройки матча из снимка - аргументы для Simulation
+    magic, version = struct.unpack_from("<4sB", blob)
+    if magic != STATE_MAGIC:
+        raise ValueError("это не снимок матча")
+    if version != STATE_VERSION:
+        raise ValueError(f"неподдерживаемая версия снимка: {version}")
+    (_, _, difficulty, flags, seed, world_width, world_height, level_size, arena,
+     tick_rate) = STATE_HEADER.unpack_from(blob)
+    level = None
+    if level_size:
+        level = bytes(blob[STATE_HEADER.size:STATE_HEADER.size + level_size]).decode()
+    return {"difficulty": list(Difficulty)[difficulty],
+            "batch_ai": bool(flags & REPLAY_BATCH_AI), "seed": seed,
+            "world_width": world_width, "world_height": world_height, "level": level,
+            "arena": arena, "arena_per_wave": bool(flags & REPLAY_ARENA_PER_WAVE),
+            "enemy_movement": flag_movement(flags),
+            "enemy_sight": bool(flags & REPLAY_SIGHT),
+            "swept_bullets": bool(flags & REPLAY_SWEPT), "tick_rate": tick_rate}
+
+
+def unpack_records(packer, data, offset, count):
+    end = offset + packer.size * count
+    return list(packer.iter_unpack(data[offset:end])), end
+
+
+def sprite_boxes(sprites, half_widths, half_heights):
+    # Центры и полуразмеры спрайтов в виде массивов для BulletSystem.hits
+    return (np.array([sprite.center_x for sprite in sprites], dtype=np.float64),
+            np.array([sprite.center_y for sprite in sprites], dtype=np.float64),
+            np.array(half_widths, dtype=np.float64),
+            np.array(half_heights, dtype=np.float64))
+
+
+# Фазы кадра для FrameTimer: сначала тик симуляции, потом отрисовка
+PHASES = ["input", "effects", "enemy_ai", "bullets", "hits_obstacles",
+          "hits_enemies", "hits_player", "powerups",
+          "draw_world", "draw_bullets", "draw_effects", "draw_health", "draw_hud"]
+(PHASE_INPUT, PHASE_EFFECTS, PHASE_ENEMY_AI, PHASE_BULLETS, PHASE_HITS_OBSTACLES,
+ PHASE_HITS_ENEMIES, PHASE_HITS_PLAYER, PHASE_POWERUPS, PHASE_DRAW_WORLD,
+ PHASE_DRAW_BULLETS, PHASE_DRAW_EFFECTS, PHASE_DRAW_HEALTH,
+ PHASE_DRAW_HUD) = range(len(PHASES))
+PHASE_COLORS = [
+    arcade.color.CYAN, arcade.color.ORANGE, arcade.color.RED, arcade.color.GOLD,
+    arcade.color.GRAY, arcade.color.MAGENTA, arcade.color.PINK,
+    arcade.color.LIME_GREEN, arcade.color.BLUE, arcade.color.YELLOW,
+    arcade.color.ORANGE_PEEL, arcade.color.GREEN, arcade.color.WHITE,
+]
+FRAME_TIMER_CAPACITY = 4096
+TIMINGS_DIR = "timings"
+
+
+class NullFrameTimer:
+    # Таймеры выключены: вместо замеров пустые методы, и в горячем цикле
+    # не остаётся ни time.perf_counter(), ни записи в буфер
+    frames = 0
+
+    def begin(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def next_frame(self):
+        pass
+
+
+NULL_FRAME_TIMER = NullFrameTimer()
+
+
+class FrameTimer:
+    # Время каждой фазы кадра в кольцевом буфере последних кадров.
+    # lap(phase) относит время с прошлой отметки к фазе, так что фаза
+    # может встречаться в кадре несколько раз. Время отрисовки - это
+    # время CPU на отправку команд, работа GPU идёт асинхронно
+    def __init__(self, capacity=FRAME_TIMER_CAPACITY):
+        self.samples = np.zeros((capacity, len(PHASES)), dtype=np.float64)
+        self.frames = 0
+        self.current = [0.0] * len(PHASES)
+        self.last = time.perf_counter()
+
+    def begin(self):
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.current[phase] += now - self.last
+        self.last = now
+
+    def next_frame(self):
+        self.samples[self.frames % len(self.samples)] = self.current
+        self.frames += 1
+        self.current = [0.0] * len(PHASES)
+
+    def recent(self, count=None):
+        # Последние завершённые кадры по порядку, в секундах
+        stored = min(self.frames, len(self.samples))
+        if count is not None:
+            stored = min(stored, count)
+        end = self.frames % len(self.samples)
+        index = np.arange(end - stored, end) % len(self.samples)
+        return self.samples[index]
+
+    def export(self, path):
+        # Формат выбирается по расширению: .json или .csv, время в мс
+        samples = self.recent() * 1000
+        first = self.frames - len(samples)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if path.endswith(".json"):
+            with open(path, "w") as f:
+                json.dump({"phases": PHASES, "first_frame": first,
+                           "frames_ms": np.round(samples, 4).tolist()}, f)
+        else:
+            with open(path, "w") as f:
+                f.write(",".join(["frame"] + PHASES + ["total"]) + "\n")
+                for i, row in enumerate(samples):
+                    values = ",".join(f"{value:.4f}" for value in row)
+                    f.write(f"{first + i},{values},{row.sum():.4f}\n")
+
+
+def tick_frames(tick_rate):
+    # Кадров по 1/FRAME_RATE секунды за тик. При 60 тиках - целое 1,
+    # и матч совпадает с записанным до частоты тиков
+    if FRAME_RATE % tick_rate:
+        return FRAME_RATE / tick_rate
+    return FRAME_RATE // tick_rate
+
+
+def drive_player(player, control, obstacle_grid, frame_step):
+    # Поворот к прицелу и движение танка игрока на один тик; False, если
+    # танк упёрся. Им же сетевой клиент предсказывает свой танк
+    dx = control.aim_x - player.center_x
+    dy = control.aim_y - player.center_y
+    angle = math.degrees(math.atan2(dy, dx))
+
+    if -45 <= angle <= 45:
+        player.direction = "RIGHT"
+    elif 45 < angle <= 135:
+        player.direction = "UP"
+    elif angle > 135 or angle < -135:
+        player.direction = "LEFT"
+    else:
+        player.direction = "DOWN"
+
+    new_x = player.center_x
+    new_y = player.center_y
+    speed = TANK_SPEED * player.speed_multiplier * frame_step
+
+    if control.left:
+        new_x -= speed
+    if control.right:
+        new_x += speed
+    if control.up:
+        new_y += speed
+    if control.down:
+        new_y -= speed
+
+    can_move = not player.is_blocked(new_x, new_y, obstacle_grid)
+
+    if can_move:
+        dx_move = 0
+        dy_move = 0
+        if control.left:
+            dx_move = -speed
+        if control.right:
+            dx_move = speed
+        if control.up:
+            dy_move = speed
+        if control.down:
+            dy_move = -speed
+
+        player.move_with_collision(dx_move, dy_move, obstacle_grid)
+    return can_move
+
+
+# Вся игровая логика без окна и OpenGL: матч можно гонять без экрана
+class Simulation:
+    def __init__(self, difficulty=Difficulty.NORMAL, batch_ai=False, seed=None,
+                 effects=True, enemy_weights=ENEMY_WEIGHTS,
+                 enemies_per_wave=ENEMIES_PER_WAVE, world_width=SCREEN_WIDTH,
+                 world_height=SCREEN_HEIGHT, level=None, arena=ARENA_VERSION,
+                 arena_per_wave=False, enemy_movement=ENEMY_MOVEMENT, enemy_sight=True,
+                 swept_bullets=True, tick_rate=TICK_RATE):
+        if tick_rate < MIN_TICK_RATE:
+            raise ValueError(f"частота тиков меньше {MIN_TICK_RATE}: {tick_rate}")
+        self.difficulty = difficulty
+        # Тиков в секунду и кадров (по 1/FRAME_RATE с) за тик
+        self.tick_rate = tick_rate
+        self.frame_step = tick_frames(tick_rate)
+        self.enemy_movement = dict(enemy_movement)
+        # Враги стреляют, только когда видят игрока (PlayerSight)
+        self.enemy_sight = enemy_sight
+        # Попадания пуль ищутся вдоль всего пути за тик (BulletSystem.sweeps),
+        # а не только в конечной точке
+        self.swept_bullets = swept_bullets
+        # Генератор арены (1 - старый, для повторов прошлых версий) и
+        # новая расстановка блоков перед каждой волной
+        self.arena = arena
+        self.arena_per_wave = arena_per_wave
+        # Файл уровня .tnkl; без него арена строится случайно по зерну
+        self.level = level
+        if level is not None:
+            parsed = load_level(level)
+            world_width = parsed.width
+            world_height = parsed.height
+        # Размер мира; если он больше экрана, камера TankGame следует за игроком
+        self.world_width = world_width
+        self.world_height = world_height
+        self.enemy_weights = list(enemy_weights)
+        # Без эффектов не создаются частицы и взрывы: на игру они не влияют,
+        # а быстрый пересчёт без экрана замедляют
+        self.effects = effects
+        # Вся случайность матча идёт из self.rng: одинаковые зерно и ввод
+        # дают одинаковую игру
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed
+        self.rng = None
+        # Пакетный ИИ врагов (EnemyController) вместо update() у каждого
+        self.enemy_ai = EnemyController(frame_step=self.frame_step) if batch_ai else None
         self.player_list = None
         self.enemy_list = None
-        self.bullet_list = None
-        self.enemy_bullet_list = None
+        self.bullets = BulletSystem()
+        # Враги в сетке грубой фазы попаданий, обновляется каждый тик
+        self.enemy_spatial = SpatialHash()
+        # Пулы переживают перезапуск матча: спрайты выдаются повторно
+        self.enemy_pool = ObjectPool(EnemyTank)
+        self.explosion_pool = ObjectPool(Explosion)
+        self.powerup_pool = ObjectPool(PowerUp)
         self.obstacle_list = None
         self.explosion_list = None
         self.powerup_list = None
         self.particle_system = None
+        self.obstacle_grid = ObstacleGrid(world_width, world_height)
+        self.obstacle_boxes = None
+        # Кэш destructible_obstacles() и версия сетки, для которой он собран
+        self.destructible = None
+        self.destructible_version = None
+        # Те же препятствия в списках по чанкам DRAW_CHUNK_SIZE - для отрисовки
+        self.obstacle_chunks = {}
+        self.walls = []
         self.player_bullet_color = (255, 215, 0)
         self.player = None
         self.score = 0
-        self.high_score = 0
         self.wave = 1
-        self.enemies_per_wave = 3
+        self.enemies_per_wave = enemies_per_wave
         self.enemies_to_spawn = 0
+        self.powerup_timer = 0
+        # Сквозные номера врагов и улучшений: пулы выдают спрайты повторно,
+        # а сетевой игре нужно отличать новый объект от прежнего
+        self.serial = 0
+        self.tick = 0
+        # Статистика матча для прогонов баланса
+        self.damage_taken = 0
+        self.damage_dealt = 0
+        self.kills = 0
+        self.timer = NULL_FRAME_TIMER
+        load_explosion_textures()
+        load_tank_textures()
+        self.setup()
+
+    def setup(self):
+        if self.enemy_list is not None:
+            self.release_sprites()
+        self.rng = random.Random(self.seed)
+        self.player_list = arcade.SpriteList()
+        self.enemy_list = arcade.SpriteList()
+        self.obstacle_list = arcade.SpriteList()
+        self.explosion_list = arcade.SpriteList()
+        self.powerup_list = arcade.SpriteList()
+        # У частиц свой генератор: эффекты не сдвигают игровую случайность
+        self.particle_system = ParticleSystem(
+            capacity=512 if self.effects else 0,
+            rng=random.Random(self.rng.getrandbits(64)),
+            frame_step=self.frame_step
+        )
+        self.bullets.clear()
+        if self.enemy_ai:
+            self.enemy_ai.clear(self.rng.getrandbits(64))
+        self.obstacle_grid.clear()
+        self.obstacle_boxes = None
+        self.obstacle_chunks = {}
+        self.walls = []
+        # Поле строится под самого крупного из преследующих врагов
+        chasers = [kind for kind in ENEMY_TYPES if self.enemy_movement[kind] == "chase"]
+        self.flow = None
+        if chasers:
+            self.flow = FlowField(self.obstacle_grid,
+                                  max(tank_collision_half(kind) for kind in chasers),
+                                  FLOW_ALIGN * self.frame_step)
+        self.sight = PlayerSight(self.obstacle_grid) if self.enemy_sight else None
+
+        self.player = PlayerTank(self.difficulty)
+        self.player.frame_step = self.frame_step
+        self.player.center_x, self.player.center_y = self.player_start()
+        self.player_list.append(self.player)
+
+        self.score = 0
+        self.wave = 1
+        self.powerup_timer = 0
+        self.serial = 0
+        self.tick = 0
+        self.damage_taken = 0
+        self.damage_dealt = 0
+        self.kills = 0
+        self.enemies_to_spawn = self.enemies_per_wave + self.wave
+        self.create_obstacles()
+        self.spawn_wave()
+
+    def player_start(self):
+        if self.level is not None:
+            return load_level(self.level).spawn
+        return self.world_width // 2, 100
+
+    def player_spot(self, player=None):
+        # Свободное место для игрока (кроме player - его место не в счёт):
+        # точка старта или кольца вокруг неё с шагом в размер танка.
+        # Случайность не тратится - матч без сетевых игроков от этого
+        # не меняется
+        start_x, start_y = self.player_start()
+        half = tank_collision_half("player")
+        taken = [(other.center_x, other.center_y) for other in self.player_list
+                 if other is not player and other.is_alive]
+        spots = [(0, 0)] + [(dx * radius, dy * radius) for radius in range(1, 16)
+                            for dx, dy in ARENA_RING]
+        for dx, dy in spots:
+            x = start_x + dx * PLAYER_SPACING
+            y = start_y + dy * PLAYER_SPACING
+            if (30 <= x <= self.world_width - 30 and 30 <= y <= self.world_height - 30 and
+                    not self.obstacle_grid.is_blocked(half, x, y) and
+                    all(abs(x - other_x) >= PLAYER_SPACING or abs(y - other_y) >= PLAYER_SPACING
+                        for other_x, other_y in taken)):
+                return x, y
+        return start_x, start_y
+
+    def add_player(self):
+        # Ещё один игрок в том же матче (сетевая игра). Игроки играют вместе:
+        # их пули бьют только врагов, враги стреляют в ближайшего
+        player = PlayerTank(self.difficulty)
+        player.frame_step = self.frame_step
+        player.center_x, player.center_y = self.player_spot()
+        self.player_list.append(player)
+        return player
+
+    def respawn_player(self, player):
+        # Погибший сетевой игрок возвращается в матч целым и без улучшений
+        player.reset_tank("player", player.max_health)
+        player.frame_step = self.frame_step
+        player.speed_timer = 0
+        player.damage_timer = 0
+        player.fire_rate_timer = 0
+        player.center_x, player.center_y = self.player_spot(player)
+
+    def remove_player(self, player):
+        player.remove_from_sprite_lists()
+        if player is self.player and len(self.player_list):
+            self.player = self.player_list[0]
+        for enemy in self.enemy_list:
+            if enemy.player is player:
+                enemy.player = self.player
+
+    def create_obstacles(self):
+        if self.level is not None:
+            self.create_level_obstacles(load_level(self.level))
+            return
+        width = self.world_width
+        height = self.world_height
+        # НЕРАЗРУШАЕМЫЕ ПРЕПЯТСТВИЯ
+        for x in range(50, width - 50, 60):
+            for y in [50, height - 50]:
+                obstacle = Obstacle(60, 60, (169, 169, 169), self.rng)
+                obstacle.center_x = x
+                obstacle.center_y = y
+                obstacle.is_destructible = False
+                self.add_obstacle(obstacle)
+
+        for y in range(110, height - 110, 60):
+            for x in [50, width - 50]:
+                obstacle = Obstacle(60, 60, (169, 169, 169), self.rng)
+                obstacle.center_x = x
+                obstacle.center_y = y
+                obstacle.is_destructible = False
+                self.add_obstacle(obstacle)
+
+        if self.arena == 1:
+            self.create_blocks_v1()
+        else:
+            self.create_blocks()
+
+    def block_count(self):
+        # По 8 разрушаемых блоков на каждый экран площади мира
+        return 8 * self.world_width * self.world_height // (SCREEN_WIDTH * SCREEN_HEIGHT)
+
+    def create_blocks(self):
+        clear = self.spawn_zones()
+        for tank in [*self.player_list, *self.enemy_list]:
+            clear.append((tank.center_x - PLAYER_CLEARANCE, tank.center_y - PLAYER_CLEARANCE,
+                          tank.center_x + PLAYER_CLEARANCE, tank.center_y + PLAYER_CLEARANCE))
+        for x, y in generate_blocks(self.rng, self.world_width, self.world_height,
+                                    self.block_count(), clear):
+            obstacle = Obstacle(60, 60, (178, 34, 34), self.rng)
+            obstacle.is_destructible = True
+            obstacle.center_x = x
+            obstacle.center_y = y
+            self.add_obstacle(obstacle)
+
+    def regenerate_blocks(self):
+        # Новая расстановка разрушаемых блоков; стены остаются
+        for obstacle in list(self.obstacle_list):
+            if obstacle.is_destructible:
+                self.remove_obstacle(obstacle)
+        self.create_blocks()
+
+    def create_blocks_v1(self):
+        # Прежняя расстановка перебором: блоки могли пересекаться и
+        # запирать игрока. Нужна только для повторов версий 1-3
+        width = self.world_width
+        height = self.world_height
+        for _ in range(self.block_count()):
+            obstacle = Obstacle(60, 60, (178, 34, 34), self.rng)
+            obstacle.is_destructible = True
+            while True:
+                x = self.rng.randint(100, width - 100)
+                y = self.rng.randint(150, height - 150)
+                if (abs(x - self.player.center_x) > 100 and
+                        abs(y - self.player.center_y) > 100):
+                    break
+            obstacle.center_x = x
+            obstacle.center_y = y
+            self.add_obstacle(obstacle)
+
+    def spawn_enemy(self):
+        enemy_type = self.rng.choices(
+            ENEMY_TYPES,
+            weights=self.enemy_weights,
+            k=1
+        )[0]
+
+        enemy = self.enemy_pool.acquire(self.player, enemy_type, self.rng)
+
+        # Враги выходят с краёв экрана вокруг игрока
+        left, bottom = self.spawn_origin()
+        side = self.rng.choice(["top", "bottom", "left", "right"])
+        for _ in range(SPAWN_ATTEMPTS):
+            if side == "top":
+                enemy.center_x = left + self.rng.randint(100, SCREEN_WIDTH - 100)
+                enemy.center_y = bottom + SCREEN_HEIGHT - 100
+                enemy.direction = "DOWN"
+            elif side == "bottom":
+                enemy.center_x = left + self.rng.randint(100, SCREEN_WIDTH - 100)
+                enemy.center_y = bottom + 100
+                enemy.direction = "UP"
+            elif side == "left":
+                enemy.center_x = left + 100
+                enemy.center_y = bottom + self.rng.randint(150, SCREEN_HEIGHT - 150)
+                enemy.direction = "RIGHT"
+            else:
+                enemy.center_x = left + SCREEN_WIDTH - 100
+                enemy.center_y = bottom + self.rng.randint(150, SCREEN_HEIGHT - 150)
+                enemy.direction = "LEFT"
+            # Линии появления свободны на стартовом экране; в большом мире
+            # экран сдвигается вместе с игроком и может задеть блок
+            if self.arena == 1 or not enemy.is_blocked(enemy.center_x, enemy.center_y,
+                                                      self.obstacle_grid):
+                break
+
+        self.serial += 1
+        enemy.serial = self.serial
+        self.attach_enemy(enemy)
+
+    def attach_enemy(self, enemy):
+        enemy.bullets = self.bullets
+        enemy.obstacle_grid = self.obstacle_grid
+        enemy.world_width = self.world_width
+        enemy.world_height = self.world_height
+        enemy.movement = self.enemy_movement[enemy.enemy_type]
+        enemy.flow = self.flow
+        enemy.sight = self.sight
+        enemy.frame_step = self.frame_step
+        self.enemy_list.append(enemy)
+        if self.enemy_ai:
+            self.enemy_ai.add(enemy)
+
+    def create_level_obstacles(self, level):
+        # Стены уровня уже слиты в большие прямоугольники, спрайты
+        # создаются только для разрушаемых блоков
+        for left, bottom, right, top in level.walls.tolist():
+            self.add_wall(Wall(left, bottom, right, top))
+        for x, y in level.bricks.tolist():
+            obstacle = Obstacle(level.tile_size, level.tile_size, (178, 34, 34),
+                                self.rng)
+            obstacle.is_destructible = True
+            obstacle.health = 2
+            obstacle.center_x = x
+            obstacle.center_y = y
+            self.add_obstacle(obstacle)
+
+    def spawn_zones(self):
+        # Прямоугольники вокруг линий, на которых spawn_enemy ставит врагов
+        left, bottom = self.spawn_origin()
+        right = left + SCREEN_WIDTH
+        top = bottom + SCREEN_HEIGHT
+        pad = SPAWN_CLEARANCE
+        return [
+            (left + 100 - pad, top - 100 - pad, right - 100 + pad, top - 100 + pad),
+            (left + 100 - pad, bottom + 100 - pad, right - 100 + pad, bottom + 100 + pad),
+            (left + 100 - pad, bottom + 150 - pad, left + 100 + pad, top - 150 + pad),
+            (right - 100 - pad, bottom + 150 - pad, right - 100 + pad, top - 150 + pad),
+        ]
+
+    def spawn_origin(self):
+        # Левый нижний угол экрана вокруг игрока, прижатого к краям мира
+        left = int(self.player.center_x) - SCREEN_WIDTH // 2
+        bottom = int(self.player.center_y) - SCREEN_HEIGHT // 2
+        return (max(0, min(self.world_width - SCREEN_WIDTH, left)),
+                max(0, min(self.world_height - SCREEN_HEIGHT, bottom)))
+
+    def add_obstacle(self, obstacle, slot=None, refresh=True):
+        self.obstacle_list.append(obstacle)
+        self.obstacle_grid.add(obstacle, slot, refresh)
+        self.obstacle_boxes = None
+        key = (int(obstacle.center_x) // DRAW_CHUNK_SIZE,
+               int(obstacle.center_y) // DRAW_CHUNK_SIZE)
+        chunk = self.obstacle_chunks.get(key)
+        if chunk is None:
+            chunk = self.obstacle_chunks[key] = arcade.SpriteList(use_spatial_hash=False)
+        chunk.append(obstacle)
+
+    def add_wall(self, wall):
+        self.walls.append(wall)
+        self.obstacle_grid.add(wall)
+        self.obstacle_boxes = None
+
+    def visible_obstacles(self, left, bottom, right, top):
+        # Списки препятствий из чанков, которые задевают область экрана.
+        # Препятствие меньше CHUNK_APRON * 2, поэтому поля хватает, чтобы
+        # не потерять выступающие из соседнего чанка
+        x0 = int(left - CHUNK_APRON) // DRAW_CHUNK_SIZE
+        x1 = int(right + CHUNK_APRON) // DRAW_CHUNK_SIZE
+        y0 = int(bottom - CHUNK_APRON) // DRAW_CHUNK_SIZE
+        y1 = int(top + CHUNK_APRON) // DRAW_CHUNK_SIZE
+        return [self.obstacle_chunks[(cx, cy)]
+                for cy in range(y0, y1 + 1) for cx in range(x0, x1 + 1)
+                if (cx, cy) in self.obstacle_chunks]
+
+    def remove_obstacle(self, obstacle, refresh=True):
+        obstacle.remove_from_sprite_lists()
+        self.obstacle_grid.remove(obstacle, refresh)
+        self.obstacle_boxes = None
+
+    def get_obstacle_boxes(self):
+        # Препятствия неподвижны: массивы пересобираются только после
+        # добавления или разрушения препятствия
+        if self.obstacle_boxes is None:
+            obstacles = self.walls + list(self.obstacle_list)
+            self.obstacle_boxes = (obstacles,) + sprite_boxes(
+                obstacles, [o.width / 2 for o in obstacles],
+                [o.height / 2 for o in obstacles]
+            )
+        return self.obstacle_boxes
+
+    def spawn_wave(self):
+        if self.arena_per_wave and self.tick > 0:
+            self.regenerate_blocks()
+        self.wave += 1
+        self.enemies_to_spawn = self.enemies_per_wave + self.wave
+        for _ in range(self.enemies_to_spawn):
+            self.spawn_enemy()
+
+    def add_explosion(self, x, y, kind=None):
+        if self.effects:
+            explosion = self.explosion_pool.acquire(x, y, kind)
+            explosion.frame_step = self.frame_step
+            self.explosion_list.append(explosion)
+
+    def spawn_powerup(self, x, y):
+        powerup_type = self.rng.choice(list(PowerUpType))
+        powerup = self.powerup_pool.acquire(powerup_type)
+        powerup.frame_step = self.frame_step
+        self.serial += 1
+        powerup.serial = self.serial
+        powerup.center_x = x
+        powerup.center_y = y
+        self.powerup_list.append(powerup)
+
+    def apply_powerup(self, powerup, player=None):
+        if player is None:
+            player = self.player
+        if powerup.type == PowerUpType.HEALTH:
+            player.health = min(
+                player.max_health, player.health + 2
+            )
+        elif powerup.type == PowerUpType.SPEED:
+            player.speed_multiplier = 1.5
+            player.speed_timer = 600
+        elif powerup.type == PowerUpType.DAMAGE:
+            player.damage_multiplier = 2.0
+            player.damage_timer = 900
+        elif powerup.type == PowerUpType.RAPID_FIRE:
+            player.shoot_delay = 5
+            player.fire_rate_timer = 600
+
+    def update_powerup_timers(self, player):
+        step = self.frame_step
+        if player.speed_timer > 0:
+            player.speed_timer -= step
+            if player.speed_timer <= 0:
+                player.speed_multiplier = 1.0
+        if player.damage_timer > 0:
+            player.damage_timer -= step
+            if player.damage_timer <= 0:
+                player.damage_multiplier = 1.0
+        if player.fire_rate_timer > 0:
+            player.fire_rate_timer -= step
+            if player.fire_rate_timer <= 0:
+                player.shoot_delay = 15
+
+    def shoot(self, player=None):
+        if player is None:
+            player = self.player
+        if player.is_alive and player.can_shoot():
+            return player.shoot(self.bullets, self.player_bullet_color)
+        return False
+
+    def update_effects(self):
+        # Вне игры (меню, пауза) анимируются только эффекты
+        self.explosion_list.update()
+        self.powerup_list.update()
+
+    def step(self, inputs=None):
+        # inputs - ввод игрока или, когда игроков несколько, словарь
+        # {танк: ввод}; кого нет в словаре, стоит на месте
+        players = [player for player in self.player_list if player.is_alive]
+        if not players:
+            return False
+        if not isinstance(inputs, dict):
+            inputs = {self.player: inputs}
+        controls = []
+        for player in players:
+            control = inputs.get(player)
+            if control is None:
+                control = PlayerInput(aim_x=player.center_x, aim_y=player.center_y + 1)
+            controls.append(control)
+
+        timer = self.timer
+        timer.begin()
+        self.tick += 1
+        for player, control in zip(players, controls):
+            if control.fire:
+                self.shoot(player)
+
+        for player in players:
+            player.update()
+        timer.lap(PHASE_INPUT)
+        self.particle_system.update()
+        timer.lap(PHASE_EFFECTS)
+        self.powerup_list.update()
+        for player in players:
+            self.update_powerup_timers(player)
+
+        if len(self.enemy_list) == 0:
+            self.spawn_wave()
+        timer.lap(PHASE_POWERUPS)
+
+        for player, control in zip(players, controls):
+            self.move_player(player, control)
+        timer.lap(PHASE_INPUT)
+
+        if self.flow is not None and len(self.enemy_list):
+            self.flow.update([(player.center_x, player.center_y) for player in players])
+        if self.sight is not None:
+            self.sight.update([(player.center_x, player.center_y) for player in players])
+        if self.enemy_ai:
+            self.enemy_ai.update(players, self.obstacle_grid, self.bullets,
+                                 self.flow, self.sight)
+        else:
+            if len(self.player_list) > 1:
+                self.retarget(players)
+            for enemy in self.enemy_list:
+                enemy.update()
+        timer.lap(PHASE_ENEMY_AI)
+
+        self.bullets.update(self.world_width, self.world_height)
+        timer.lap(PHASE_BULLETS)
+        self.explosion_list.update()
+        timer.lap(PHASE_EFFECTS)
+
+        # Попадания в танки ищутся до разбора препятствий: при непрерывной
+        # проверке пуля достаётся той цели, которую задела раньше
+        if self.enemy_ai:
+            enemies, enemy_boxes = self.enemy_ai.boxes()
+        else:
+            enemies = list(self.enemy_list)
+            halves = [enemy.get_collision_half() for enemy in enemies]
+            enemy_boxes = sprite_boxes(enemies, halves, halves)
+        self.enemy_spatial.update(*enemy_boxes)
+        enemy_hits = self.bullet_hits(OWNER_PLAYER, enemy_boxes, self.enemy_spatial)
+        halves = [player.get_collision_half() for player in players]
+        player_hits = self.bullet_hits(OWNER_ENEMY, sprite_boxes(players, halves, halves))
+        # Доля пути до задетого танка по номеру пули
+        tank_t = dict(zip(enemy_hits[0].tolist(), enemy_hits[2].tolist()))
+        tank_t.update(zip(player_hits[0].tolist(), player_hits[2].tolist()))
+
+        # Препятствия ищутся по сетке препятствий, индекс цели - их слот
+        grid = self.obstacle_grid
+        obstacles = grid.obstacles
+        for index, target, t in zip(*self.bullet_hits(None, grid.box_arrays(), grid.spatial)):
+            obstacle = obstacles[target]
+            if (not self.bullets.alive[index] or obstacle is None or
+                    tank_t.get(index, math.inf) < t):
+                continue
+            by_player = self.bullets.owner[index] == OWNER_PLAYER
+            if obstacle.is_destructible:
+                obstacle.health -= int(self.bullets.damage[index])
+                if obstacle.health <= 0:
+                    self.add_explosion(obstacle.center_x, obstacle.center_y)
+                    self.remove_obstacle(obstacle)
+                    if by_player:
+                        self.score += 10
+                        if self.rng.random() < 0.2:
+                            self.spawn_powerup(
+                                obstacle.center_x, obstacle.center_y
+                            )
+            self.bullets.kill(index)
+        timer.lap(PHASE_HITS_OBSTACLES)
+
+        enemies_to_remove = []
+        for index, target, _ in zip(*enemy_hits):
+            enemy = enemies[target]
+            if not self.bullets.alive[index] or not enemy.is_alive:
+                continue
+            damage = int(self.bullets.damage[index])
+            enemy.take_damage(damage)
+            self.damage_dealt += damage
+            if not enemy.is_alive:
+                self.score += 100
+                self.kills += 1
+                enemies_to_remove.append(enemy)
+                x = float(enemy_boxes[0][target])
+                y = float(enemy_boxes[1][target])
+                self.add_explosion(x, y, enemy.enemy_type)
+                if self.rng.random() < 0.1:
+                    self.spawn_powerup(x, y)
+            self.bullets.kill(index)
+
+        for enemy in enemies_to_remove:
+            if enemy in self.enemy_list:
+                if self.enemy_ai:
+                    self.enemy_ai.remove(enemy)
+                self.enemy_pool.release(enemy)
+        timer.lap(PHASE_HITS_ENEMIES)
+
+        for index, target, _ in zip(*player_hits):
+            player = players[target]
+            if player.is_alive and self.bullets.alive[index]:
+                damage = int(self.bullets.damage[index])
+                player.take_damage(damage)
+                self.damage_taken += damage
+                self.bullets.kill(index)
+                if player.health > 0:
+                    self.add_explosion(
+                        player.center_x, player.center_y, "hit"
+                    )
+        timer.lap(PHASE_HITS_PLAYER)
+
+        for powerup in self.powerup_list:
+            for player in players:
+                if arcade.check_for_collision(player, powerup):
+                    self.apply_powerup(powerup, player)
+                    self.powerup_pool.release(powerup)
+                    break
+
+        self.powerup_timer += self.frame_step
+        if self.powerup_timer >= 600:
+            left, bottom = self.spawn_origin()
+            x = left + self.rng.randint(50, SCREEN_WIDTH - 50)
+            y = bottom + self.rng.randint(50, SCREEN_HEIGHT - 50)
+            self.spawn_powerup(x, y)
+            self.powerup_timer = 0
+        timer.lap(PHASE_POWERUPS)
+
+        return True
+
+    def move_player(self, player, control):
+        if not drive_player(player, control, self.obstacle_grid, self.frame_step):
+            return
+        self.timer.lap(PHASE_INPUT)
+
+        if control.left:
+            self.particle_system.create_trail(
+                player.center_x + 20,
+                player.center_y,
+                (0, 255, 255)
+            )
+        if control.right:
+            self.particle_system.create_trail(
+                player.center_x - 20,
+                player.center_y,
+                (0, 255, 255)
+            )
+        if control.up:
+            self.particle_system.create_trail(
+                player.center_x,
+                player.center_y - 20,
+                (0, 255, 255)
+            )
+        if control.down:
+            self.particle_system.create_trail(
+                player.center_x,
+                player.center_y + 20,
+                (0, 255, 255)
+            )
+        self.timer.lap(PHASE_EFFECTS)
+
+        player.center_x = max(
+            30, min(self.world_width - 30, player.center_x)
+        )
+        player.center_y = max(
+            30, min(self.world_height - 30, player.center_y)
+        )
+
+    def retarget(self, players):
+        # Каждый враг целится в ближайшего живого игрока
+        for enemy in self.enemy_list:
+            enemy.player = min(players, key=lambda player:
+                               (player.center_x - enemy.center_x) ** 2 +
+                               (player.center_y - enemy.center_y) ** 2)
+
+    def bullet_hits(self, owner, boxes, spatial=None):
+        # Пули, задевшие цели, с долей пути t до попадания. Без непрерывной
+        # проверки (повторы прошлых версий) - пересечения в конце тика, t = 0.
+        # spatial - SpatialHash целей, иначе цели ищутся в сетке пуль
+        if self.swept_bullets:
+            return self.bullets.sweeps(owner, *boxes, spatial)
+        index, target = self.bullets.hits(owner, *boxes, spatial)
+        return index, target, np.zeros(len(index))
+
+    def release_sprites(self):
+        # Спрайты прошлого матча возвращаются в пулы
+        for sprites in (self.enemy_list, self.explosion_list, self.powerup_list):
+            for sprite in list(sprites):
+                release_sprite(sprite)
+
+    def pool_stats(self):
+        return {
+            "enemies": self.enemy_pool.stats(),
+            "bullets": self.bullets.stats(),
+            "powerups": self.powerup_pool.stats(),
+            "explosions": self.explosion_pool.stats(),
+        }
+
+    def sync_sprites(self):
+        # При пакетном ИИ спрайты врагов обновляются только перед отрисовкой
+        if self.enemy_ai:
+            self.enemy_ai.sync()
+
+    def run(self, n_ticks, inputs=None):
+        ticks = 0
+        for _ in range(n_ticks):
+            if not self.step(inputs):
+                break
+            self.timer.next_frame()
+            ticks += 1
+        return ticks
+
+    def state_header(self):
+        level = self.level.encode() if self.level is not None else b""
+        flags = match_flags(self.enemy_ai is not None, self.arena_per_wave,
+                            self.enemy_movement, self.enemy_sight, self.swept_bullets)
+        return STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION,
+                                 list(Difficulty).index(self.difficulty), flags, self.seed,
+                                 self.world_width, self.world_height, len(level), self.arena,
+                                 self.tick_rate) + level
+
+    def save_state(self):
+        # Снимок матча для быстрого сохранения и перемотки (разделы STATE_*).
+        # Эффекты (взрывы, частицы) на игру не влияют и не сохраняются
+        players = list(self.player_list)
+        _, internal, gauss = self.rng.getstate()
+        parts = [
+            self.state_header(),
+            STATE_MATCH.pack(self.score, self.wave, self.enemies_to_spawn, self.powerup_timer,
+                             self.serial, self.tick, self.damage_taken, self.damage_dealt,
+                             self.kills),
+            STATE_RANDOM.pack(*internal, math.nan if gauss is None else gauss),
+        ]
+        ai = self.enemy_ai
+        if ai:
+            state = ai.rng.bit_generator.state
+            parts.append(STATE_NUMPY_RANDOM.pack(
+                state["state"]["state"] >> 64, state["state"]["state"] & UINT64,
+                state["state"]["inc"] >> 64, state["state"]["inc"] & UINT64,
+                state["has_uint32"], state["uinteger"]))
+        obstacles, placement = self.destructible_obstacles()
+        parts.append(STATE_COUNTS.pack(len(players), len(self.enemy_list), len(obstacles),
+                                       len(self.powerup_list), players.index(self.player),
+                                       len(self.obstacle_grid.obstacles)))
+        for player in players:
+            parts.append(STATE_PLAYER.pack(
+                player.center_x, player.center_y, DIRECTIONS.index(player.direction),
+                player.health, player.max_health, player.is_alive, player.shoot_cooldown,
+                player.shoot_delay, player.speed_multiplier, player.damage_multiplier,
+                player.speed_timer, player.damage_timer, player.fire_rate_timer))
+        targets = {id(player): i for i, player in enumerate(players)}
+        for enemy in self.enemy_list:
+            if ai:
+                # При пакетном ИИ позиция и таймеры - в массивах контроллера
+                i = enemy.ai_slot
+                x, y, direction = ai.x.item(i), ai.y.item(i), ai.direction.item(i)
+                cooldown = ai.cooldown.item(i)
+                shoot_timer = ai.shoot_timer.item(i)
+                turn_timer = ai.turn_timer.item(i)
+            else:
+                x, y = enemy.center_x, enemy.center_y
+                direction = DIRECTIONS.index(enemy.direction)
+                cooldown = enemy.shoot_cooldown
+                shoot_timer = enemy.shoot_timer
+                turn_timer = enemy.change_direction_timer
+            parts.append(STATE_ENEMY.pack(
+                enemy.serial, ENEMY_TYPES.index(enemy.enemy_type), x, y, direction,
+                enemy.health, enemy.max_health, enemy.speed_multiplier,
+                enemy.damage_multiplier, cooldown, enemy.shoot_delay, shoot_timer, turn_timer,
+                targets.get(id(enemy.player), 0)))
+        parts.append(self.bullets.to_bytes())
+        parts.append(placement)
+        parts.append(np.array([obstacle.health for obstacle in obstacles],
+                              dtype="<i4").tobytes())
+        kinds = list(PowerUpType)
+        for powerup in self.powerup_list:
+            parts.append(STATE_POWERUP.pack(powerup.serial, kinds.index(powerup.type),
+                                            powerup.center_x, powerup.center_y,
+                                            powerup.lifetime))
+        if self.flow is not None:
+            parts.append(self.flow.to_bytes())
+        return b"".join(parts)
+
+    def load_state(self, blob):
+        # Возврат к снимку save_state() из матча с теми же настройками.
+        # Неразрушаемые препятствия не трогаются, разрушаемые меняются,
+        # только если отличаются от снимка: каждое изменение сетки стоит
+        # пересчёта её слоёв
+        read_state_header(blob)
+        header = self.state_header()
+        if blob[:len(header)] != header:
+            raise ValueError("снимок сделан в матче с другими настройками")
+        data = memoryview(blob)
+        offset = len(header)
+        (self.score, self.wave, self.enemies_to_spawn, self.powerup_timer, self.serial,
+         self.tick, self.damage_taken, self.damage_dealt,
+         self.kills) = STATE_MATCH.unpack_from(data, offset)
+        offset += STATE_MATCH.size
+        random_state = STATE_RANDOM.unpack_from(data, offset)
+        offset += STATE_RANDOM.size
+        numpy_state = None
+        if self.enemy_ai:
+            numpy_state = STATE_NUMPY_RANDOM.unpack_from(data, offset)
+            offset += STATE_NUMPY_RANDOM.size
+        (players, enemies, obstacles, powerups, main,
+         slots) = STATE_COUNTS.unpack_from(data, offset)
+        offset += STATE_COUNTS.size
+
+        records, offset = unpack_records(STATE_PLAYER, data, offset, players)
+        self.load_players(records, main)
+        records, offset = unpack_records(STATE_ENEMY, data, offset, enemies)
+        self.load_enemies(records)
+        offset = self.bullets.restore(data, offset)
+        placement = data[offset:offset + STATE_OBSTACLE.itemsize * obstacles]
+        offset += len(placement)
+        health = np.frombuffer(data, dtype="<i4", count=obstacles, offset=offset)
+        offset += health.nbytes
+        self.load_obstacles(placement, health, slots)
+        records, offset = unpack_records(STATE_POWERUP, data, offset, powerups)
+        self.load_powerups(records)
+        if self.flow is not None:
+            offset = self.flow.restore(data, offset)
+
+        for explosion in list(self.explosion_list):
+            release_sprite(explosion)
+        self.particle_system.clear()
+        # Генераторы - в конце: создание спрайтов выше тратит случайность
+        gauss = random_state[-1]
+        self.rng.setstate((self.rng.VERSION, random_state[:-1],
+                           None if math.isnan(gauss) else gauss))
+        if numpy_state is not None:
+            state_high, state_low, inc_high, inc_low, has_uint32, uinteger = numpy_state
+            self.enemy_ai.rng.bit_generator.state = {
+                "bit_generator": "PCG64",
+                "state": {"state": state_high << 64 | state_low,
+                          "inc": inc_high << 64 | inc_low},
+                "has_uint32": has_uint32, "uinteger": uinteger}
+
+    def load_players(self, records, main):
+        players = list(self.player_list)
+        for player in players[len(records):]:
+            self.remove_player(player)
+        del players[len(records):]
+        while len(players) < len(records):
+            players.append(self.add_player())
+        for player, record in zip(players, records):
+            (player.center_x, player.center_y, direction, player.health, player.max_health,
+             is_alive, player.shoot_cooldown, player.shoot_delay, player.speed_multiplier,
+             player.damage_multiplier, player.speed_timer, player.damage_timer,
+             player.fire_rate_timer) = record
+            player.is_alive = bool(is_alive)
+            player.direction = DIRECTIONS[direction]
+            player.update_direction_texture()
+        self.player = players[main]
+
+    def load_enemies(self, records):
+        # Те же враги, что в снимке (перемотка на доли секунды), остаются
+        # на месте; иначе все спрайты берутся из пула заново
+        enemies = list(self.enemy_list)
+        same = [enemy.serial for enemy in enemies] == [record[0] for record in records]
+        if not same:
+            for enemy in enemies:
+                release_sprite(enemy)
+        if self.enemy_ai:
+            self.enemy_ai.clear()
+        players = self.player_list
+        for i, (serial, kind, x, y, direction, health, max_health, speed_multiplier,
+                damage_multiplier, cooldown, shoot_delay, shoot_timer, turn_timer,
+                target) in enumerate(records):
+            if same:
+                enemy = enemies[i]
+                enemy.player = players[target]
+            else:
+                enemy = self.enemy_pool.acquire(players[target], ENEMY_TYPES[kind], self.rng)
+                enemy.serial = serial
+            enemy.center_x = x
+            enemy.center_y = y
+            enemy.direction = DIRECTIONS[direction]
+            enemy.update_direction_texture()
+            enemy.health = health
+            enemy.max_health = max_health
+            enemy.speed_multiplier = speed_multiplier
+            enemy.damage_multiplier = damage_multiplier
+            enemy.shoot_cooldown = cooldown
+            enemy.shoot_delay = shoot_delay
+            enemy.shoot_timer = shoot_timer
+            enemy.change_direction_timer = turn_timer
+            if not same:
+                self.attach_enemy(enemy)
+            elif self.enemy_ai:
+                self.enemy_ai.add(enemy)
+
+    def destructible_obstacles(self):
+        # Разрушаемые препятствия по слотам и их размещение в виде
+        # STATE_OBSTACLE. Меняются только вместе с версией сетки, поэтому
+        # снимок каждый раз собирает заново лишь прочность
+        grid = self.obstacle_grid
+        if self.destructible_version != grid.version:
+            obstacles = [obstacle for obstacle in grid.obstacles
+                         if obstacle is not None and obstacle.is_destructible]
+            placement = np.array([(obstacle.grid_slot, obstacle.center_x, obstacle.center_y,
+                                   round(obstacle.width), round(obstacle.height))
+                                  for obstacle in obstacles], dtype=STATE_OBSTACLE)
+            self.destructible = (obstacles, placement.tobytes())
+            self.destructible_version = grid.version
+        return self.destructible
+
+    def load_obstacles(self, placement, health, size):
+        grid = self.obstacle_grid
+        obstacles, current = self.destructible_obstacles()
+        if placement != current:
+            # Размещения сравниваются массивами по слотам, в Python - только
+            # отличия. Слои сетки перестраиваются один раз для всех изменений:
+            # по препятствию за раз это стоило бы ~1 мс на каждое
+            saved = np.frombuffer(placement, dtype=STATE_OBSTACLE)
+            now = np.frombuffer(current, dtype=STATE_OBSTACLE)
+            # Оба размещения упорядочены по слотам; записи сравниваются
+            # целиком как байты
+            record = f"V{STATE_OBSTACLE.itemsize}"
+            index = np.searchsorted(saved["slot"], now["slot"])
+            kept = index < len(saved)
+            kept[kept] = saved.view(record)[index[kept]] == now.view(record)[kept]
+            stale = ~kept
+            missing = np.ones(len(saved), dtype=bool)
+            missing[index[kept]] = False
+            removed = [obstacles[index] for index in stale.nonzero()[0].tolist()]
+            for obstacle in removed:
+                self.remove_obstacle(obstacle, refresh=False)
+            added = []
+            for slot, x, y, width, height in saved[missing].tolist():
+                # Разрушенный после снимка блок ставится обратно в свой слот
+                obstacle = Obstacle(width, height, (178, 34, 34), self.rng)
+                obstacle.is_destructible = True
+                obstacle.center_x = x
+                obstacle.center_y = y
+                self.add_obstacle(obstacle, slot, refresh=False)
+                added.append(obstacle)
+            # Сначала добавленные: перестройка убранных затем пересчитает
+            # свои строки по уже полной карте
+            grid.refresh_layers(added, added=True)
+            grid.refresh_layers(removed)
+            # Теперь на сетке ровно снимок: кэш destructible_obstacles()
+            # собирается из него без обхода всех препятствий
+            slots = grid.obstacles
+            obstacles = [slots[slot] for slot in saved["slot"].tolist()]
+            self.destructible = (obstacles, placement)
+            self.destructible_version = grid.version
+        grid.trim(size)
+        for obstacle, value in zip(obstacles, health.tolist()):
+            obstacle.health = value
+
+    def load_powerups(self, records):
+        for powerup in list(self.powerup_list):
+            release_sprite(powerup)
+        kinds = list(PowerUpType)
+        for serial, kind, x, y, lifetime in records:
+            powerup = self.powerup_pool.acquire(kinds[kind])
+            powerup.frame_step = self.frame_step
+            powerup.serial = serial
+            powerup.center_x = x
+            powerup.center_y = y
+            powerup.lifetime = lifetime
+            self.powerup_list.append(powerup)
+
+
+RECT_VERTEX_SHADER = """
+#version 330
+
+in vec4 in_rect;
+in vec4 in_color;
+
+out vec4 v_rect;
+out vec4 v_color;
+
+void main() {
+    gl_Position = vec4(0.0, 0.0, 0.0, 1.0);
+    v_rect = in_rect;
+    v_color = in_color;
+}
+"""
+
+RECT_GEOMETRY_SHADER = """
+#version 330
+
+layout (points) in;
+layout (triangle_strip, max_vertices = 4) out;
+
+uniform Projection {
+    uniform mat4 matrix;
+} proj;
+
+in vec4 v_rect[];
+in vec4 v_color[];
+
+out vec4 g_color;
+
+void main() {
+    // v_rect = (left, bottom, right, top)
+    vec4 rect = v_rect[0];
+    for (int i = 0; i < 4; i++) {
+        vec2 corner = vec2(i % 2 == 0 ? rect.x : rect.z, i < 2 ? rect.y : rect.w);
+        g_color = v_color[0];
+        gl_Position = proj.matrix * vec4(corner, 0.0, 1.0);
+        EmitVertex();
+    }
+    EndPrimitive();
+}
+"""
+
+RECT_FRAGMENT_SHADER = """
+#version 330
+
+in vec4 g_color;
+
+out vec4 f_color;
+
+void main() {
+    f_color = g_color;
+}
+"""
+
+RECT_VERTEX_DTYPE = np.dtype([
+    ("rect", np.float32, 4),
+    ("color", np.uint8, 4),
+])
+
+HEALTH_BAR_HEIGHT = 6
+
+
+class RectRenderer:
+    # Прямоугольники из массива RECT_VERTEX_DTYPE одним вызовом отрисовки
+    def __init__(self):
+        self.program = None
+        self.geometry = None
+        self.buffer = None
+        self.count = 0
+
+    def upload(self, data):
+        ctx = arcade.get_window().ctx
+        if self.program is None:
+            self.program = ctx.program(
+                vertex_shader=RECT_VERTEX_SHADER,
+                geometry_shader=RECT_GEOMETRY_SHADER,
+                fragment_shader=RECT_FRAGMENT_SHADER,
+            )
+        if self.buffer is None or self.buffer.size < data.nbytes:
+            self.buffer = ctx.buffer(reserve=max(len(data), 256) * 2 * data.itemsize)
+            self.geometry = ctx.geometry(
+                [arcade.gl.BufferDescription(
+                    self.buffer, "4f 4f1", ["in_rect", "in_color"],
+                    normalized=["in_color"],
+                )],
+                mode=ctx.POINTS,
+            )
+        self.buffer.write(data.tobytes())
+        self.count = len(data)
+
+    def render(self):
+        if self.count:
+            self.geometry.render(self.program, vertices=self.count)
+
+    def draw(self, data):
+        self.upload(data)
+        self.render()
+
+
+class HealthBarRenderer:
+    # Полоски здоровья всех танков одним вызовом отрисовки: фон и заполнение
+    # на каждый танк. Буфер пересобирается, только если какой-то танк
+    # сдвинулся или его здоровье изменилось
+    def __init__(self):
+        self.renderer = RectRenderer()
+        self.state = None
+
+    def rebuild(self, state):
+        x, y, width, height, ratio = state.T
+        left = x - width / 2
+        bottom = y + height / 2 + 5
+        top = bottom + HEALTH_BAR_HEIGHT
+
+        n = len(state)
+        data = np.empty(n * 2, dtype=RECT_VERTEX_DTYPE)
+        background = data[:n]
+        fill = data[n:]
+        background["rect"] = np.column_stack((left, bottom, left + width, top))
+        background["color"] = arcade.get_four_byte_color(arcade.color.BLACK)
+        fill["rect"] = np.column_stack(
+            (left, bottom, left + width * np.maximum(ratio, 0), top)
+        )
+        fill["color"] = arcade.get_four_byte_color(arcade.color.LIME_GREEN)
+        return data
+
+    def draw(self, tanks, view=None):
+        state = np.array(
+            [(tank.center_x, tank.center_y, tank.width, tank.height,
+              tank.health / tank.max_health) for tank in tanks],
+            dtype=np.float64,
+        ).reshape(-1, 5)
+        if view is not None:
+            # Полоска висит над танком: с запасом на его размер и высоту полоски
+            left, bottom, right, top = view
+            x = state[:, 0]
+            y = state[:, 1]
+            state = state[(x >= left - 60) & (x <= right + 60) &
+                          (y >= bottom - 60) & (y <= top + 60)]
+        if len(state) == 0:
+            return
+
+        if self.state is None or not np.array_equal(state, self.state):
+            self.state = state
+            self.renderer.upload(self.rebuild(state))
+        self.renderer.render()
+
+
+class FrameTimerOverlay:
+    # График времени фаз за последние кадры: столбик на кадр, фазы
+    # сложены друг на друга. Линия сверху - бюджет кадра при 60 FPS
+    def __init__(self, x, y, frames=240, bar_width=2, height=120, budget=1 / 60):
+        self.x = x
+        self.y = y
+        self.frames = frames
+        self.bar_width = bar_width
+        self.height = height
+        self.budget = budget
+        self.renderer = RectRenderer()
+        self.colors = np.array([arcade.get_four_byte_color(color)
+                                for color in PHASE_COLORS], dtype=np.uint8)
+        self.legend = TextLayer()
+        legend_x = x + frames * bar_width + 10
+        for i, name in enumerate(PHASES):
+            self.legend.add(name, name + ": {:.2f} мс", legend_x,
+                            y + height - 12 * i, PHASE_COLORS[i], 9)
+        self.legend.add("total", "кадр: {:.2f} мс", legend_x,
+                        y + height - 12 * len(PHASES), arcade.color.WHITE, 9, bold=True)
+
+    def draw(self, timer):
+        samples = timer.recent(self.frames)
+        k = len(samples)
+        if k == 0:
+            return
+        phases = len(PHASES)
+        scale = self.height / self.budget
+        tops = np.minimum(np.cumsum(samples, axis=1) * scale, self.height * 1.5)
+        bottoms = np.hstack((np.zeros((k, 1)), tops[:, :-1]))
+        left = self.x + np.arange(k, dtype=np.float64) * self.bar_width
+
+        data = np.empty(2 + k * phases, dtype=RECT_VERTEX_DTYPE)
+        data[0]["rect"] = (self.x, self.y, self.x + self.frames * self.bar_width,
+                           self.y + self.height)
+        data[0]["color"] = (0, 0, 0, 160)
+        data[1]["rect"] = (self.x, self.y + self.height,
+                           self.x + self.frames * self.bar_width, self.y + self.height + 1)
+        data[1]["color"] = arcade.get_four_byte_color(arcade.color.WHITE)
+        bars = data[2:]
+        bars["rect"] = np.stack((
+            np.repeat(left, phases),
+            self.y + bottoms.ravel(),
+            np.repeat(left + self.bar_width, phases),
+            self.y + tops.ravel(),
+        ), axis=1)
+        bars["color"] = np.tile(self.colors, (k, 1))
+        self.renderer.draw(data)
+
+        # Подписи с текстом пересобираются не чаще раза в 15 кадров
+        if timer.frames % 15 == 0 or not self.legend.values:
+            mean = samples.mean(axis=0) * 1000
+            for name, value in zip(PHASES, mean):
+                self.legend.set(name, round(value, 2))
+            self.legend.set("total", round(mean.sum(), 2))
+        self.legend.draw()
+
+
+class TextLayer:
+    # Постоянные надписи в одном пакете pyglet. Текст пересобирается только
+    # при изменении значения, а весь слой рисуется одним вызовом
+    def __init__(self):
+        self.batch = pyglet.graphics.Batch()
+        self.labels = {}
+        self.templates = {}
+        self.values = {}
+
+    def add(self, key, template, x, y, color, font_size,
+            anchor_x="left", bold=False):
+        self.templates[key] = template
+        self.labels[key] = pyglet.text.Label(
+            template, x=x, y=y, font_name=("calibri", "arial"),
+            font_size=font_size, bold=bold, anchor_x=anchor_x,
+            anchor_y="baseline", color=arcade.get_four_byte_color(color),
+            batch=self.batch,
+        )
+
+    def set(self, key, *values):
+        if self.values.get(key) == values:
+            return
+        self.values[key] = values
+        self.labels[key].text = self.templates[key].format(*values)
+
+    def set_color(self, key, color):
+        color = arcade.get_four_byte_color(color)
+        label = self.labels[key]
+        if label.color != color:
+            label.color = color
+
+    def set_position(self, key, x, y):
+        label = self.labels[key]
+        if label.x != x or label.y != y:
+            label.position = (x, y)
+
+    def set_visible(self, key, visible):
+        label = self.labels[key]
+        if label.visible != visible:
+            label.visible = visible
+
+    def draw(self):
+        with arcade.get_window().ctx.pyglet_rendering():
+            self.batch.draw()
+
+
+class TankGame(arcade.Window):
+    def __init__(self, batch_ai=False, seed=None, world_width=SCREEN_WIDTH,
+                 world_height=SCREEN_HEIGHT, level=None, arena_per_wave=False,
+                 tick_rate=TICK_RATE, fps=FRAME_RATE):
+        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE,
+                         update_rate=1 / fps)
+        self.sim = None
+        # Симуляция идёт тиками по 1 / tick_rate секунды независимо от
+        # частоты кадров: время кадра копится в accumulator, на отрисовке
+        # танки и пули стоят на доле alpha пути между двумя последними тиками
+        self.tick_rate = tick_rate
+        self.tick_time = 1 / tick_rate
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.previous = {}
+        self.batch_ai = batch_ai
+        self.arena_per_wave = arena_per_wave
+        self.world_width = world_width
+        self.world_height = world_height
+        self.level = level
+        # Стены уровня - неподвижные прямоугольники одним вызовом отрисовки
+        self.walls = RectRenderer()
+        # Камера мира следует за игроком, интерфейс рисуется своей камерой
+        # в координатах экрана
+        self.camera = arcade.Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.gui_camera = arcade.Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.view_x = 0
+        self.view_y = 0
+        # Зерно первого матча; следующие матчи получают новое из него
+        self.rng = random.Random(seed)
+        self.replay = None
+        # Снимки матча (Simulation.save_state) с местом в повторе: кольцо
+        # для перемотки назад (BACKSPACE) и быстрое сохранение (F5/F9)
+        self.snapshots = deque(maxlen=round(REWIND_SECONDS / REWIND_STEP))
+        self.quick_save = None
+        self.rewinding = False
+        # Таймеры фаз кадра: F3 - включить с графиком, F4 - выгрузить
+        self.timer = NULL_FRAME_TIMER
+        self.frame_timer = None
+        self.timer_overlay = None
+        self.high_score = 0
         self.game_state = GameState.MENU
         self.difficulty = Difficulty.NORMAL
         self.difficulty_selected = False
@@ -437,8 +4162,10 @@ class TankGame(arcade.Window):
         self.can_shoot = True
         self.mouse_x = 0
         self.mouse_y = 0
-        self.powerup_timer = 0
+        self.fire_pressed = False
         self.load_high_score()
+        self.create_text_layers()
+        self.health_bars = HealthBarRenderer()
         arcade.set_background_color((30, 30, 30))
 
         if not os.path.exists("images"):
@@ -503,149 +4230,178 @@ class TankGame(arcade.Window):
             self.high_score = 0
 
     def save_high_score(self):
-        if self.score > self.high_score:
-            self.high_score = self.score
+        if self.sim.score > self.high_score:
+            self.high_score = self.sim.score
             with open("highscore.json", "w") as f:
                 json.dump({"high_score": self.high_score}, f)
 
     def setup(self):
-        self.player_list = arcade.SpriteList()
-        self.enemy_list = arcade.SpriteList()
-        self.bullet_list = arcade.SpriteList()
-        self.enemy_bullet_list = arcade.SpriteList()
-        self.obstacle_list = arcade.SpriteList()
-        self.explosion_list = arcade.SpriteList()
-        self.powerup_list = arcade.SpriteList()
-        self.particle_system = ParticleSystem()
-
-        self.player = PlayerTank(self.difficulty)
-        self.player.center_x = SCREEN_WIDTH // 2
-        self.player.center_y = 100
-        self.player_list.append(self.player)
-
-        self.score = 0
-        self.wave = 1
-        self.enemies_to_spawn = self.enemies_per_wave + self.wave
-        self.create_obstacles()
-        self.spawn_wave()
-
-    def create_obstacles(self):
-        # НЕРАЗРУШАЕМЫЕ ПРЕПЯТСТВИЯ
-        for x in range(50, SCREEN_WIDTH - 50, 60):
-            for y in [50, SCREEN_HEIGHT - 50]:
-                obstacle = Obstacle(60, 60, (169, 169, 169))
-                obstacle.center_x = x
-                obstacle.center_y = y
-                obstacle.is_destructible = False
-                self.obstacle_list.append(obstacle)
-
-        for y in range(110, SCREEN_HEIGHT - 110, 60):
-            for x in [50, SCREEN_WIDTH - 50]:
-                obstacle = Obstacle(60, 60, (169, 169, 169))
-                obstacle.center_x = x
-                obstacle.center_y = y
-                obstacle.is_destructible = False
-                self.obstacle_list.append(obstacle)
-
-        # РАЗРУШАЕМЫЕ ПРЕПЯТСТВИЯ
-        for _ in range(8):
-            obstacle = Obstacle(60, 60, (178, 34, 34))
-            obstacle.is_destructible = True
-            while True:
-                x = random.randint(100, SCREEN_WIDTH - 100)
-                y = random.randint(150, SCREEN_HEIGHT - 150)
-                if (abs(x - self.player.center_x) > 100 and
-                        abs(y - self.player.center_y) > 100):
-                    break
-            obstacle.center_x = x
-            obstacle.center_y = y
-            self.obstacle_list.append(obstacle)
-
-    def spawn_enemy(self):
-        enemy_type = random.choices(
-            ["normal", "fast", "heavy"],
-            weights=[0.6, 0.25, 0.15],
-            k=1
-        )[0]
-
-        enemy = EnemyTank(self.player, enemy_type)
-
-        side = random.choice(["top", "bottom", "left", "right"])
-        if side == "top":
-            enemy.center_x = random.randint(100, SCREEN_WIDTH - 100)
-            enemy.center_y = SCREEN_HEIGHT - 100
-            enemy.direction = "DOWN"
-        elif side == "bottom":
-            enemy.center_x = random.randint(100, SCREEN_WIDTH - 100)
-            enemy.center_y = 100
-            enemy.direction = "UP"
-        elif side == "left":
-            enemy.center_x = 100
-            enemy.center_y = random.randint(150, SCREEN_HEIGHT - 150)
-            enemy.direction = "RIGHT"
+        self.save_replay()
+        seed = self.rng.getrandbits(64)
+        self.sim = Simulation(self.difficulty, self.batch_ai, seed,
+                              world_width=self.world_width,
+                              world_height=self.world_height, level=self.level,
+                              arena_per_wave=self.arena_per_wave,
+                              tick_rate=self.tick_rate)
+        self.sim.timer = self.timer
+        self.replay = Replay(seed, self.difficulty, self.batch_ai,
+                             self.sim.world_width, self.sim.world_height, self.level,
+                             arena_per_wave=self.arena_per_wave,
+                             tick_rate=self.tick_rate)
+        self.snapshots.clear()
+        self.quick_save = None
+        self.previous = {}
+        self.upload_walls()
+        self.update_camera()
+        self.fire_pressed = False
+
+    def resume(self, path):
+        # Продолжение матча из файла снимка - автосохранения после сбоя или
+        # быстрого сохранения. Повтор не пишется: матч начат не с начала
+        with open(path, "rb") as f:
+            blob = f.read()
+        self.save_replay()
+        self.replay = None
+        self.sim = load_match(blob)
+        self.sim.timer = self.timer
+        self.difficulty = self.sim.difficulty
+        self.difficulty_selected = True
+        self.tick_rate = self.sim.tick_rate
+        self.tick_time = 1 / self.tick_rate
+        self.snapshots.clear()
+        self.quick_save = None
+        self.previous = {}
+        self.upload_walls()
+        self.update_camera()
+        self.fire_pressed = False
+        self.game_state = GameState.PAUSED
+
+    def take_snapshot(self):
+        # Раз в REWIND_STEP секунд матча - снимок в кольцо перемотки
+        sim = self.sim
+        step = max(1, round(REWIND_STEP * sim.tick_rate))
+        if sim.tick % step:
+            return
+        state = sim.save_state()
+        self.snapshots.append((state, self.replay.mark() if self.replay else None))
+        if sim.tick % (step * AUTOSAVE_STEPS) == 0:
+            save_state_file(os.path.join(STATE_DIR, "autosave.tnks"), state)
+
+    def restore(self, state, mark, data=None):
+        self.sim.load_state(state)
+        if self.replay is not None and mark is not None:
+            self.replay.rewind(mark, data)
+        self.previous = {}
+
+    def rewind(self):
+        # Шаг назад по кольцу снимков за тик; самый старый снимок остаётся
+        if not self.snapshots:
+            return
+        if len(self.snapshots) > 1:
+            state, mark = self.snapshots.pop()
         else:
-            enemy.center_x = SCREEN_WIDTH - 100
-            enemy.center_y = random.randint(150, SCREEN_HEIGHT - 150)
-            enemy.direction = "LEFT"
-
-        enemy.enemy_bullet_list = self.enemy_bullet_list
-        enemy.obstacle_list = self.obstacle_list
-        self.enemy_list.append(enemy)
-
-    def spawn_wave(self):
-        self.wave += 1
-        self.enemies_to_spawn = self.enemies_per_wave + self.wave
-        for _ in range(self.enemies_to_spawn):
-            self.spawn_enemy()
-
-    def spawn_powerup(self, x, y):
-        powerup_type = random.choice(list(PowerUpType))
-        powerup = PowerUp(powerup_type)
-        powerup.center_x = x
-        powerup.center_y = y
-        self.powerup_list.append(powerup)
-
-    def apply_powerup(self, powerup):
-        if powerup.type == PowerUpType.HEALTH:
-            self.player.health = min(
-                self.player.max_health, self.player.health + 2
-            )
-        elif powerup.type == PowerUpType.SPEED:
-            self.player.speed_multiplier = 1.5
-            arcade.schedule(self.reset_speed, 10.0)
-        elif powerup.type == PowerUpType.DAMAGE:
-            self.player.damage_multiplier = 2.0
-            arcade.schedule(self.reset_damage, 15.0)
-        elif powerup.type == PowerUpType.RAPID_FIRE:
-            self.player.shoot_delay = 5
-            arcade.schedule(self.reset_fire_rate, 10.0)
-
-    def reset_speed(self, delta_time):
-        self.player.speed_multiplier = 1.0
-
-    def reset_damage(self, delta_time):
-        self.player.damage_multiplier = 1.0
-
-    def reset_fire_rate(self, delta_time):
-        self.player.shoot_delay = 15
+            state, mark = self.snapshots[0]
+        self.restore(state, mark)
+
+    def quick_save_match(self):
+        state = self.sim.save_state()
+        mark = data = None
+        if self.replay is not None:
+            mark = self.replay.mark()
+            data = bytes(self.replay.data[:mark[0]])
+        self.quick_save = (state, mark, data)
+        save_state_file(os.path.join(STATE_DIR, "quicksave.tnks"), state)
+
+    def quick_load_match(self):
+        if self.quick_save is None:
+            return
+        self.restore(*self.quick_save)
+        # Снимки в кольце могли остаться с другой ветки матча
+        self.snapshots.clear()
+
+    def upload_walls(self):
+        x, y, half_width, half_height = np.array(
+            [(wall.center_x, wall.center_y, wall.width / 2, wall.height / 2)
+             for wall in self.sim.walls], dtype=np.float64).reshape(-1, 4).T
+        data = np.empty(len(x), dtype=RECT_VERTEX_DTYPE)
+        data["rect"] = np.column_stack((x - half_width, y - half_height,
+                                        x + half_width, y + half_height))
+        data["color"] = arcade.get_four_byte_color((169, 169, 169))
+        self.walls.upload(data)
+
+    def save_replay(self):
+        # Повтор каждого сыгранного матча лежит в replays/ - по нему
+        # можно воспроизвести игру: python tanks.py --replay ФАЙЛ
+        if self.replay is None or self.replay.ticks == 0:
+            return
+        name = time.strftime("%Y%m%d_%H%M%S") + f"_{self.replay.seed:016x}.tnkr"
+        self.replay.save(os.path.join(REPLAY_DIR, name))
+        self.replay = None
+
+    def on_close(self):
+        self.save_replay()
+        super().on_close()
+
+    def update_camera(self):
+        # Игрок в центре экрана, у краёв мира камера останавливается
+        player = self.sim.player
+        self.view_x = max(0, min(self.sim.world_width - SCREEN_WIDTH,
+                                 int(player.center_x) - SCREEN_WIDTH // 2))
+        self.view_y = max(0, min(self.sim.world_height - SCREEN_HEIGHT,
+                                 int(player.center_y) - SCREEN_HEIGHT // 2))
+        self.camera.move_to((self.view_x, self.view_y), 1.0)
+
+    def interpolate(self):
+        # Ставит танки между прошлым и текущим тиком, возвращает текущие
+        # позиции, чтобы вернуть их после отрисовки
+        current = []
+        alpha = self.alpha
+        for sprite, (x0, y0) in self.previous.items():
+            x1 = sprite.center_x
+            y1 = sprite.center_y
+            if (x0 == x1 and y0 == y1) or \
+                    abs(x1 - x0) + abs(y1 - y0) > MAX_LERP_DISTANCE:
+                continue
+            current.append((sprite, x1, y1))
+            sprite.center_x = x0 + (x1 - x0) * alpha
+            sprite.center_y = y0 + (y1 - y0) * alpha
+        return current
 
     def on_draw(self):
+        timer = self.timer
+        timer.begin()
         self.clear()
-        self.obstacle_list.draw()
-        self.powerup_list.draw()
-        self.player_list.draw()
-        self.enemy_list.draw()
-        self.bullet_list.draw()
-        self.enemy_bullet_list.draw()
-        self.explosion_list.draw()
-        self.particle_system.draw()
-
-        for enemy in self.enemy_list:
-            enemy.draw_health_bar()
-
-        if self.player.is_alive:
-            self.player.draw_health_bar()
-
+        self.sim.sync_sprites()
+        current = self.interpolate()
+        self.update_camera()
+        self.camera.use()
+        # Рисуется только то, что попадает на экран: препятствия - целыми
+        # чанками, пули и полоски здоровья - по маске
+        view = (self.view_x, self.view_y, self.view_x + SCREEN_WIDTH,
+                self.view_y + SCREEN_HEIGHT)
+        self.walls.render()
+        for obstacles in self.sim.visible_obstacles(*view):
+            obstacles.draw()
+        self.sim.powerup_list.draw()
+        self.sim.player_list.draw()
+        self.sim.enemy_list.draw()
+        timer.lap(PHASE_DRAW_WORLD)
+        self.sim.bullets.draw(view, self.alpha if self.previous else 1.0)
+        timer.lap(PHASE_DRAW_BULLETS)
+        self.sim.explosion_list.draw()
+        self.sim.particle_system.draw()
+        timer.lap(PHASE_DRAW_EFFECTS)
+
+        tanks = list(self.sim.enemy_list)
+        if self.sim.player.is_alive:
+            tanks.append(self.sim.player)
+        self.health_bars.draw(tanks, view)
+        timer.lap(PHASE_DRAW_HEALTH)
+        for sprite, x, y in current:
+            sprite.center_x = x
+            sprite.center_y = y
+
+        self.gui_camera.use()
         self.draw_hud()
 
         if self.game_state == GameState.GAME_OVER:
@@ -654,395 +4410,228 @@ class TankGame(arcade.Window):
             self.draw_menu()
         elif self.game_state == GameState.PAUSED:
             self.draw_pause_screen()
+        timer.lap(PHASE_DRAW_HUD)
 
-    def draw_hud(self):
-        health_text = f"Здоровье: {self.player.health}/{self.player.max_health}"
-        arcade.draw_text(
-            health_text, 10, SCREEN_HEIGHT - 30, arcade.color.WHITE, 20
-        )
-
-        score_text = f"Очки: {self.score}"
-        arcade.draw_text(
-            score_text, 10, SCREEN_HEIGHT - 60, arcade.color.WHITE, 20
-        )
-
-        high_score_text = f"Рекорд: {self.high_score}"
-        arcade.draw_text(
-            high_score_text, 10, SCREEN_HEIGHT - 90, arcade.color.GOLD, 20
-        )
-
-        enemies_text = f"Врагов: {len(self.enemy_list)}"
-        arcade.draw_text(
-            enemies_text, 10, SCREEN_HEIGHT - 120, arcade.color.WHITE, 20
-        )
-
-        wave_text = f"Волна: {self.wave}"
-        arcade.draw_text(
-            wave_text, SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30,
-            arcade.color.WHITE, 20, anchor_x="right"
-        )
+        if self.timer is not NULL_FRAME_TIMER:
+            self.timer_overlay.draw(self.frame_timer)
 
-        difficulty_text = f"Сложность: {self.difficulty.value}"
-        arcade.draw_text(
-            difficulty_text, SCREEN_WIDTH - 10, SCREEN_HEIGHT - 60,
-            arcade.color.WHITE, 16, anchor_x="right"
-        )
-
-        control_text = "WASD - движение, ЛКМ/ПРОБЕЛ - стрельба"
-        arcade.draw_text(
-            control_text, SCREEN_WIDTH // 2, 30,
-            arcade.color.LIGHT_GRAY, 16, anchor_x="center"
-        )
-
-        pause_text = "P - пауза"
-        arcade.draw_text(
-            pause_text, SCREEN_WIDTH - 10, SCREEN_HEIGHT - 90,
-            arcade.color.LIGHT_GRAY, 16, anchor_x="right"
-        )
+    def toggle_timers(self):
+        if self.frame_timer is None:
+            self.frame_timer = FrameTimer()
+            self.timer_overlay = FrameTimerOverlay(10, SCREEN_HEIGHT - 320)
+        if self.timer is NULL_FRAME_TIMER:
+            self.timer = self.frame_timer
+        else:
+            self.timer = NULL_FRAME_TIMER
+        self.sim.timer = self.timer
 
+    def export_timers(self):
+        if self.frame_timer is None:
+            return
+        name = os.path.join(TIMINGS_DIR, time.strftime("frames_%Y%m%d_%H%M%S"))
+        self.frame_timer.export(name + ".json")
+        self.frame_timer.export(name + ".csv")
+
+    def create_text_layers(self):
+        self.hud = TextLayer()
+        self.hud.add("health", "Здоровье: {}/{}", 10, SCREEN_HEIGHT - 30,
+                     arcade.color.WHITE, 20)
+        self.hud.add("score", "Очки: {}", 10, SCREEN_HEIGHT - 60,
+                     arcade.color.WHITE, 20)
+        self.hud.add("high_score", "Рекорд: {}", 10, SCREEN_HEIGHT - 90,
+                     arcade.color.GOLD, 20)
+        self.hud.add("enemies", "Врагов: {}", 10, SCREEN_HEIGHT - 120,
+                     arcade.color.WHITE, 20)
+        self.hud.add("wave", "Волна: {}", SCREEN_WIDTH - 150, SCREEN_HEIGHT - 30,
+                     arcade.color.WHITE, 20, anchor_x="right")
+        self.hud.add("difficulty", "Сложность: {}", SCREEN_WIDTH - 10,
+                     SCREEN_HEIGHT - 60, arcade.color.WHITE, 16, anchor_x="right")
+        self.hud.add("controls", "WASD - движение, ЛКМ/ПРОБЕЛ - стрельба",
+                     SCREEN_WIDTH // 2, 30, arcade.color.LIGHT_GRAY, 16,
+                     anchor_x="center")
+        self.hud.add("pause", "P - пауза", SCREEN_WIDTH - 10, SCREEN_HEIGHT - 90,
+                     arcade.color.LIGHT_GRAY, 16, anchor_x="right")
         # Индикаторы улучшений
-        if self.player.speed_multiplier > 1.0:
-            arcade.draw_text(
-                "⚡", self.player.center_x,
-                self.player.center_y + 50,
-                arcade.color.YELLOW, 20, anchor_x="center"
-            )
+        self.hud.add("speed", "⚡", 0, 0, arcade.color.YELLOW, 20,
+                     anchor_x="center")
+        self.hud.add("damage", "⚔️", 0, 0, arcade.color.RED, 20,
+                     anchor_x="center")
+
+        self.menu = TextLayer()
+        self.menu.add("title", "ТАНЧИКИ", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 150,
+                      arcade.color.CYAN, 60, anchor_x="center", bold=True)
+        self.menu.add("choose", "ВЫБЕРИТЕ СЛОЖНОСТЬ", SCREEN_WIDTH // 2,
+                      SCREEN_HEIGHT // 2 + 80, arcade.color.WHITE, 35,
+                      anchor_x="center")
+        self.menu.add("easy", "1 - ЛЕГКО", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 20,
+                      arcade.color.LIGHT_GRAY, 30, anchor_x="center")
+        self.menu.add("normal", "2 - НОРМАЛЬНО", SCREEN_WIDTH // 2,
+                      SCREEN_HEIGHT // 2 - 30, arcade.color.LIGHT_GRAY, 30,
+                      anchor_x="center")
+        self.menu.add("hard", "3 - СЛОЖНО", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 80,
+                      arcade.color.LIGHT_GRAY, 30, anchor_x="center")
+        self.menu.add("confirm", "Нажмите ENTER для начала игры", SCREEN_WIDTH // 2,
+                      SCREEN_HEIGHT // 2 - 150, arcade.color.WHITE, 25,
+                      anchor_x="center")
+        self.menu.add("start", "Нажмите ПРОБЕЛ для начала игры", SCREEN_WIDTH // 2,
+                      SCREEN_HEIGHT // 2 + 40, arcade.color.WHITE, 30,
+                      anchor_x="center")
+        self.menu.add("controls", "Управление: WASD - движение, ЛКМ/ПРОБЕЛ - стрельба",
+                      SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
+                      arcade.color.LIGHT_GRAY, 20, anchor_x="center")
+        self.menu.add("high_score", "Текущий рекорд: {}", SCREEN_WIDTH // 2,
+                      SCREEN_HEIGHT // 2 - 140, arcade.color.GOLD, 25,
+                      anchor_x="center")
+        self.menu.add("quit", "ESC - выход из игры", SCREEN_WIDTH // 2,
+                      SCREEN_HEIGHT // 2 - 180, arcade.color.WHITE, 20,
+                      anchor_x="center")
+
+        self.pause_text = TextLayer()
+        self.pause_text.add("title", "ПАУЗА", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 50,
+                            arcade.color.CYAN, 60, anchor_x="center", bold=True)
+        self.pause_text.add("continue", "Нажмите P для продолжения", SCREEN_WIDTH // 2,
+                            SCREEN_HEIGHT // 2 - 50, arcade.color.WHITE, 30,
+                            anchor_x="center")
+        self.pause_text.add("quit", "ESC - выход в меню", SCREEN_WIDTH // 2,
+                            SCREEN_HEIGHT // 2 - 100, arcade.color.WHITE, 25,
+                            anchor_x="center")
+        self.pause_text.add("saves", "F5 - сохранить, F9 - загрузить, BACKSPACE - перемотка",
+                            SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 150,
+                            arcade.color.LIGHT_GRAY, 18, anchor_x="center")
+
+        self.death_text = TextLayer()
+        self.death_text.add("title", "ВЫ ПРОИГРАЛИ!", SCREEN_WIDTH // 2,
+                            SCREEN_HEIGHT // 2 + 100, arcade.color.RED, 60,
+                            anchor_x="center", bold=True)
+        self.death_text.add("score", "Ваш счет: {}", SCREEN_WIDTH // 2,
+                            SCREEN_HEIGHT // 2 + 40, arcade.color.WHITE, 40,
+                            anchor_x="center")
+        self.death_text.add("high_score", "Рекорд: {}", SCREEN_WIDTH // 2,
+                            SCREEN_HEIGHT // 2, arcade.color.GOLD, 35,
+                            anchor_x="center")
+        self.death_text.add("killed", "Убито врагов: {}", SCREEN_WIDTH // 2,
+                            SCREEN_HEIGHT // 2 - 40, arcade.color.WHITE, 30,
+                            anchor_x="center")
+        self.death_text.add("restart", "Нажмите ENTER или R чтобы начать заново",
+                            SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
+                            arcade.color.WHITE, 25, anchor_x="center")
+        self.death_text.add("menu", "Нажмите ESC чтобы выйти в меню",
+                            SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 140,
+                            arcade.color.WHITE, 25, anchor_x="center")
 
-        if self.player.damage_multiplier > 1.0:
-            arcade.draw_text(
-                "⚔️", self.player.center_x + 20,
-                      self.player.center_y + 50,
-                arcade.color.RED, 20, anchor_x="center"
-            )
+    def draw_hud(self):
+        player = self.sim.player
+        self.hud.set("health", player.health, player.max_health)
+        self.hud.set("score", self.sim.score)
+        self.hud.set("high_score", self.high_score)
+        self.hud.set("enemies", len(self.sim.enemy_list))
+        self.hud.set("wave", self.sim.wave)
+        self.hud.set("difficulty", self.difficulty.value)
+
+        self.hud.set_visible("speed", player.speed_multiplier > 1.0)
+        x = player.center_x - self.view_x
+        y = player.center_y - self.view_y
+        self.hud.set_position("speed", x, y + 50)
+        self.hud.set_visible("damage", player.damage_multiplier > 1.0)
+        self.hud.set_position("damage", x + 20, y + 50)
+
+        self.hud.draw()
 
     def draw_menu(self):
         arcade.draw_lrbt_rectangle_filled(
             0, SCREEN_WIDTH, 0, SCREEN_HEIGHT, (0, 0, 0, 200)
         )
 
-        arcade.draw_text(
-            "ТАНЧИКИ", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 150,
-            arcade.color.CYAN, 60, anchor_x="center", bold=True
-        )
-
-        if not self.difficulty_selected:
-            arcade.draw_text(
-                "ВЫБЕРИТЕ СЛОЖНОСТЬ", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 80,
-                arcade.color.WHITE, 35, anchor_x="center"
-            )
-
-            arcade.draw_text(
-                "1 - ЛЕГКО", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 20,
-                arcade.color.GREEN if self.difficulty == Difficulty.EASY else arcade.color.LIGHT_GRAY,
-                30, anchor_x="center"
-            )
-
-            arcade.draw_text(
-                "2 - НОРМАЛЬНО", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 30,
-                arcade.color.YELLOW if self.difficulty == Difficulty.NORMAL else arcade.color.LIGHT_GRAY,
-                30, anchor_x="center"
-            )
+        for key in ("choose", "easy", "normal", "hard", "confirm"):
+            self.menu.set_visible(key, not self.difficulty_selected)
+        self.menu.set_visible("start", self.difficulty_selected)
 
-            arcade.draw_text(
-                "3 - СЛОЖНО", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 80,
-                arcade.color.RED if self.difficulty == Difficulty.HARD else arcade.color.LIGHT_GRAY,
-                30, anchor_x="center"
-            )
-
-            arcade.draw_text(
-                "Нажмите ENTER для начала игры", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 150,
-                arcade.color.WHITE, 25, anchor_x="center"
-            )
-        else:
-            start_text = "Нажмите ПРОБЕЛ для начала игры"
-            arcade.draw_text(
-                start_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 40,
-                arcade.color.WHITE, 30, anchor_x="center"
-            )
-
-        controls_text = "Управление: WASD - движение, ЛКМ/ПРОБЕЛ - стрельба"
-        arcade.draw_text(
-            controls_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
-            arcade.color.LIGHT_GRAY, 20, anchor_x="center"
+        self.menu.set_color(
+            "easy",
+            arcade.color.GREEN if self.difficulty == Difficulty.EASY else arcade.color.LIGHT_GRAY
         )
-
-        high_score_text = f"Текущий рекорд: {self.high_score}"
-        arcade.draw_text(
-            high_score_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 140,
-            arcade.color.GOLD, 25, anchor_x="center"
+        self.menu.set_color(
+            "normal",
+            arcade.color.YELLOW if self.difficulty == Difficulty.NORMAL else arcade.color.LIGHT_GRAY
         )
-
-        quit_text = "ESC - выход из игры"
-        arcade.draw_text(
-            quit_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 180,
-            arcade.color.WHITE, 20, anchor_x="center"
+        self.menu.set_color(
+            "hard",
+            arcade.color.RED if self.difficulty == Difficulty.HARD else arcade.color.LIGHT_GRAY
         )
+        self.menu.set("high_score", self.high_score)
+        self.menu.draw()
 
     def draw_pause_screen(self):
         arcade.draw_lrbt_rectangle_filled(
             0, SCREEN_WIDTH, 0, SCREEN_HEIGHT, (0, 0, 0, 180)
         )
-
-        arcade.draw_text(
-            "ПАУЗА", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 50,
-            arcade.color.CYAN, 60, anchor_x="center", bold=True
-        )
-
-        continue_text = "Нажмите P для продолжения"
-        arcade.draw_text(
-            continue_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 50,
-            arcade.color.WHITE, 30, anchor_x="center"
-        )
-
-        quit_text = "ESC - выход в меню"
-        arcade.draw_text(
-            quit_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
-            arcade.color.WHITE, 25, anchor_x="center"
-        )
+        self.pause_text.draw()
 
     def draw_death_screen(self):
         arcade.draw_lrbt_rectangle_filled(
             0, SCREEN_WIDTH, 0, SCREEN_HEIGHT, (0, 0, 0, 200)
         )
 
-        arcade.draw_text(
-            "ВЫ ПРОИГРАЛИ!", SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 100,
-            arcade.color.RED, 60, anchor_x="center", bold=True
-        )
-
-        score_text = f"Ваш счет: {self.score}"
-        arcade.draw_text(
-            score_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 + 40,
-            arcade.color.WHITE, 40, anchor_x="center"
-        )
-
-        high_score_text = f"Рекорд: {self.high_score}"
-        arcade.draw_text(
-            high_score_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2,
-            arcade.color.GOLD, 35, anchor_x="center"
-        )
-
-        killed_text = f"Убито врагов: {self.score // 100}"
-        arcade.draw_text(
-            killed_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 40,
-            arcade.color.WHITE, 30, anchor_x="center"
-        )
-
-        restart_text = "Нажмите ENTER или R чтобы начать заново"
-        arcade.draw_text(
-            restart_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 100,
-            arcade.color.WHITE, 25, anchor_x="center"
-        )
-
-        menu_text = "Нажмите ESC чтобы выйти в меню"
-        arcade.draw_text(
-            menu_text, SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2 - 140,
-            arcade.color.WHITE, 25, anchor_x="center"
-        )
+        self.death_text.set("score", self.sim.score)
+        self.death_text.set("high_score", self.high_score)
+        self.death_text.set("killed", self.sim.score // 100)
+        self.death_text.draw()
 
     def on_update(self, delta_time):
+        self.timer.next_frame()
+        self.accumulator += min(delta_time, MAX_FRAME_TIME)
+        while self.accumulator >= self.tick_time:
+            self.accumulator -= self.tick_time
+            self.tick()
+        self.alpha = self.accumulator / self.tick_time
+
+    def tick(self):
+        # Перематывать можно и на паузе: подсказка об этом на её экране
+        if self.rewinding and self.game_state in (GameState.PLAYING, GameState.PAUSED):
+            self.rewind()
+            return
+
         if self.game_state != GameState.PLAYING:
-            self.explosion_list.update()
-            self.powerup_list.update()
+            self.previous = {}
+            self.sim.update_effects()
             return
 
-        if not self.player.is_alive:
+        if not self.sim.player.is_alive:
             self.game_state = GameState.GAME_OVER
+            self.previous = {}
             self.save_high_score()
+            self.save_replay()
             return
 
-        self.player.update()
-        self.particle_system.update()
-        self.powerup_list.update()
-
-        if len(self.enemy_list) == 0:
-            self.spawn_wave()
-
-        dx = self.mouse_x - self.player.center_x
-        dy = self.mouse_y - self.player.center_y
-        angle = math.degrees(math.atan2(dy, dx))
-
-        if -45 <= angle <= 45:
-            self.player.direction = "RIGHT"
-        elif 45 < angle <= 135:
-            self.player.direction = "UP"
-        elif angle > 135 or angle < -135:
-            self.player.direction = "LEFT"
-        else:
-            self.player.direction = "DOWN"
-
-        new_x = self.player.center_x
-        new_y = self.player.center_y
-        speed = TANK_SPEED * self.player.speed_multiplier
-
-        if self.left:
-            new_x -= speed
-        if self.right:
-            new_x += speed
-        if self.up:
-            new_y += speed
-        if self.down:
-            new_y -= speed
-
-        can_move = True
-        temp_x = self.player.center_x
-        temp_y = self.player.center_y
-        self.player.center_x = new_x
-        self.player.center_y = new_y
-
-        if arcade.check_for_collision_with_list(self.player, self.obstacle_list):
-            can_move = False
-
-        self.player.center_x = temp_x
-        self.player.center_y = temp_y
-
-        if can_move:
-            dx_move = 0
-            dy_move = 0
-            if self.left:
-                dx_move = -speed
-            if self.right:
-                dx_move = speed
-            if self.up:
-                dy_move = speed
-            if self.down:
-                dy_move = -speed
-
-            self.player.move_with_collision(dx_move, dy_move, self.obstacle_list)
-
-            if self.left:
-                self.particle_system.create_trail(
-                    self.player.center_x + 20,
-                    self.player.center_y,
-                    (0, 255, 255)
-                )
-            if self.right:
-                self.particle_system.create_trail(
-                    self.player.center_x - 20,
-                    self.player.center_y,
-                    (0, 255, 255)
-                )
-            if self.up:
-                self.particle_system.create_trail(
-                    self.player.center_x,
-                    self.player.center_y - 20,
-                    (0, 255, 255)
-                )
-            if self.down:
-                self.particle_system.create_trail(
-                    self.player.center_x,
-                    self.player.center_y + 20,
-                    (0, 255, 255)
-                )
-
-            self.player.center_x = max(
-                30, min(SCREEN_WIDTH - 30, self.player.center_x)
-            )
-            self.player.center_y = max(
-                30, min(SCREEN_HEIGHT - 30, self.player.center_y)
-            )
-
-        for enemy in self.enemy_list:
-            enemy.update()
-
-        self.bullet_list.update()
-        self.enemy_bullet_list.update()
-        self.explosion_list.update()
-
-        for bullet in self.bullet_list[:]:
-            hit_obstacles = arcade.check_for_collision_with_list(
-                bullet, self.obstacle_list
-            )
-            for obstacle in hit_obstacles:
-                if obstacle.is_destructible:
-                    obstacle.health -= bullet.damage
-                    if obstacle.health <= 0:
-                        explosion = Explosion(
-                            obstacle.center_x, obstacle.center_y
-                        )
-                        self.explosion_list.append(explosion)
-                        obstacle.remove_from_sprite_lists()
-                        self.score += 10
-                        if random.random() < 0.2:
-                            self.spawn_powerup(
-                                obstacle.center_x, obstacle.center_y
-                            )
-                bullet.remove_from_sprite_lists()
-                break
-
-        for bullet in self.enemy_bullet_list[:]:
-            hit_obstacles = arcade.check_for_collision_with_list(
-                bullet, self.obstacle_list
-            )
-            for obstacle in hit_obstacles:
-                if obstacle.is_destructible:
-                    obstacle.health -= bullet.damage
-                    if obstacle.health <= 0:
-                        explosion = Explosion(
-                            obstacle.center_x, obstacle.center_y
-                        )
-                        self.explosion_list.append(explosion)
-                        obstacle.remove_from_sprite_lists()
-                bullet.remove_from_sprite_lists()
-                break
-
-        enemies_to_remove = []
-        for bullet in self.bullet_list:
-            hit_list = arcade.check_for_collision_with_list(
-                bullet, self.enemy_list
-            )
-            for enemy in hit_list:
-                enemy.take_damage(bullet.damage)
-                if not enemy.is_alive:
-                    self.score += 100
-                    enemies_to_remove.append(enemy)
-                    explosion = Explosion(enemy.center_x, enemy.center_y, enemy.enemy_type)
-                    self.explosion_list.append(explosion)
-                    if random.random() < 0.1:
-                        self.spawn_powerup(enemy.center_x, enemy.center_y)
-                bullet.remove_from_sprite_lists()
-                break
-
-        for enemy in enemies_to_remove:
-            if enemy in self.enemy_list:
-                self.enemy_list.remove(enemy)
-
-        for bullet in self.enemy_bullet_list:
-            if self.player.is_alive and arcade.check_for_collision(
-                    bullet, self.player
-            ):
-                damage = bullet.damage
-                self.player.take_damage(damage)
-                bullet.remove_from_sprite_lists()
-                if self.player.health > 0:
-                    explosion = Explosion(
-                        self.player.center_x, self.player.center_y
-                    )
-                    explosion.textures = [
-                        arcade.make_circle_texture(
-                            20, arcade.color.RED
-                        )
-                    ]
-                    self.explosion_list.append(explosion)
-
-        for powerup in self.powerup_list:
-            if arcade.check_for_collision(self.player, powerup):
-                self.apply_powerup(powerup)
-                powerup.remove_from_sprite_lists()
-
-        self.powerup_timer += 1
-        if self.powerup_timer >= 600:
-            x = random.randint(50, SCREEN_WIDTH - 50)
-            y = random.randint(50, SCREEN_HEIGHT - 50)
-            self.spawn_powerup(x, y)
-            self.powerup_timer = 0
+        self.sim.sync_sprites()
+        self.previous = {sprite: (sprite.center_x, sprite.center_y)
+                         for sprites in (self.sim.player_list, self.sim.enemy_list)
+                         for sprite in sprites}
+        self.take_snapshot()
+        # Мышь в координатах экрана, прицел - в координатах мира
+        inputs = PlayerInput(
+            self.left, self.right, self.up, self.down,
+            self.mouse_x + self.view_x, self.mouse_y + self.view_y,
+            self.fire_pressed
+        )
+        if self.replay is not None:
+            inputs = self.replay.record(inputs)
+        self.sim.step(inputs)
+        self.fire_pressed = False
 
     def shoot(self):
-        if (self.player.is_alive and self.player.can_shoot() and
+        if (self.sim.player.is_alive and self.sim.player.can_shoot() and
                 self.game_state == GameState.PLAYING):
-            self.player.shoot(self.bullet_list, self.player_bullet_color)
+            self.fire_pressed = True
 
     def on_key_press(self, key, modifiers):
+        if key == arcade.key.F3:
+            self.toggle_timers()
+            return
+        if key == arcade.key.F4:
+            self.export_timers()
+            return
+
         if self.game_state == GameState.MENU:
             if key == arcade.key.ENTER and not self.difficulty_selected:
                 self.difficulty_selected = True
@@ -1074,6 +4663,13 @@ class TankGame(arcade.Window):
             elif key == arcade.key.ESCAPE:
                 self.game_state = GameState.MENU
                 self.difficulty_selected = False
+                self.save_replay()
+            elif key == arcade.key.F5:
+                self.quick_save_match()
+            elif key == arcade.key.F9:
+                self.quick_load_match()
+            elif key == arcade.key.BACKSPACE:
+                self.rewinding = True
             return
 
         if key == arcade.key.P:
@@ -1083,7 +4679,13 @@ class TankGame(arcade.Window):
                 self.game_state = GameState.PLAYING
             return
 
-        if key == arcade.key.A:
+        if key == arcade.key.F5:
+            self.quick_save_match()
+        elif key == arcade.key.F9:
+            self.quick_load_match()
+        elif key == arcade.key.BACKSPACE:
+            self.rewinding = True
+        elif key == arcade.key.A:
             self.left = True
         elif key == arcade.key.D:
             self.right = True
@@ -1097,7 +4699,9 @@ class TankGame(arcade.Window):
                 self.shoot()
 
     def on_key_release(self, key, modifiers):
-        if key == arcade.key.A:
+        if key == arcade.key.BACKSPACE:
+            self.rewinding = False
+        elif key == arcade.key.A:
             self.left = False
         elif key == arcade.key.D:
             self.right = False
@@ -1118,6 +4722,144 @@ class TankGame(arcade.Window):
         self.mouse_y = y
 
 
+def export_timings(timer, path):
+    timer.export(path)
+    mean = timer.recent()[:, :PHASE_DRAW_WORLD].mean(axis=0) * 1e6
+    print("среднее по фазам, мкс: " + ", ".join(
+        f"{name} {value:.1f}" for name, value in zip(PHASES, mean)))
+
+
+def print_pool_stats(stats):
+    for name, pool in stats.items():
+        print(f"пул {name}: выдано {pool['acquired']}, повторно {pool['hit_rate']:.0%}, "
+              f"максимум {pool['high_water']}")
+
+
+def run_headless(ticks, difficulty, batch_ai=False, seed=None, timings=None,
+                 world=(SCREEN_WIDTH, SCREEN_HEIGHT), level=None, arena_per_wave=False,
+                 tick_rate=TICK_RATE):
+    sim = Simulation(difficulty, batch_ai, seed, world_width=world[0],
+                     world_height=world[1], level=level, arena_per_wave=arena_per_wave,
+                     tick_rate=tick_rate)
+    if timings:
+        sim.timer = FrameTimer()
+    start = time.perf_counter()
+    done = sim.run(ticks)
+    elapsed = time.perf_counter() - start
+    print(f"{done} тиков за {elapsed:.2f} с ({done / elapsed:.0f} тиков/с), "
+          f"волна {sim.wave}, очки {sim.score}")
+    print_pool_stats(sim.pool_stats())
+    if timings:
+        export_timings(sim.timer, timings)
+
+
+def load_match(blob, effects=True):
+    # Матч из снимка save_state() - например, после сбоя из автосохранения
+    sim = Simulation(effects=effects, **read_state_header(blob))
+    sim.load_state(blob)
+    return sim
+
+
+def save_state_file(path, blob):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Через временный файл: сбой посреди записи не портит прежний снимок
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(blob)
+    os.replace(temporary, path)
+
+
+def play_replay(path, timings=None):
+    # Пересчёт матча из файла повтора без окна и отрисовки
+    replay = Replay.load(path)
+    sim = Simulation(replay.difficulty, replay.batch_ai, replay.seed,
+                     effects=False, world_width=replay.world_width,
+                     world_height=replay.world_height, level=replay.level,
+                     arena=replay.arena, arena_per_wave=replay.arena_per_wave,
+                     enemy_movement=replay.enemy_movement,
+                     enemy_sight=replay.enemy_sight,
+                     swept_bullets=replay.swept_bullets, tick_rate=replay.tick_rate)
+    if timings:
+        sim.timer = FrameTimer()
+    start = time.perf_counter()
+    done = 0
+    for inputs in replay.inputs():
+        if not sim.step(inputs):
+            break
+        sim.timer.next_frame()
+        done += 1
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print(f"{done} из {replay.ticks} тиков за {elapsed:.2f} с "
+          f"({done / replay.tick_rate / elapsed:.0f}x реального времени)")
+    print(f"зерно {replay.seed:016x}, сложность {replay.difficulty.value}, "
+          f"волна {sim.wave}, очки {sim.score}, здоровье {sim.player.health}")
+    if timings:
+        export_timings(sim.timer, timings)
+    return sim
+
+
 if __name__ == "__main__":
-    game = TankGame()
-    arcade.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=SCREEN_TITLE)
+    parser.add_argument("--headless", type=int, metavar="TICKS",
+                        help="прогнать симуляцию без окна")
+    parser.add_argument("--difficulty", choices=[d.value for d in Difficulty],
+                        default=Difficulty.NORMAL.value)
+    parser.add_argument("--batch-ai", action="store_true",
+                        help="пакетный ИИ врагов на массивах NumPy")
+    parser.add_argument("--seed", type=int, help="зерно генератора случайных чисел")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="воспроизвести повтор без окна")
+    parser.add_argument("--resume", metavar="FILE",
+                        help="продолжить матч из снимка .tnks (saves/autosave.tnks "
+                             "после сбоя, saves/quicksave.tnks - быстрое сохранение)")
+    parser.add_argument("--world", type=int, nargs=2, metavar=("W", "H"),
+                        default=[SCREEN_WIDTH, SCREEN_HEIGHT],
+                        help="размер мира в пикселях, не меньше экрана")
+    parser.add_argument("--level", metavar="FILE",
+                        help="уровень .tnkl вместо случайной арены")
+    parser.add_argument("--arena-per-wave", action="store_true",
+                        help="новая расстановка блоков перед каждой волной")
+    parser.add_argument("--build-level", nargs=2, metavar=("TXT", "TNKL"),
+                        help="собрать уровень из текстового исходника")
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE,
+                        help="размер клетки для --build-level, пикселей")
+    parser.add_argument("--tick-rate", type=int, default=TICK_RATE,
+                        help=f"тиков симуляции в секунду, не меньше {MIN_TICK_RATE}")
+    parser.add_argument("--fps", type=int, default=FRAME_RATE,
+                        help="кадров отрисовки в секунду")
+    parser.add_argument("--timings", metavar="FILE",
+                        help="записать время фаз тиков в .json или .csv "
+                             "(для --headless и --replay)")
+    args = parser.parse_args()
+    if args.world[0] < SCREEN_WIDTH or args.world[1] < SCREEN_HEIGHT:
+        parser.error(f"мир не может быть меньше экрана {SCREEN_WIDTH}x{SCREEN_HEIGHT}")
+    if args.tick_rate < MIN_TICK_RATE:
+        parser.error(f"частота тиков не может быть меньше {MIN_TICK_RATE}")
+
+    if args.build_level is not None:
+        source, target = args.build_level
+        with open(source, encoding="utf-8") as f:
+            tiles = parse_level_text(f)
+        save_level(target, tiles, args.tile_size)
+        level = load_level(target)
+        print(f"{target}: {tiles.shape[1]}x{tiles.shape[0]} клеток, "
+              f"стен {len(level.walls)} прямоугольников, блоков {len(level.bricks)}")
+    elif args.replay is not None:
+        play_replay(args.replay, args.timings)
+    elif args.headless is not None:
+        run_headless(args.headless, Difficulty(args.difficulty), args.batch_ai,
+                     args.seed, args.timings, args.world, args.level,
+                     args.arena_per_wave, args.tick_rate)
+    else:
+        game = TankGame(args.batch_ai, args.seed, *args.world, args.level,
+                        args.arena_per_wave, args.tick_rate, args.fps)
+        if args.resume is not None:
+            game.resume(args.resume)
+        if args.fps == FRAME_RATE:
+            arcade.run()
+        else:
+            # arcade.run() перерисовывает окно с частотой по умолчанию
+            # (60 раз в секунду), поэтому цикл pyglet запускается напрямую
+            pyglet.app.run(1 / args.fps)
\ No newline at end of file
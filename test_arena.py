@@ -0,0 +1,84 @@
+import random
+from collections import deque
+
+import numpy as np
+import pytest
+
+from tanks import (ARENA_MARGIN, ARENA_PITCH, ENEMY_TYPES, Simulation, generate_blocks,
+                   tank_collision_half)
+
+# Шаг растра, по которому ищется путь: центр танка ставится в его узлы
+STEP = 5
+SIZES = [(800, 600), (1200, 900), (1600, 1200), (3200, 2400)]
+
+
+def largest_half():
+    return max(tank_collision_half(kind) for kind in ["player"] + ENEMY_TYPES)
+
+
+def passable(width, height, boxes, half):
+    # Узлы растра, где танк полуразмера half не задевает ни одного
+    # прямоугольника (центр, полуразмеры) и не выезжает за край мира
+    xs = np.arange(half, width - half + 1, STEP)
+    ys = np.arange(half, height - half + 1, STEP)
+    free = np.ones((len(ys), len(xs)), dtype=bool)
+    for x, y, half_width, half_height in boxes:
+        free[np.ix_(np.abs(ys - y) < half_height + half,
+                    np.abs(xs - x) < half_width + half)] = False
+    return xs, ys, free
+
+
+def reachable(free, row, column):
+    # Поиск в ширину по соседним узлам растра
+    rows, columns = free.shape
+    cells = free.ravel().tolist()
+    seen = [False] * len(cells)
+    start = row * columns + column
+    seen[start] = cells[start]
+    queue = deque([start] if cells[start] else [])
+    while queue:
+        index = queue.popleft()
+        row, column = divmod(index, columns)
+        for other, inside in ((index - columns, row > 0), (index + columns, row < rows - 1),
+                              (index - 1, column > 0), (index + 1, column < columns - 1)):
+            if inside and cells[other] and not seen[other]:
+                seen[other] = True
+                queue.append(other)
+    return np.array(seen).reshape(free.shape)
+
+
+def node(xs, ys, x, y):
+    return int(np.abs(ys - y).argmin()), int(np.abs(xs - x).argmin())
+
+
+@pytest.mark.parametrize("width, height", SIZES)
+@pytest.mark.parametrize("share", [0.6, 1.0])
+def test_generate_blocks_keeps_free_space_connected(width, height, share):
+    # Блоков просят на долю клеток решётки (1.0 - на все): генератор сам
+    # останавливается там, где следующий блок разорвал бы проезд
+    cells = ((width - 2 * ARENA_MARGIN) // ARENA_PITCH) * ((height - 2 * ARENA_MARGIN) //
+                                                           ARENA_PITCH)
+    half = largest_half()
+    for seed in range(8):
+        blocks = generate_blocks(random.Random(seed), width, height, int(cells * share), [])
+        assert blocks
+        xs, ys, free = passable(width, height, [(x, y, 30, 30) for x, y in blocks], half)
+        # Из угла мира доезжает до любого места, куда танк помещается
+        seen = reachable(free, 0, 0)
+        assert np.array_equal(seen, free), (seed, int(free.sum() - seen.sum()))
+
+
+@pytest.mark.parametrize("width, height", SIZES)
+def test_arena_connects_player_and_spawn_sides(width, height):
+    # Путь ищется для танка игрока: он стоит у нижней стены вплотную
+    for seed in range(6):
+        sim = Simulation(seed=seed, effects=False, world_width=width, world_height=height)
+        half = sim.player.get_collision_half()
+        boxes = [(obstacle.center_x, obstacle.center_y, obstacle.width / 2, obstacle.height / 2)
+                 for obstacle in sim.obstacle_grid.obstacles if obstacle is not None]
+        assert any(obstacle.is_destructible for obstacle in sim.obstacle_list)
+        xs, ys, free = passable(width, height, boxes, half)
+        seen = reachable(free, *node(xs, ys, sim.player.center_x, sim.player.center_y))
+        # Середина каждой линии появления врагов - в той же связной области
+        for x0, y0, x1, y1 in sim.spawn_zones():
+            assert seen[node(xs, ys, (x0 + x1) / 2, (y0 + y1) / 2)], (seed, (x0, y0, x1, y1))
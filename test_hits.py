@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from tanks import (segment_box_entry, segment_box_entry_scalar, segment_circle_entry,
+                   segment_circle_entry_scalar)
+
+
+def random_paths(rng, count):
+    # Пути в случайных направлениях рядом с прямоугольником и через него
+    px = rng.uniform(-120, 120, count)
+    py = rng.uniform(-120, 120, count)
+    dx = rng.uniform(-90, 90, count)
+    dy = rng.uniform(-90, 90, count)
+    half_width = rng.uniform(1, 40, count)
+    half_height = rng.uniform(1, 40, count)
+    radius = rng.uniform(1, 10, count)
+    return px, py, dx, dy, half_width, half_height, radius
+
+
+def axis_paths(rng, count):
+    # Пути вдоль осей на целых координатах, в том числе ровно по краю
+    # расширенного прямоугольника, где вход - касание
+    px, py, dx, dy, half_width, half_height, radius = [
+        np.round(values) for values in random_paths(rng, count)]
+    along_x = rng.random(count) < 0.5
+    dx = np.where(along_x, dx, 0.0)
+    dy = np.where(along_x, 0.0, dy)
+    edge = rng.random(count) < 0.3
+    side = np.where(rng.random(count) < 0.5, -1.0, 1.0)
+    py = np.where(edge & along_x, side * (half_height + radius), py)
+    px = np.where(edge & ~along_x, side * (half_width + radius), px)
+    return px, py, dx, dy, half_width, half_height, radius
+
+
+def corner_paths(rng, count):
+    # Пути через точку на скруглённом углу (чуть внутри, ровно на нём или
+    # чуть снаружи): вход решает окружность угла. Половина путей идёт по
+    # касательной к ней - едва задевает угол или проходит мимо
+    _, _, dx, dy, half_width, half_height, radius = random_paths(rng, count)
+    sign_x = np.where(rng.random(count) < 0.5, -1.0, 1.0)
+    sign_y = np.where(rng.random(count) < 0.5, -1.0, 1.0)
+    angle = rng.uniform(0, np.pi / 2, count)
+    distance = radius * rng.choice([1 - 1e-9, 1.0, 1 + 1e-9], count)
+    normal_x = sign_x * np.cos(angle)
+    normal_y = sign_y * np.sin(angle)
+    touch_x = sign_x * half_width + distance * normal_x
+    touch_y = sign_y * half_height + distance * normal_y
+    tangent = rng.random(count) < 0.5
+    step = np.hypot(dx, dy) * np.where(rng.random(count) < 0.5, -1.0, 1.0)
+    dx = np.where(tangent, -normal_y * step, dx)
+    dy = np.where(tangent, normal_x * step, dy)
+    share = rng.uniform(0, 1, count)
+    return (touch_x - share * dx, touch_y - share * dy, dx, dy, half_width, half_height,
+            radius)
+
+
+@pytest.mark.parametrize("paths", [random_paths, axis_paths, corner_paths])
+def test_scalar_box_entry_matches_vector(paths):
+    rng = np.random.default_rng(5)
+    pairs = paths(rng, 20000)
+    vector = segment_box_entry(*pairs)
+    scalar = np.array([segment_box_entry_scalar(*pair)
+                       for pair in zip(*[values.tolist() for values in pairs])])
+    # Проверка не пустая: есть и попадания, и промахи
+    assert 0 < np.isfinite(vector).sum() < len(vector)
+    assert np.array_equal(vector, scalar)
+
+
+@pytest.mark.parametrize("paths", [random_paths, axis_paths, corner_paths])
+def test_scalar_circle_entry_matches_vector(paths):
+    rng = np.random.default_rng(6)
+    px, py, dx, dy, half_width, _, radius = paths(rng, 20000)
+    # Круг того же размера, что и прямоугольник, касается тех же путей
+    radius = radius + half_width
+    vector = segment_circle_entry(px, py, dx, dy, radius)
+    scalar = np.array([segment_circle_entry_scalar(*pair) for pair in zip(
+        px.tolist(), py.tolist(), dx.tolist(), dy.tolist(), radius.tolist())])
+    assert 0 < np.isfinite(vector).sum() < len(vector)
+    assert np.array_equal(vector, scalar)
@@ -0,0 +1,41 @@
+import pytest
+
+from balance import scripted_policy
+from tanks import TICK_RATE, Difficulty, Replay, Simulation, play_replay
+
+
+def record_match(ticks, seed, difficulty=Difficulty.NORMAL, batch_ai=False,
+                 tick_rate=TICK_RATE):
+    # Матч бота с записью: на вход симуляции идёт тот же ввод, что в повторе
+    sim = Simulation(difficulty, batch_ai, seed, effects=False, tick_rate=tick_rate)
+    replay = Replay(seed, difficulty, batch_ai, tick_rate=tick_rate)
+    while sim.tick < ticks and sim.player.is_alive:
+        sim.step(replay.record(scripted_policy(sim)))
+    return sim, replay
+
+
+@pytest.mark.parametrize("settings", [
+    {"seed": 1, "difficulty": Difficulty.EASY},
+    {"seed": 7, "difficulty": Difficulty.HARD, "batch_ai": True},
+    {"seed": 3, "difficulty": Difficulty.EASY, "tick_rate": 30},
+])
+def test_replay_resimulates_match(settings):
+    sim, replay = record_match(1500, **settings)
+    blob = replay.to_bytes()
+    loaded = Replay.from_bytes(blob)
+    assert loaded.to_bytes() == blob
+    assert loaded.ticks == sim.tick
+
+    again = Simulation(loaded.difficulty, loaded.batch_ai, loaded.seed, effects=False,
+                       tick_rate=loaded.tick_rate)
+    for inputs in loaded.inputs():
+        again.step(inputs)
+    assert (again.tick, again.wave, again.score) == (sim.tick, sim.wave, sim.score)
+    assert again.save_state() == sim.save_state()
+
+
+def test_play_replay_matches_recording(tmp_path):
+    sim, replay = record_match(1500, seed=2)
+    path = tmp_path / "match.tnkr"
+    replay.save(str(path))
+    assert play_replay(str(path)).save_state() == sim.save_state()
@@ -0,0 +1,117 @@
+from server import (NET_FIELDS, NET_HEADER, PACKET_SNAPSHOT, SNAPSHOT_HEADER, SNAPSHOT_PART,
+                    NetClient, decode_delta, encode_delta, packet, snapshot_parts)
+
+
+def make_state(**categories):
+    state = {category: {} for category in NET_FIELDS}
+    state.update(categories)
+    return state
+
+
+def round_trip(base, state):
+    data = encode_delta(base, state)
+    return decode_delta(base, b"\0" * 3 + data, 3), data
+
+
+FIRST = make_state(
+    match={0: (120, 3)},
+    players={1: (400, 800, 0, 5, 5, 1), 2: (1200, 900, 2, 3, 5, 9)},
+    enemies={10: (2000, 2400, 1, 0, 2), 11: (3000, 200, 3, 2, 4)},
+    bullets={7: (1000, 1000, -24, 0, 4, 1 << 24 | 0xff00ff, 18)},
+    obstacles={0: (800, 800, 160, 160, 65535, 0), 3: (2400, 1600, 128, 64, 40, 1)},
+    powerups={4: (640, 480, 2)},
+)
+
+
+def test_full_snapshot_round_trip():
+    state, _ = round_trip({}, FIRST)
+    assert state == FIRST
+
+
+def test_delta_from_older_base():
+    second = make_state(**{category: dict(entities) for category, entities in FIRST.items()})
+    second["players"][1] = (404, 800, 0, 5, 5, 1)
+    second["enemies"][12] = (100, 100, 0, 1, 3)
+    third = make_state(**{category: dict(entities) for category, entities in second.items()})
+    third["players"][1] = (408, 804, 1, 4, 5, 3)
+    third["match"][0] = (220, 3)
+    # База старше прошлого снимка: в дельте всё, что изменилось с неё
+    state, _ = round_trip(FIRST, third)
+    assert state == third
+
+
+def test_deleted_entities():
+    newer = make_state(**{category: dict(entities) for category, entities in FIRST.items()})
+    del newer["enemies"][10]
+    del newer["bullets"][7]
+    del newer["obstacles"][3]
+    newer["powerups"] = {}
+    state, _ = round_trip(FIRST, newer)
+    assert state == newer
+    assert 10 not in state["enemies"] and 7 not in state["bullets"]
+
+
+def test_changed_field_subset():
+    newer = make_state(**{category: dict(entities) for category, entities in FIRST.items()})
+    # Меняется одно поле: прочность препятствия
+    newer["obstacles"][3] = (2400, 1600, 128, 64, 39, 1)
+    state, data = round_trip(FIRST, newer)
+    assert state == newer
+    # Пустые категории, одна запись и только её изменившееся поле H
+    assert len(data) == len(encode_delta(FIRST, FIRST)) + 5 + 2
+
+
+def test_shared_dict_is_unchanged():
+    # Сервер держит словарь препятствий общим, пока он не изменится
+    newer = dict(FIRST, match={0: (130, 3)})
+    assert newer["obstacles"] is FIRST["obstacles"]
+    data = encode_delta(FIRST, newer)
+    assert decode_delta(FIRST, data, 0) == newer
+    # Без сравнения по записям - та же дельта, что для равной копии
+    copied = dict(newer, obstacles=dict(FIRST["obstacles"]))
+    assert data == encode_delta(FIRST, copied)
+
+
+def snapshot_packets(tick, base, body):
+    parts = snapshot_parts(body)
+    return [packet(PACKET_SNAPSHOT, SNAPSHOT_HEADER.pack(tick, base, 0, index, len(parts)), part)
+            for index, part in enumerate(parts)]
+
+
+def connected_client():
+    client = NetClient()
+    client.welcome(1, 60, 2, 16000, 12000)
+    return client
+
+
+def test_client_needs_base():
+    client = connected_client()
+    for data in snapshot_packets(4, 2, encode_delta(FIRST, FIRST)):
+        client.receive(data, 0.0)
+    assert client.undecodable == 1
+    assert client.latest == 0 and not client.states
+
+    for data in snapshot_packets(6, 0, encode_delta({}, FIRST)):
+        client.receive(data, 0.0)
+    assert client.states[6] == FIRST
+    assert client.undecodable == 1
+
+
+def test_client_assembles_parts_in_any_order():
+    obstacles = {slot: (slot * 8 % 60000, slot * 16 % 60000, 128, 128, 65535, slot & 1)
+                 for slot in range(400)}
+    big = make_state(**dict(FIRST, obstacles=obstacles))
+    body = encode_delta({}, big)
+    packets = snapshot_packets(2, 0, body)
+    assert len(packets) == -(-len(body) // SNAPSHOT_PART) > 2
+    assert all(len(data) <= NET_HEADER.size + SNAPSHOT_HEADER.size + SNAPSHOT_PART
+               for data in packets)
+
+    client = connected_client()
+    for data in packets[:0:-1]:
+        client.receive(data, 0.0)
+    # Без первой части снимок не собран
+    assert client.latest == 0
+    client.receive(packets[0], 0.0)
+    assert client.latest == 2 and client.states[2] == big
+    assert not client.parts
@@ -0,0 +1,35 @@
+import pytest
+
+from balance import scripted_policy
+from tanks import Difficulty, Simulation
+
+
+@pytest.mark.parametrize("settings", [
+    {"seed": 1},
+    {"seed": 2, "batch_ai": True},
+    {"seed": 3, "arena_per_wave": True},
+])
+def test_load_state_continues_match(settings):
+    sim = Simulation(Difficulty.EASY, effects=False, **settings)
+    while sim.tick < 400:
+        sim.step(scripted_policy(sim))
+    # Середина волны: враги на поле, пули в полёте
+    assert sim.enemy_list and sim.bullets.count
+    saved = sim.save_state()
+    wave = sim.wave
+    inputs = []
+    while sim.tick < 1000:
+        inputs.append(scripted_policy(sim))
+        sim.step(inputs[-1])
+    # За продолжением начинается новая волна, с arena_per_wave - на новой арене
+    assert sim.wave > wave
+    expected = sim.save_state()
+
+    # Снимок загружается и в тот же матч, и в новый с теми же настройками
+    fresh = Simulation(Difficulty.EASY, effects=False, **settings)
+    for target in (sim, fresh):
+        target.load_state(saved)
+        assert target.save_state() == saved
+        for control in inputs:
+            target.step(control)
+        assert target.save_state() == expected